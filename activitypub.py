@@ -1,25 +1,35 @@
 """Handles requests for ActivityPub endpoints: actors, inbox, etc.
 """
 from base64 import b64encode
+import collections
 import datetime
 from hashlib import sha256
 import logging
+import os
 import re
 import threading
 
-from cachetools import LRUCache
+from cachetools import LRUCache, TTLCache
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
 from flask import abort, make_response, request
 from google.cloud import ndb
 from google.cloud.ndb import OR
 from granary import as1, as2
 from httpsig import HeaderVerifier
-from httpsig.utils import parse_signature_header
+from httpsig.utils import ALGORITHMS, HASHES, HttpSigException, parse_signature_header
+from httpsig.verify import Verifier
 from oauth_dropins.webutil import flask_util, util
 from oauth_dropins.webutil.util import json_dumps, json_loads
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException
 
 from app import app, cache
 import common
+import dedupe
+import metrics
 from common import CACHE_TIME, host_url, redirect_unwrap, redirect_wrap, TLD_BLOCKLIST
+from conversions import convert
 from models import Follower, Object, Target, User
 
 logger = logging.getLogger(__name__)
@@ -43,9 +53,89 @@ FETCH_OBJECT_TYPES = (
     'Announce',
 )
 
+# parsed public keys for HTTP Signature verification
+KEY_CACHE_SIZE = 10000
+KEY_TTL = datetime.timedelta(days=1)
+# minimum time between refetches of the same key after failed verifications
+KEY_REFETCH_INTERVAL = datetime.timedelta(minutes=1)
+
+# if True, inbox() acknowledges activities after only the cheap checks and
+# enqueues the rest of the processing as a task. set via environment variable,
+# eg in app.yaml.
+ASYNC_INBOX = bool(os.getenv('ASYNC_INBOX'))
+
 # activity ids that we've already handled and can now ignore
-seen_ids = LRUCache(100000)
-seen_ids_lock = threading.Lock()
+seen_ids = dedupe.from_env()
+
+
+def store_if_unseen(id, activity_unwrapped):
+    """Stores an inbound activity if we haven't already seen it.
+
+    Checks :data:`seen_ids` first, which may be shared across instances, then
+    atomically inserts a new :class:`Object` if one doesn't already exist in
+    the datastore. No global lock is held across the datastore transaction.
+    If the insert fails, forgets the id again, so that a retry isn't dropped.
+
+    Args:
+      id: str, activity id
+      activity_unwrapped: dict, AS2 activity with redirect URLs unwrapped
+
+    Returns: the new, stored :class:`Object`, or None if we've already seen
+      this activity
+    """
+    if not seen_ids.add(id):
+        return None
+
+    activity_obj = Object(id=id, as2=activity_unwrapped,
+                          source_protocol='activitypub')
+    try:
+        inserted = _insert_if_absent(activity_obj)
+    except BaseException:
+        seen_ids.discard(id)
+        raise
+
+    if inserted:
+        return activity_obj
+
+
+@ndb.transactional()
+def _insert_if_absent(obj):
+    """Stores an entity if one with the same key doesn't already exist.
+
+    Args:
+      obj: :class:`ndb.Model`
+
+    Returns: boolean, True if we stored it, False if it already existed
+    """
+    if obj.key.get():
+        return False
+    obj.put()
+    return True
+
+
+def process_or_forget(activity, activity_obj, user):
+    """Runs :func:`process_activity`, and forgets the activity if it fails.
+
+    If processing raises an error worth retrying, ie anything but a 4xx,
+    removes the activity from :data:`seen_ids` and deletes its stored
+    :class:`Object`, so that the sender's redelivery or our task's retry
+    processes it again instead of dropping it as already handled.
+
+    Args:
+      activity: dict, AS2 activity, as received
+      activity_obj: :class:`Object`, stored activity
+      user: :class:`User`, or None for the shared inbox
+
+    Returns: Flask response
+    """
+    try:
+        return process_activity(activity, activity_obj, user)
+    except BaseException as e:
+        if not (isinstance(e, HTTPException) and e.code and e.code < 500):
+            logger.info(f'Processing {activity_obj.key.id()} failed, forgetting it so it can be retried')
+            seen_ids.discard(activity_obj.key.id())
+            activity_obj.key.delete()
+        raise
 
 
 def error(msg, status=400):
@@ -97,7 +187,16 @@ def actor(domain):
 @app.post('/inbox')
 @app.post(f'/<regex("{common.DOMAIN_RE}"):domain>/inbox')
 def inbox(domain=None):
-    """Handles ActivityPub inbox delivery."""
+    """Handles ActivityPub inbox delivery.
+
+    Runs in stages, cheapest first, and only stores the activity after it's
+    passed all of them: parse, validate its type and user, check whether we've
+    already seen it, verify its HTTP Signature, then store and process it.
+    Rejected activities aren't stored; they're counted in :mod:`metrics`.
+
+    If :data:`ASYNC_INBOX` is set, signature verification and everything after
+    it happen in :func:`inbox_task` instead.
+    """
     body = request.get_data(as_text=True)
 
     # parse and validate AS2 activity
@@ -105,49 +204,181 @@ def inbox(domain=None):
         activity = request.json
         assert activity
     except (TypeError, ValueError, AssertionError):
+        metrics.incr('inbox.rejected.invalid')
         error(f"Couldn't parse body as JSON: {body}", exc_info=True)
 
-
     type = activity.get('type')
     actor = activity.get('actor')
     actor_id = actor.get('id') if isinstance(actor, dict) else actor
     logger.info(f'Got {type} activity from {actor_id}: {json_dumps(activity, indent=2)}')
 
-    obj_as2 = activity.get('object') or {}
-    if isinstance(obj_as2, str):
-        obj_as2 = {'id': obj_as2}
-
     id = activity.get('id')
     if not id:
+        metrics.incr('inbox.rejected.invalid')
         error('Activity has no id')
 
-    # short circuit if we've already seen this activity id
-    with seen_ids_lock:
-        already_seen = id in seen_ids
-        seen_ids[id] = True
-        if already_seen or Object.get_by_id(id):
-            msg = f'Already handled this activity {id}'
-            logger.info(msg)
-            return msg, 200
-
-    activity_unwrapped = redirect_unwrap(activity)
-    activity_obj = Object(id=id, as2=activity_unwrapped,
-                          source_protocol='activitypub')
-    activity_obj.put()
-
     if type == 'Accept':  # eg in response to a Follow
         return ''  # noop
     if type not in SUPPORTED_TYPES:
+        metrics.incr('inbox.rejected.unsupported_type')
         error(f'Sorry, {type} activities are not supported yet.', status=501)
 
-    # load user
     user = None
     if domain:
         user = User.get_by_id(domain)
         if not user:
+            metrics.incr('inbox.rejected.no_user')
             return f'User {domain} not found', 404
 
-    verify_signature(user)
+    # short circuit if we've already seen this activity id. this only reads;
+    # we don't mark it seen until its signature is verified, so that spoofed
+    # copies can't block the real one.
+    if id in seen_ids:
+        return already_handled(id)
+
+    if is_unknown_actor_delete(activity):
+        logger.info(f"Dropping Delete of actor {actor_id} we don't know about")
+        metrics.incr('inbox.dropped.unknown_actor_delete')
+        return 'OK'
+
+    if ASYNC_INBOX:
+        common.create_task('inbox', domain=domain or '', body=body,
+                           path=request.path,
+                           headers=json_dumps(dict(request.headers)))
+        return 'Queued', 202
+
+    activity_obj = verify_and_store(activity, user)
+    if not activity_obj:
+        return already_handled(id)
+
+    return process_or_forget(activity, activity_obj, user)
+
+
+@app.post('/_ah/queue/inbox')
+def inbox_task():
+    """Task handler for activities that :func:`inbox` enqueued.
+
+    Cloud Tasks retries any non-2xx response, so permanent rejections, ie
+    unknown users and bad signatures, return 200 to drop the task instead of
+    verifying it again on every retry.
+
+    Parameters:
+      domain: str, user domain for individual inboxes, empty for the shared inbox
+      body: str, original raw HTTP request body
+      path: str, original HTTP request path
+      headers: str, JSON object of the original HTTP request headers
+    """
+    body = flask_util.get_required_param('body')
+    activity = json_loads(body)
+
+    user = None
+    domain = request.values.get('domain')
+    if domain:
+        user = User.get_by_id(domain)
+        if not user:
+            metrics.incr('inbox.rejected.no_user')
+            return drop_task(activity, f'User {domain} not found')
+
+    try:
+        activity_obj = verify_and_store(
+            activity, user, headers=Headers(json_loads(request.values['headers'])),
+            path=request.values['path'], body=body.encode())
+    except HTTPException as e:
+        if e.code != 401:
+            raise  # eg we couldn't fetch the key. worth retrying.
+        return drop_task(activity, 'HTTP Signature verification failed')
+
+    if not activity_obj:
+        return already_handled(activity['id'])
+
+    return process_or_forget(activity, activity_obj, user)
+
+
+def drop_task(activity, reason):
+    msg = f"Dropping {activity.get('id')}: {reason}"
+    logger.info(msg)
+    return msg, 200
+
+
+def already_handled(id):
+    msg = f'Already handled this activity {id}'
+    logger.info(msg)
+    return msg, 200
+
+
+def verify_and_store(activity, user, headers=None, path=None, body=None):
+    """Verifies an inbound activity's HTTP Signature, then stores it if it's new.
+
+    Defaults to the current request's headers, path, and body.
+
+    Args:
+      activity: dict, AS2 activity, as received
+      user: :class:`User`, or None for the shared inbox
+      headers: dict-like, HTTP request headers
+      path: str, HTTP request path
+      body: bytes, raw HTTP request body
+
+    Returns: the new, stored :class:`Object`, or None if we've already seen
+      this activity
+    """
+    try:
+        verify_signature(user, headers=headers, path=path, body=body)
+    except HTTPException:
+        metrics.incr('inbox.rejected.signature')
+        raise
+
+    return store_if_unseen(activity['id'], redirect_unwrap(activity))
+
+
+def is_unknown_actor_delete(activity):
+    """Returns True if this is an actor deleting itself and we don't know them.
+
+    When an account is deleted, its server sends a Delete to every shared inbox
+    it knows about, and the actor is usually already gone, so we can't fetch
+    its key to verify the signature. If it has no followers or followees here
+    and we haven't stored it, there's nothing to do, so we can drop the
+    activity before any datastore writes or fetches.
+
+    Args:
+      activity: dict, AS2 activity
+
+    Returns: boolean
+    """
+    if activity.get('type') != 'Delete':
+        return False
+
+    actor = activity.get('actor')
+    actor_id = actor.get('id') if isinstance(actor, dict) else actor
+    obj = activity.get('object')
+    obj_id = obj.get('id') if isinstance(obj, dict) else obj
+    if not actor_id or obj_id != actor_id:
+        return False
+
+    actor_id = redirect_unwrap(actor_id)
+    if Follower.query(OR(Follower.src == actor_id,
+                         Follower.dest == actor_id)).get(keys_only=True):
+        return False
+
+    return not ndb.Key(Object, actor_id).get()
+
+
+def process_activity(activity, activity_obj, user):
+    """Handles an inbound activity after it's been verified and stored.
+
+    Args:
+      activity: dict, AS2 activity, as received
+      activity_obj: :class:`Object`, stored activity
+      user: :class:`User`, or None for the shared inbox
+
+    Returns: Flask response
+    """
+    activity_unwrapped = redirect_unwrap(activity)
+    type = activity.get('type')
+    actor = activity.get('actor')
+
+    obj_as2 = activity.get('object') or {}
+    if isinstance(obj_as2, str):
+        obj_as2 = {'id': obj_as2}
 
     # handle activity!
     if type == 'Undo' and obj_as2.get('type') == 'Follow':
@@ -203,14 +434,14 @@ def inbox(domain=None):
     if type in FETCH_OBJECT_TYPES and isinstance(inner_obj, str):
         obj = Object.get_by_id(inner_obj) or common.get_object(inner_obj, user=user)
         obj_as2 = activity['object'] = activity_unwrapped['object'] = \
-            obj.as2 if obj.as2 else as2.from_as1(obj.as1)
+            obj.as2 if obj.as2 else convert(as2.from_as1, obj.as1)
 
     if type == 'Follow':
         resp = accept_follow(activity, activity_unwrapped, user)
 
     # send webmentions to each target
     activity_obj.as2 = activity_unwrapped
-    common.send_webmentions(as2.to_as1(activity), activity_obj, proxy=True)
+    common.send_webmentions(convert(as2.to_as1, activity), activity_obj, proxy=True)
 
     # deliver original posts and reposts to followers
     if ((type == 'Create' and not activity.get('inReplyTo') and not obj_as2.get('inReplyTo'))
@@ -241,45 +472,194 @@ def inbox(domain=None):
     return 'OK'
 
 
-def verify_signature(user):
-    """Verifies the current request's HTTP Signature.
+class PublicKeys:
+    """In-memory store of parsed RSA public keys, keyed by HTTP Signature keyId.
+
+    Keys expire after :data:`KEY_TTL`. Also keeps per-keyId counters of cache
+    hits, misses, and refetches in :attr:`stats`.
+    """
+    def __init__(self, maxsize=KEY_CACHE_SIZE, ttl=KEY_TTL):
+        self.keys = TTLCache(maxsize, ttl.total_seconds())  # keyId => RsaKey
+        self.refetched = TTLCache(maxsize, KEY_REFETCH_INTERVAL.total_seconds())
+        self.stats = LRUCache(maxsize)  # keyId => collections.Counter
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+            self.refetched.clear()
+            self.stats.clear()
+
+    def _count(self, key_id, stat):
+        with self.lock:
+            self.stats.setdefault(key_id, collections.Counter())[stat] += 1
+
+    def get(self, key_id, user=None):
+        """Returns the parsed public key for a keyId, fetching it if necessary.
+
+        Args:
+          key_id: str
+          user: :class:`User` used to sign the HTTP request, if we fetch
+
+        Returns: :class:`Crypto.PublicKey.RSA.RsaKey`, or None if the keyId's
+          actor has no valid public key
+        """
+        with self.lock:
+            key = self.keys.get(key_id)
+        if key:
+            self._count(key_id, 'hit')
+            return key
+
+        self._count(key_id, 'miss')
+        return self._load(key_id, common.get_object(key_id, user=user).as2)
+
+    def refetch(self, key_id, user=None):
+        """Refetches a keyId's actor, eg after a key rotation.
+
+        Does nothing and returns None if we already fetched this key within the
+        last :data:`KEY_REFETCH_INTERVAL`.
+
+        Args:
+          key_id: str
+          user: :class:`User` used to sign the HTTP request
+
+        Returns: :class:`Crypto.PublicKey.RSA.RsaKey`, or None
+        """
+        with self.lock:
+            if key_id in self.refetched:
+                logger.info(f'Already refetched {key_id} recently')
+                return None
+            self.refetched[key_id] = True
+
+        self._count(key_id, 'refetch')
+        try:
+            actor = common.get_object(key_id, user=user, refresh=True).as2
+        except BaseException as e:
+            code, body = util.interpret_http_exception(e)
+            if not code and not body:
+                raise
+            logger.info(f"Couldn't refetch {key_id}: {code} {body}")
+            return None
+
+        return self._load(key_id, actor)
+
+    def _load(self, key_id, actor):
+        pem = (actor or {}).get('publicKey', {}).get('publicKeyPem')
+        logger.info(f'Loading key {key_id}: {pem}')
+        try:
+            key = RSA.import_key(pem)
+        except (TypeError, ValueError, IndexError) as e:
+            logger.info(f"Couldn't parse public key for {key_id}: {e}")
+            return None
+
+        with self.lock:
+            self.keys[key_id] = key
+        return key
+
+
+public_keys = PublicKeys()
+
+
+class _ImportedKeyVerifier(Verifier):
+    """Sets up RSA verification with an imported key instead of a PEM string.
+
+    Replaces :class:`httpsig.sign.Signer`'s constructor, which imports the
+    key, in :class:`KeyVerifier`'s MRO.
+    """
+    def __init__(self, key, algorithm=None):
+        if algorithm not in ALGORITHMS:
+            raise HttpSigException(f'Unknown algorithm {algorithm}')
+        self.sign_algorithm, self.hash_algorithm = algorithm.split('-')
+        if self.sign_algorithm != 'rsa':
+            raise HttpSigException(f'Unsupported algorithm {algorithm}')
+        self._rsa = PKCS1_v1_5.new(key)
+        self._hash = HASHES[self.hash_algorithm]
+
+
+class KeyVerifier(HeaderVerifier, _ImportedKeyVerifier):
+    """:class:`httpsig.HeaderVerifier` that takes an imported RSA public key.
+
+    :class:`HeaderVerifier` parses its PEM key every time, which is most of
+    the cost of verifying, so this lets us reuse the keys in
+    :data:`public_keys`. Parsing and checking the signature is all httpsig's.
+    """
+
+
+def signature_valid(key, headers, method, path):
+    """Checks the HTTP Signature in a set of headers against a public key.
+
+    Args:
+      key: :class:`Crypto.PublicKey.RSA.RsaKey`
+      headers: dict-like, HTTP request headers
+      method: str, HTTP method
+      path: str, HTTP request path
+
+    Returns: boolean
+    """
+    if not key:
+        return False
+
+    try:
+        return KeyVerifier(headers, key, required_headers=['Digest'],
+                           method=method, path=path,
+                           sign_header='signature').verify()
+    except Exception as e:
+        logger.info(f'HTTP Signature verification failed: {e}')
+        return False
+
+
+def verify_signature(user, headers=None, path=None, body=None):
+    """Verifies an inbound request's HTTP Signature.
+
+    Defaults to the current request's headers, path, and body.
 
     Args:
       user: :class:`User`
+      headers: dict-like, HTTP request headers
+      path: str, HTTP request path
+      body: bytes, raw HTTP request body
 
     Logs details of the result. Raises :class:`werkzeug.HTTPSignature` if the
     signature is missing or invalid, otherwise does nothing and returns None.
     """
-    sig = request.headers.get('Signature')
+    if headers is None:
+        headers = request.headers
+    if path is None:
+        path = request.path
+    if body is None:
+        body = request.data
+
+    sig = headers.get('Signature')
     if not sig:
         error('No HTTP Signature', status=401)
 
-    logger.info(f'Headers: {json_dumps(dict(request.headers), indent=2)}')
+    logger.info(f'Headers: {json_dumps(dict(headers), indent=2)}')
 
     # parse_signature_header lower-cases all keys
-    keyId = parse_signature_header(sig).get('keyid')
+    sig_params = parse_signature_header(sig)
+    keyId = sig_params.get('keyid')
     if not keyId:
         error('HTTP Signature missing keyId', status=401)
 
-    digest = request.headers.get('Digest') or ''
+    digest = headers.get('Digest') or ''
     if not digest:
         error('Missing Digest header, required for HTTP Signature', status=401)
 
-    expected = b64encode(sha256(request.data).digest()).decode()
+    expected = b64encode(sha256(body).digest()).decode()
     if digest.removeprefix('SHA-256=') != expected:
         error('Invalid Digest header, required for HTTP Signature', status=401)
 
-    key_actor = common.get_object(keyId, user=user).as2
-    key = key_actor.get("publicKey", {}).get('publicKeyPem')
-    logger.info(f'Verifying signature for {request.path} with key {key}')
-    try:
-        verified = HeaderVerifier(request.headers, key,
-                                  required_headers=['Digest'],
-                                  method=request.method,
-                                  path=request.path,
-                                  sign_header='signature').verify()
-    except BaseException as e:
-        error(f'HTTP Signature verification failed: {e}', status=401)
+    if 'digest' not in sig_params.get('headers', '').lower().split():
+        error('HTTP Signature verification failed: digest is a required header',
+              status=401)
+
+    logger.info(f'Verifying signature for {path} with key {keyId}')
+    key = public_keys.get(keyId, user=user)
+    verified = signature_valid(key, headers, request.method, path)
+    if not verified:
+        # maybe they rotated their key. try refetching it, once.
+        key = public_keys.refetch(keyId, user=user)
+        verified = key and signature_valid(key, headers, request.method, path)
 
     if verified:
         logger.info('HTTP Signature verified!')
@@ -442,3 +822,28 @@ def outbox(domain):
                 'items': [],
             },
         }, {'Content-Type': as2.CONTENT_TYPE}
+
+
+@app.post('/_ah/queue/refresh-object')
+def refresh_object_task():
+    """Task handler that refetches a stale stored object.
+
+    Queued by :func:`common.check_fresh`. If the object hasn't changed, only
+    updates its ``fetched`` time, and only once that's half way to
+    :data:`common.OBJECT_MAX_AGE`.
+
+    Parameters:
+      id: str, :class:`Object` id
+    """
+    id = flask_util.get_required_param('id')
+
+    try:
+        common.get_object(id, refresh=True)
+    except BaseException as e:
+        code, body = util.interpret_http_exception(e)
+        if not code and not body:
+            raise
+        # don't retry; we'll queue another refresh the next time it's loaded
+        return f"Couldn't refresh {id}: {code} {body}"
+
+    return f'Refreshed {id}'
@@ -2,29 +2,41 @@
 """Misc common utilities.
 """
 from base64 import b64encode
+import collections
 import copy
 from datetime import timedelta, timezone
+import functools
 from hashlib import sha256
 import itertools
 import logging
 import os
+import random
 import re
 import threading
 import urllib.parse
+from urllib.parse import urlencode
 
-from cachetools import cached, LRUCache
+from cachetools import cached, LRUCache, TLRUCache, TTLCache
 from flask import request
+from google.cloud import ndb
 from granary import as1, as2, microformats2
 from httpsig.requests_auth import HTTPSignatureAuth
 import mf2util
 from oauth_dropins.webutil import util, webmention
+from oauth_dropins.webutil.appengine_config import tasks_client
 from oauth_dropins.webutil.flask_util import error
-from oauth_dropins.webutil.appengine_info import DEBUG
+from oauth_dropins.webutil.appengine_info import APP_ID, DEBUG
 from oauth_dropins.webutil.util import json_dumps, json_loads
 import requests
-from werkzeug.exceptions import BadGateway
+from werkzeug.exceptions import BadGateway, default_exceptions
 
-from models import Follower, Object, Target, User
+from conversions import convert
+import delivery
+import discovery
+import host_health
+import http_client
+import metrics
+from models import Delivery, Follower, Object, User
 
 logger = logging.getLogger(__name__)
 
@@ -77,6 +89,88 @@ PAGE_SIZE = 20
 
 HTTP_SIG_HEADERS = ('Date', 'Host', 'Digest', '(request-target)')
 
+# https://cloud.google.com/appengine/docs/locations
+TASKS_LOCATION = 'us-central1'
+
+# automatic retries of failed deliveries. the delay before each retry doubles,
+# from RETRY_BASE_DELAY up to RETRY_MAX_DELAY, with jitter. RETRY_MAX_ATTEMPTS
+# includes the first attempt.
+RETRY_MAX_ATTEMPTS = 8
+RETRY_BASE_DELAY = timedelta(minutes=1)
+RETRY_MAX_DELAY = timedelta(hours=6)
+
+# how long get_object remembers that fetching an id failed. see
+# FetchFailures.ttl.
+FAILURE_TTL = timedelta(hours=1)
+FAILURE_TTL_GONE = timedelta(days=1)
+FAILURE_TTL_UNAVAILABLE = timedelta(minutes=5)
+# truncate cached failure messages to this many characters
+FAILURE_MESSAGE_LENGTH = 500
+
+# freshness of remote objects that get_object loads. once a stored object is
+# older than its TTL, we return it as is and refresh it in the background, at
+# most once per REFRESH_INTERVAL per instance. once it's older than
+# OBJECT_MAX_AGE, we refetch it before returning it.
+ACTOR_TYPES = frozenset(('application', 'group', 'organization', 'person',
+                         'service'))
+ACTOR_TTL = timedelta(days=1)
+OBJECT_TTL = timedelta(days=7)
+OBJECT_MAX_AGE = timedelta(days=30)
+REFRESH_INTERVAL = timedelta(hours=1)
+
+
+class LocalTaskQueue:
+    """In-process stand-in for Cloud Tasks, for tests, benchmarks, and local dev.
+
+    Has the same :meth:`create_task` signature as :class:`CloudTasksClient`.
+    Tasks are collected in memory and only run when :meth:`run` is called,
+    which POSTs them to our own task handlers with a Flask test client.
+    """
+    def __init__(self):
+        self.tasks = collections.deque()
+        self.lock = threading.Lock()
+
+    def create_task(self, parent=None, task=None):
+        with self.lock:
+            self.tasks.append(task)
+        return task
+
+    def clear(self):
+        with self.lock:
+            self.tasks.clear()
+
+    def run(self, client, now=None):
+        """Runs queued tasks in order, including any that they enqueue.
+
+        Args:
+          client: :class:`flask.testing.FlaskClient`
+          now: :class:`datetime.datetime`. If provided, only runs tasks
+            scheduled for then or earlier, and leaves the rest queued.
+
+        Returns: list of :class:`werkzeug.test.TestResponse`
+        """
+        responses = []
+        later = []
+        while True:
+            with self.lock:
+                if not self.tasks:
+                    self.tasks.extend(later)
+                    return responses
+                task = self.tasks.popleft()
+
+            schedule_time = task.get('schedule_time')
+            if now and schedule_time and schedule_time > now:
+                later.append(task)
+                continue
+
+            req = task['app_engine_http_request']
+            responses.append(client.post(req['relative_uri'], data=req['body'],
+                                         headers=req['headers']))
+
+
+# if set, a :class:`LocalTaskQueue` that create_task uses instead of Cloud Tasks
+local_tasks = None
+
 
 def host_url(path_query=None):
   base = request.host_url
@@ -118,9 +212,270 @@ def pretty_link(url, text=None, user=None):
   return util.pretty_link(url, text=text)
 
 
-@cached(LRUCache(1000), key=lambda id, user=None: util.fragmentless(id),
-        lock=threading.Lock())
-def get_object(id, user=None):
+class FetchFailure:
+    """Why :func:`get_object` couldn't fetch an id.
+
+    Stores just enough to raise an equivalent exception, not the exception
+    itself, which would keep its traceback, chained exceptions, and response
+    alive, and would be shared and re-raised across requests and threads.
+
+    Attributes:
+      code: int, HTTP status code of the exception, eg 502
+      message: str
+      status: int, HTTP status code of the upstream response, or None
+      ttl: :class:`datetime.timedelta`, how long to remember this failure
+    """
+    __slots__ = ('code', 'message', 'status', 'ttl')
+
+    def __init__(self, exception):
+        code, body = util.interpret_http_exception(exception)
+        self.code = int(code) if str(code).isdigit() else 502
+        self.message = str(body or exception)[:FAILURE_MESSAGE_LENGTH]
+        self.status = http_client.status_code(exception)
+        self.ttl = FetchFailures.ttl(exception)
+
+    def __str__(self):
+        return f'{self.code} {self.message}'
+
+    def exception(self):
+        """Returns a new :class:`werkzeug.exceptions.HTTPException` for this failure."""
+        err = default_exceptions.get(self.code, BadGateway)(self.message)
+        if self.status:
+            # so that http_client.status_code finds it
+            resp = requests.Response()
+            resp.status_code = self.status
+            err.__context__ = requests.HTTPError(response=resp)
+        return err
+
+
+class FetchFailures:
+    """Thread-safe negative cache of ids that :func:`get_object` couldn't fetch.
+
+    Each failure expires after a TTL based on why it failed; see :meth:`ttl`.
+    """
+    def __init__(self, maxsize=10000):
+        self.failures = TLRUCache(
+            maxsize, ttu=lambda id, failure, now: now + failure.ttl.total_seconds(),
+            timer=lambda: util.now().timestamp())
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def ttl(exception):
+        """Returns how long to remember a failure.
+
+        Args:
+          exception: :class:`BaseException`
+
+        Returns: :class:`datetime.timedelta`, :data:`FAILURE_TTL_GONE` for 410s,
+          :data:`FAILURE_TTL_UNAVAILABLE` for connection failures, timeouts,
+          and other errors worth retrying, :data:`FAILURE_TTL` otherwise, eg
+          for 404s and HTML pages without AS2.
+        """
+        resp = getattr(exception, 'requests_response', None)
+        if resp is not None and resp.ok:
+            return FAILURE_TTL  # fetched fine, but no AS2
+
+        if http_client.status_code(exception) == 410:
+            return FAILURE_TTL_GONE
+        elif is_retryable(exception):
+            return FAILURE_TTL_UNAVAILABLE
+        return FAILURE_TTL
+
+    def get(self, id):
+        """Returns the :class:`FetchFailure` for id, or None if it's not cached."""
+        with self.lock:
+            return self.failures.get(id)
+
+    def add(self, id, exception):
+        failure = FetchFailure(exception)
+        with self.lock:
+            self.failures[id] = failure
+
+    def discard(self, id):
+        with self.lock:
+            self.failures.pop(id, None)
+
+    def clear(self):
+        with self.lock:
+            self.failures.clear()
+
+
+fetch_failures = FetchFailures()
+
+
+_MISSING = object()
+
+
+class _Flight:
+    """One in-flight call of a :func:`single_flight` function."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+    def raise_exception(self):
+        """Raises a copy of the leader's exception for a waiting caller.
+
+        Each waiter gets its own exception, without the leader's traceback, so
+        that waiters in different threads don't share and extend one live
+        exception. Keeps its chained exceptions, since eg
+        :func:`http_client.status_code` looks at them.
+        """
+        e = self.exception
+        try:
+            copied = copy.copy(e)
+        except Exception:
+            copied = FetchFailure(e).exception()
+        copied.__cause__ = e.__cause__
+        copied.__context__ = e.__context__
+        raise copied
+
+
+def single_flight(cache, key, check=None):
+    """Decorator like :func:`cachetools.cached` that also coalesces calls.
+
+    If a call with the same key is already in flight, other callers wait for it
+    and get its result, or raise a copy of its exception, instead of calling the
+    function again themselves. Those are counted in the ``[FUNCTION NAME].coalesced``
+    metric. Exceptions aren't cached.
+
+    Callers that pass ``refresh=True`` skip the cache and only coalesce with
+    each other.
+
+    If ``check`` is provided, it's called on each cached value before returning
+    it. If it returns False, the value is ignored, as if it weren't cached.
+
+    Like :func:`cachetools.cached`, the decorated function has ``cache``,
+    ``cache_key``, and ``cache_lock`` attributes.
+
+    Args:
+      cache: :class:`cachetools.Cache` or other mutable mapping
+      key: callable that takes the function's args and returns a cache key
+      check: callable that takes a cached value and returns boolean, optional
+    """
+    def decorator(fn):
+        lock = threading.Lock()
+        flights = {}  # (cache key, refresh) => _Flight
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            k = key(*args, **kwargs)
+            refresh = bool(kwargs.get('refresh'))
+            if not refresh:
+                with lock:
+                    value = cache.get(k, _MISSING)
+                # check outside the lock since it may be slow
+                if value is not _MISSING and (not check or check(value)):
+                    return value
+
+            with lock:
+                flight = flights.get((k, refresh))
+                if not flight:
+                    flight = flights[(k, refresh)] = _Flight()
+                    leader = True
+                else:
+                    leader = False
+
+            if not leader:
+                metrics.incr(f'{fn.__name__}.coalesced')
+                flight.done.wait()
+                if flight.exception:
+                    flight.raise_exception()
+                return flight.result
+
+            try:
+                flight.result = fn(*args, **kwargs)
+                with lock:
+                    try:
+                        cache[k] = flight.result
+                    except ValueError:
+                        pass  # too large for the cache
+                return flight.result
+            except BaseException as e:
+                flight.exception = e
+                raise
+            finally:
+                with lock:
+                    del flights[(k, refresh)]
+                flight.done.set()
+
+        wrapper.cache = cache
+        wrapper.cache_key = key
+        wrapper.cache_lock = lock
+        return wrapper
+
+    return decorator
+
+
+_refresh_queued = TTLCache(10000, REFRESH_INTERVAL.total_seconds())
+_refresh_queued_lock = threading.Lock()
+
+
+def object_age(obj):
+    """Returns how long ago we fetched a stored remote object, or None.
+
+    Actors and other objects we fetched before we started recording that use
+    their last update time instead. Activities without a fetch time came in
+    through our inbox, not :func:`get_object`, so they're never refreshed.
+
+    Args:
+      obj: :class:`Object`
+
+    Returns: :class:`datetime.timedelta`, or None if obj isn't a stored remote
+      object that we fetched
+    """
+    if obj.source_protocol != 'activitypub' or not obj.as2:
+        return None
+
+    if obj.fetched:
+        fetched = obj.fetched
+    elif obj.updated and obj.as1.get('objectType') != 'activity':
+        fetched = obj.updated.replace(tzinfo=timezone.utc)
+    else:
+        return None
+
+    return util.now() - fetched
+
+
+def check_fresh(obj):
+    """Applies :func:`get_object`'s freshness policy to a stored object.
+
+    If it's older than its TTL, queues a background refresh, at most once per
+    :data:`REFRESH_INTERVAL` per instance.
+
+    Args:
+      obj: :class:`Object`
+
+    Returns: boolean, False if it's older than :data:`OBJECT_MAX_AGE` and we
+      should refetch it before using it, True otherwise
+    """
+    age = object_age(obj)
+    if age is None:
+        return True
+    elif age >= OBJECT_MAX_AGE:
+        logger.info(f'{obj.key.id()} is {age} old, expired')
+        metrics.incr('get_object.expired')
+        return False
+
+    ttl = ACTOR_TTL if obj.type in ACTOR_TYPES else OBJECT_TTL
+    if age >= ttl:
+        id = obj.key.id()
+        with _refresh_queued_lock:
+            if id in _refresh_queued:
+                return True
+            _refresh_queued[id] = True
+
+        logger.info(f'{id} is {age} old, queueing refresh')
+        metrics.incr('get_object.refresh.queued')
+        create_task('refresh-object', id=id)
+
+    return True
+
+
+@single_flight(LRUCache(1000),
+               key=lambda id, user=None, refresh=False: util.fragmentless(id),
+               check=check_fresh)
+def get_object(id, user=None, refresh=False):
     """Loads and returns an Object from memory cache, datastore, or HTTP fetch.
 
     Assumes id is a URL. Any fragment at the end is stripped before loading.
@@ -133,72 +488,275 @@ def get_object(id, user=None):
     https://github.com/mastodon/mastodon/issues/13879 (open!)
     https://github.com/w3c/activitypub/issues/224
 
-    Note that :meth:`Object._post_put_hook` updates the cache.
+    Concurrent calls for the same id share one load and fetch; see
+    :func:`single_flight`. Note that :meth:`Object._post_put_hook` updates the
+    cache.
+
+    If fetching fails, we remember that in :data:`fetch_failures` and raise
+    an equivalent exception for that id, without loading or fetching it
+    again, until the failure expires. If we have an expired stored copy,
+    though, we return that instead, eg so that we can still verify a Delete
+    from an actor whose account is gone.
+
+    Stored remote objects are refreshed based on their age; see
+    :func:`check_fresh`.
 
     Args:
       id: str
       user: optional, :class:`User` used to sign HTTP request, if necessary
+      refresh: boolean, if True, skip the caches and the datastore, and always
+        fetch over HTTP
 
     Returns: Object, or None if it can't be fetched
+
+    Raises: whatever :func:`get_as2` raises
     """
     id = util.fragmentless(id)
     logger.info(f'Loading Object {id}')
+
+    if not refresh:
+      failure = fetch_failures.get(id)
+      if failure:
+        logger.info(f'  fetching failed recently: {failure}')
+        metrics.incr('get_object.failure_cached')
+        raise failure.exception()
+
     obj = Object.get_by_id(id)
+    expired = False
     if obj:
-      if obj.as2:
-        logger.info('  got from datastore')
-        return obj
+      if obj.as2 and not refresh:
+        if check_fresh(obj):
+          logger.info('  got from datastore')
+          return obj
+        expired = True
     else:
       obj = Object(id=id)
 
-    logger.info(f'Object not in datastore or has no as2: {id}')
-    obj_as2 = get_as2(id, user=user)
+    logger.info(f'Fetching {id}')
+    try:
+      obj_as2 = get_as2(id, user=user)
+    except BaseException as e:
+      code, body = util.interpret_http_exception(e)
+      if not code and not body:
+        raise
+      elif expired:
+        # an old copy is better than nothing
+        logger.info(f"  couldn't refetch expired {id}, using stored copy: {code} {body}")
+        metrics.incr('get_object.expired.fetch_failed')
+        return obj
+      elif not refresh:
+        # a failed refresh shouldn't hide the object we already have
+        fetch_failures.add(id, e)
+      raise
+
+    now = util.now()
+    if (obj.as2 == obj_as2 and not obj.mf2
+        and obj.source_protocol == 'activitypub'):
+      # unchanged. only record that we checked it once it's half way to
+      # expiring, so that live objects don't hit the hard expiry. until then,
+      # _refresh_queued limits how often we check it.
+      metrics.incr('get_object.refresh.unchanged')
+      if obj.fetched and now - obj.fetched < OBJECT_MAX_AGE / 2:
+        logger.info('  unchanged, not storing')
+      else:
+        logger.info('  unchanged, only updating fetched')
+        obj.fetched = now
+        obj.put()
+      return obj
 
     if obj.mf2:
       logging.warning(f'Wiping out mf2 property: {obj.mf2}')
       obj.mf2 = None
 
-    obj.populate(as2=obj_as2, source_protocol='activitypub')
+    obj.populate(as2=obj_as2, source_protocol='activitypub', fetched=now)
     obj.put()
     return obj
 
 
+def create_task(queue, schedule_time=None, **params):
+    """Adds a Cloud Tasks task that POSTs to our /_ah/queue/[queue] handler.
+
+    Uses :data:`local_tasks` instead if it's set.
+
+    Args:
+      queue: str, queue name
+      schedule_time: :class:`datetime.datetime`, optional, when to run the
+        task. Defaults to now.
+      params: form-encoded into the task's POST body
+    """
+    task = {
+        'app_engine_http_request': {
+            'http_method': 'POST',
+            'relative_uri': f'/_ah/queue/{queue}',
+            'body': urlencode(params).encode(),
+            # https://googleapis.dev/python/cloudtasks/latest/gapic/v2/types.html#google.cloud.tasks_v2.types.AppEngineHttpRequest.headers
+            'headers': {'Content-Type': 'application/x-www-form-urlencoded'},
+        },
+    }
+    if schedule_time:
+        task['schedule_time'] = schedule_time
+
+    if local_tasks is not None:
+        return local_tasks.create_task(parent=queue, task=task)
+
+    queue_path = tasks_client.queue_path(APP_ID, TASKS_LOCATION, queue)
+    return tasks_client.create_task(parent=queue_path, task=task)
+
+
+def is_retryable(exception):
+    """Returns True if a failed delivery is worth retrying later.
+
+    Connection failures, timeouts, 408s, 429s, and 5xxes are retryable. Other
+    4xxes aren't, since the receiver will probably reject the same request
+    again.
+
+    Args:
+      exception: :class:`BaseException`
+    """
+    code = http_client.status_code(exception)
+    return code is None or code in (408, 429) or code >= 500
+
+
+def retry_delay(attempts):
+    """Returns how long to wait before the next attempt.
+
+    Exponential backoff with "equal jitter": a random delay between half and
+    all of ``RETRY_BASE_DELAY * 2^(attempts - 1)``, capped at
+    :data:`RETRY_MAX_DELAY`, so that retries to a host that was down don't all
+    arrive at once when it comes back.
+
+    Args:
+      attempts: int, number of attempts so far, including the first
+
+    Returns: :class:`datetime.timedelta`
+    """
+    delay = min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+    return delay / 2 + delay / 2 * random.random()
+
+
+def schedule_retry(obj_id, target, exception, queue, params):
+    """Records a failed delivery attempt and schedules a retry if warranted.
+
+    Stores the attempt count and next attempt time in a :class:`Delivery`.
+    Gives up if the failure isn't retryable or after
+    :data:`RETRY_MAX_ATTEMPTS` attempts.
+
+    Args:
+      obj_id: str, :class:`Object` id
+      target: str, target URI, eg inbox or webmention target
+      exception: :class:`BaseException`, the failure
+      queue: str, task queue that retries delivery to this target
+      params: dict, task parameters, passed through to :func:`create_task`
+
+    Returns: boolean, True if a retry was scheduled
+    """
+    if not is_retryable(exception):
+        return False
+
+    delivery = _record_attempt(obj_id, target, exception)
+    if not delivery.next_attempt:
+        logger.info(f'Giving up on {target} for {obj_id} after {delivery.attempts} attempts')
+        metrics.incr('delivery.retry.gave_up')
+        return False
+
+    logger.info(f'Retrying {target} for {obj_id} at {delivery.next_attempt}, attempt {delivery.attempts + 1}')
+    metrics.incr('delivery.retry.scheduled')
+    create_task(queue, schedule_time=delivery.next_attempt, **params)
+    return True
+
+
+@ndb.transactional()
+def _record_attempt(obj_id, target, exception):
+    """Increments a :class:`Delivery`'s attempts and sets its next attempt.
+
+    Returns: :class:`Delivery`
+    """
+    id = Delivery._id(obj_id, target)
+    delivery = (Delivery.get_by_id(id) or
+                Delivery(id=id, obj_id=obj_id, target=target))
+    delivery.attempts += 1
+    delivery.last_error = str(exception)
+    delivery.next_attempt = (util.now() + retry_delay(delivery.attempts)
+                             if delivery.attempts < RETRY_MAX_ATTEMPTS else None)
+    delivery.put()
+    return delivery
+
+
 def signed_get(url, user, **kwargs):
-    return signed_request(util.requests_get, url, user, **kwargs)
+    return signed_request(http_client.get, url, user, **kwargs)
 
 
 def signed_post(url, user, **kwargs):
     assert user
-    return signed_request(util.requests_post, url, user, **kwargs)
+    return signed_request(http_client.post, url, user, **kwargs)
+
+
+class SignedPayload:
+    """An AS2 object serialized and digested once, to send to many inboxes.
+
+    Pass as ``data`` to :func:`signed_post` so that each inbox only pays for
+    its own Date and Host headers and RSA signature.
+
+    Attributes:
+      body: bytes, serialized JSON, or None
+      digest: str, ``Digest`` header value
+    """
+    def __init__(self, data, log_data=True):
+        """
+        Args:
+          data: dict AS2 object, or None
+          log_data: boolean, whether to log the full data object
+        """
+        if data and log_data:
+            logger.info(f'Sending AS2 object: {json_dumps(data, indent=2)}')
+        self.body = json_dumps(data).encode() if data else None
+        self.digest = f'SHA-256={b64encode(sha256(self.body or b"").digest()).decode()}'
+
+
+@cached(LRUCache(1000), key=lambda user, key_id: (key_id, user.private_exponent),
+        lock=threading.Lock())
+def signature_auth(user, key_id):
+    """Returns a reusable HTTP Signature auth for a user.
+
+    Imports the user's private key once, not on every request.
+
+    Args:
+      user: :class:`User`
+      key_id: str
+
+    Returns: :class:`HTTPSignatureAuth`
+    """
+    # (request-target) is a special HTTP Signatures header that some fediverse
+    # implementations require, eg Peertube.
+    # https://datatracker.ietf.org/doc/html/draft-cavage-http-signatures-12#section-2.3
+    # https://github.com/snarfed/bridgy-fed/issues/40
+    return HTTPSignatureAuth(secret=user.private_pem(), key_id=key_id,
+                             algorithm='rsa-sha256', sign_header='signature',
+                             headers=HTTP_SIG_HEADERS)
 
 
 def signed_request(fn, url, user, data=None, log_data=True, headers=None, **kwargs):
     """Wraps requests.* and adds HTTP Signature.
 
     Args:
-      fn: :func:`util.requests_get` or  :func:`util.requests_get`
+      fn: :func:`http_client.get` or :func:`http_client.post`
       url: str
       user: :class:`User` to sign request with
-      data: optional AS2 object
+      data: optional AS2 object, or :class:`SignedPayload`
       log_data: boolean, whether to log full data object
       kwargs: passed through to requests
 
     Returns: :class:`requests.Response`
     """
-    if headers is None:
-        headers = {}
-
     # prepare HTTP Signature and headers
     if not user:
         user = default_signature_user()
 
-    if data:
-        if log_data:
-            logger.info(f'Sending AS2 object: {json_dumps(data, indent=2)}')
-        data = json_dumps(data).encode()
+    if not isinstance(data, SignedPayload):
+        data = SignedPayload(data, log_data=log_data)
 
-    headers = copy.deepcopy(headers)
-    headers.update({
+    headers = {
+        **(headers or {}),
         # required for HTTP Signature
         # https://tools.ietf.org/html/draft-cavage-http-signatures-07#section-2.1.3
         'Date': util.now().strftime('%a, %d %b %Y %H:%M:%S GMT'),
@@ -207,28 +765,26 @@ def signed_request(fn, url, user, data=None, log_data=True, headers=None, **kwar
         'Host': util.domain_from_link(url, minimize=False),
         'Content-Type': as2.CONTENT_TYPE,
         # required for HTTP Signature and Mastodon
-        'Digest': f'SHA-256={b64encode(sha256(data or b"").digest()).decode()}',
-    })
+        'Digest': data.digest,
+    }
 
     domain = user.key.id()
     logger.info(f"Signing with {domain}'s key")
-    key_id = host_url(domain)
-    # (request-target) is a special HTTP Signatures header that some fediverse
-    # implementations require, eg Peertube.
-    # https://datatracker.ietf.org/doc/html/draft-cavage-http-signatures-12#section-2.3
-    # https://github.com/snarfed/bridgy-fed/issues/40
-    auth = HTTPSignatureAuth(secret=user.private_pem(), key_id=key_id,
-                             algorithm='rsa-sha256', sign_header='signature',
-                             headers=HTTP_SIG_HEADERS)
+    auth = signature_auth(user, host_url(domain))
 
     # make HTTP request
     kwargs.setdefault('gateway', True)
-    resp = fn(url, data=data, auth=auth, headers=headers, allow_redirects=False,
-              **kwargs)
+    try:
+        resp = fn(url, data=data.body, auth=auth, headers=headers,
+                  allow_redirects=False, **kwargs)
+    except BaseException as e:
+        host_health.hosts.record_exception(url, e)
+        raise
+    host_health.hosts.record(url, resp.status_code < 500)
     logger.info(f'Got {resp.status_code} headers: {resp.headers}')
 
     # handle GET redirects manually so that we generate a new HTTP signature
-    if resp.is_redirect and fn == util.requests_get:
+    if resp.is_redirect and fn == http_client.get:
       return signed_request(fn, resp.headers['Location'], data=data, user=user,
                             headers=headers, log_data=log_data, **kwargs)
 
@@ -331,6 +887,10 @@ def remove_blocklisted(urls):
 
 def send_webmentions(activity_wrapped, obj, proxy=None):
     """Sends webmentions for an incoming ActivityPub inbox delivery.
+
+    Discovers endpoints and sends to targets concurrently, with
+    :func:`delivery.deliver`.
+
     Args:
       activity_wrapped: dict, AS1 activity
       obj: :class:`Object`
@@ -381,48 +941,105 @@ def send_webmentions(activity_wrapped, obj, proxy=None):
 
     # send webmentions and update Object
     errors = []  # stores (code, body) tuples
-    targets = [Target(uri=uri, protocol='activitypub') for uri in targets]
-
-    obj.populate(
-      undelivered=targets,
-      status='in progress',
-    )
-    if obj.undelivered and 'notification' not in obj.labels:
+    failures = []  # stores (target, exception) tuples
+    obj.status = 'in progress'
+    if 'notification' not in obj.labels:
       obj.labels.append('notification')
 
-    while obj.undelivered:
-        target = obj.undelivered.pop()
-        domain = util.domain_from_link(target.uri, minimize=False)
-        if domain == util.domain_from_link(source, minimize=False):
-            logger.info(f'Skipping same-domain webmention from {source} to {target.uri}')
-            continue
-
+    source_domain = util.domain_from_link(source, minimize=False)
+    to_send = []
+    for target in reversed(targets):
+        if util.domain_from_link(target, minimize=False) == source_domain:
+            logger.info(f'Skipping same-domain webmention from {source} to {target}')
+        else:
+            to_send.append(target)
+
+    to_send, deferred = host_health.hosts.partition(to_send)
+    for target in to_send:
+        domain = util.domain_from_link(target, minimize=False)
         if domain not in obj.domains:
             obj.domains.append(domain)
-        wm_source = (obj.proxy_url()
-                     if verb in ('follow', 'like', 'share') or proxy
-                     else source)
-        logger.info(f'Sending webmention from {wm_source} to {target.uri}')
 
+    wm_source = (obj.proxy_url()
+                 if verb in ('follow', 'like', 'share') or proxy
+                 else source)
+
+    # datastore reads and writes happen here in the main thread. send() runs
+    # in delivery.deliver's worker threads, which don't have an ndb context.
+    deliveries = Delivery.load(obj.key.id(), targets)
+    dirty = []
+    endpoints = discovery.get(to_send)
+    discovered = {}  # str target => str endpoint or None
+    stale = []  # targets whose cached endpoint failed
+
+    def set_status(target, status):
+        if obj.set_delivery(deliveries[target], status):
+            dirty.append(deliveries[target])
+
+    def save():
+        ndb.put_multi(dirty + [obj])
+        dirty.clear()
+
+    def send(target):
+        """Discovers the endpoint and sends. Returns the endpoint or None."""
         try:
-            endpoint = webmention.discover(target.uri).endpoint
+            if target in endpoints:
+                endpoint = endpoints[target]
+            else:
+                endpoint = webmention.discover(
+                    target, session=http_client.session).endpoint
             if endpoint:
-                webmention.send(endpoint, wm_source, target.uri)
-                logger.info('Success!')
-                obj.delivered.append(target)
+                logger.info(f'Sending webmention from {wm_source} to {target}')
+                webmention.send(endpoint, wm_source, target,
+                                session=http_client.session)
             else:
-                logger.info('No webmention endpoint')
+                logger.info(f'No webmention endpoint for {target}')
         except BaseException as e:
-          code, body = util.interpret_http_exception(e)
-          if not code and not body:
+            host_health.hosts.record_exception(target, e)
             raise
-          errors.append((code, body))
-          obj.failed.append(target)
-
-        obj.put()
 
-    obj.status = ('complete' if obj.delivered or obj.domains
-                  else 'failed' if obj.failed
+        host_health.hosts.record(target, True)
+        return endpoint
+
+    with delivery.Checkpoint(save) as checkpoint:
+        # leave deferred targets undelivered so that they can be retried later
+        for target in deferred:
+            set_status(target, 'undelivered')
+            checkpoint.changed()
+
+        for result in delivery.deliver(to_send, send):
+            target = result.url
+            if result.exception:
+                code, body = util.interpret_http_exception(result.exception)
+                if not code and not body:
+                    raise result.exception
+                errors.append((code, body))
+                set_status(target, 'failed')
+                if target in endpoints:
+                    stale.append(target)
+                failures.append((target, result.exception))
+            else:
+                if target not in endpoints:
+                    discovered[target] = result.response
+                if result.response:
+                    set_status(target, 'delivered')
+
+            checkpoint.changed()
+
+    discovery.put(discovered)
+    discovery.delete(stale)
+
+    for target, e in failures:
+        schedule_retry(obj.key.id(), target, e, 'send-webmention', {
+            'obj_id': obj.key.id(),
+            'source': wm_source,
+            'target': target,
+        })
+
+    # deferred targets stay undelivered so that they can be retried later
+    obj.status = ('in progress' if obj.undelivered_count
+                  else 'complete' if obj.delivered_count or obj.domains
+                  else 'failed' if obj.failed_count
                   else 'ignored')
 
     if errors:
@@ -674,8 +1291,9 @@ def actor(user):
     if not hcard:
         error(f"Couldn't find a representative h-card (http://microformats.org/wiki/representative-hcard-parsing) on {mf2['url']}")
 
-    actor_as1 = microformats2.json_to_object(hcard, rel_urls=mf2.get('rel-urls'))
-    actor_as2 = postprocess_as2(as2.from_as1(actor_as1), user=user)
+    actor_as1 = convert(microformats2.json_to_object, hcard,
+                        rel_urls=mf2.get('rel-urls'))
+    actor_as2 = postprocess_as2(convert(as2.from_as1, actor_as1), user=user)
     # TODO: unify with activitypub.actor()
     actor_as2.update({
         'id': host_url(domain),
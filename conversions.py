@@ -0,0 +1,106 @@
+"""Cache for granary format conversions, across requests.
+
+We convert the same documents over and over, eg popular actors and posts
+arriving in many inboxes or rendered on many pages. :func:`convert` caches
+each conversion's result by converter and a hash of its input, in memory,
+up to :data:`MAX_BYTES` of serialized results per instance, least recently
+used first out.
+
+``scripts/benchmark_conversions.py`` compares cache hits and misses to
+uncached conversions.
+
+Counts hits and misses per converter in the ``conversions.[NAME].hit`` and
+``conversions.[NAME].miss`` metrics.
+
+Only use this for pure conversions that don't make HTTP requests, eg not
+:func:`granary.microformats2.json_to_object` with ``fetch_mf2=True``.
+"""
+from hashlib import sha256
+import logging
+import threading
+
+from cachetools import LRUCache
+from oauth_dropins.webutil.util import json_dumps, json_loads
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_BYTES = 32 * 1024 * 1024
+
+
+class ConversionCache:
+    """Thread-safe LRU cache of conversion results with a memory budget.
+
+    Results are stored serialized, as JSON if they're not strings, so each
+    hit returns a new copy that callers can modify.
+    """
+    def __init__(self, max_bytes=MAX_BYTES):
+        """
+        Args:
+          max_bytes: int, max total size of serialized results, in bytes
+        """
+        # values are (str serialized result, boolean whether it's JSON,
+        # int size in bytes)
+        self.cache = LRUCache(max_bytes, getsizeof=lambda val: val[2])
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def convert(self, fn, *args, **kwargs):
+        """Returns ``fn(*args, **kwargs)``, from the cache if possible.
+
+        Args:
+          fn: callable, the converter, eg :func:`granary.as2.to_as1`
+          args, kwargs: JSON-serializable inputs to ``fn``
+
+        Returns: ``fn``'s result, or a copy of it
+        """
+        name = getattr(fn, '__name__', 'unknown')
+        try:
+            # don't sort keys. it's slower, and the same input almost always
+            # comes from the same source JSON, so its keys are in the same order.
+            digest = sha256(json_dumps([args, kwargs]).encode())
+        except TypeError:
+            # not JSON-serializable
+            metrics.incr(f'conversions.{name}.uncacheable')
+            return fn(*args, **kwargs)
+
+        key = (fn, digest.digest())
+        with self.lock:
+            cached = self.cache.get(key)
+
+        if cached:
+            metrics.incr(f'conversions.{name}.hit')
+            val, is_json, _ = cached
+            return json_loads(val) if is_json else val
+
+        metrics.incr(f'conversions.{name}.miss')
+        result = fn(*args, **kwargs)
+        is_json = not isinstance(result, str)
+        try:
+            val = json_dumps(result) if is_json else result
+        except TypeError:
+            return result
+
+        size = len(val.encode())
+        with self.lock:
+            try:
+                self.cache[key] = (val, is_json, size)
+            except ValueError:
+                pass  # too large for the cache
+
+        return result
+
+
+cache = ConversionCache()
+
+
+def convert(fn, *args, **kwargs):
+    """Returns ``fn(*args, **kwargs)``, cached in :data:`cache`.
+
+    See :meth:`ConversionCache.convert`.
+    """
+    return cache.convert(fn, *args, **kwargs)
@@ -0,0 +1,346 @@
+"""Backends for remembering which inbound activity ids we've already handled.
+
+:func:`activitypub.inbox` uses these to reject duplicate deliveries, eg when
+the same activity is fanned out to multiple shared inboxes, without touching
+the datastore. Choose a backend with the ``DEDUPE_BACKEND`` environment
+variable, eg in app.yaml:
+
+* ``hashed`` (default): in-process, compact, time windowed set of hashes.
+  Each instance has its own view.
+* ``lru``: in-process LRU cache of full ids. Each instance has its own view.
+* ``memcache``: shared across instances. Server is ``MEMCACHE_HOST``.
+* ``redis``: shared across instances. Server is ``REDIS_URL``.
+
+:class:`FakeSeenIds` is an in-memory stand-in for the shared backends in tests.
+"""
+from array import array
+from datetime import timedelta
+from hashlib import blake2b, sha256
+import logging
+import os
+import threading
+import time
+
+from cachetools import LRUCache
+from pymemcache.client.base import PooledClient
+from pymemcache.exceptions import MemcacheError
+import redis
+
+logger = logging.getLogger(__name__)
+
+LRU_SIZE = 100000
+LRU_SHARDS = 16
+# HashedSeenIds remembers ids for between WINDOW * (GENERATIONS - 1) /
+# GENERATIONS and WINDOW, as long as fewer than about .75 * GENERATION_SLOTS
+# arrive per generation. Memory is fixed at GENERATIONS * GENERATION_SLOTS * 8
+# bytes, 4MB by default.
+HASHED_WINDOW = timedelta(hours=1)
+HASHED_GENERATIONS = 4
+HASHED_GENERATION_SLOTS = 1 << 17
+HASHED_MAX_LOAD = .75
+# how long shared backends remember ids
+TTL = timedelta(days=1)
+
+
+class LruSeenIds:
+    """Thread-safe in-process set of activity ids.
+
+    Sharded by id, with a separate lock and LRU cache per shard, so that
+    concurrent inbox requests rarely wait on each other.
+    """
+    def __init__(self, size=LRU_SIZE, shards=LRU_SHARDS):
+        self.shards = [(LRUCache(size // shards), threading.Lock())
+                       for _ in range(shards)]
+
+    def _shard(self, id):
+        return self.shards[hash(id) % len(self.shards)]
+
+    def add(self, id):
+        """Adds an id.
+
+        Returns: boolean, True if the id was new, False if we'd already seen it
+        """
+        cache, lock = self._shard(id)
+        with lock:
+            if id in cache:
+                return False
+            cache[id] = True
+            return True
+
+    def __contains__(self, id):
+        cache, lock = self._shard(id)
+        with lock:
+            return id in cache
+
+    def discard(self, id):
+        """Removes an id, if it's there."""
+        cache, lock = self._shard(id)
+        with lock:
+            cache.pop(id, None)
+
+    def clear(self):
+        for cache, lock in self.shards:
+            with lock:
+                cache.clear()
+
+
+class HashedSeenIds:
+    """Compact, time windowed, in-process set of activity ids.
+
+    Stores 64-bit hashes of ids, not the ids themselves, in a fixed number of
+    generations. Each generation is an array backed, open addressing hash
+    table with linear probing, so memory use is fixed and predictable. The
+    current generation takes new ids; when its time slice is over, or it gets
+    too full, the oldest generation is wiped and becomes the new current one.
+    So ids age out by time, not by count, unless traffic is unusually heavy.
+
+    False positives require a 64-bit hash collision, which is unlikely enough
+    to ignore at our volume. Callers that need certainty can still fall back to
+    the datastore on positives.
+    """
+    def __init__(self, window=HASHED_WINDOW, generations=HASHED_GENERATIONS,
+                 slots=HASHED_GENERATION_SLOTS, clock=time.monotonic):
+        """
+        Args:
+          window: :class:`datetime.timedelta`, how long to remember ids
+          generations: int
+          slots: int, hash table size per generation. Must be a power of 2.
+          clock: callable that returns the current time in seconds
+        """
+        assert slots & (slots - 1) == 0, slots
+        self.slot_time = window.total_seconds() / generations
+        self.generations = generations
+        self.num_slots = slots
+        self.max_fill = int(slots * HASHED_MAX_LOAD)
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # newest generation is last
+            self.tables = [self._new_table() for _ in range(self.generations)]
+            self.fill = 0
+            self.started = self.clock()
+
+    def _new_table(self):
+        return array('Q', bytes(8 * self.num_slots))
+
+    @staticmethod
+    def _hash(id):
+        # 0 marks empty slots
+        return int.from_bytes(blake2b(id.encode(), digest_size=8).digest(),
+                              'little') or 1
+
+    def _rotate(self):
+        """Starts a new generation if the current one is over. Call with lock held."""
+        elapsed = int((self.clock() - self.started) // self.slot_time)
+        for _ in range(min(elapsed, len(self.tables))):
+            self._new_generation()
+        if elapsed:
+            self.started += elapsed * self.slot_time
+
+        if self.fill >= self.max_fill:
+            logger.info('Current generation is full, starting a new one early')
+            self._new_generation()
+            self.started = self.clock()
+
+    def _new_generation(self):
+        self.tables.pop(0)
+        self.tables.append(self._new_table())
+        self.fill = 0
+
+    def _find(self, table, hash):
+        """Returns the slot index for hash, either a match or an empty slot."""
+        mask = self.num_slots - 1
+        i = hash & mask
+        while True:
+            val = table[i]
+            if val == hash or val == 0:
+                return i
+            i = (i + 1) & mask
+
+    def add(self, id):
+        """Adds an id.
+
+        Returns: boolean, True if the id was new, False if we'd already seen it
+        """
+        hash = self._hash(id)
+        with self.lock:
+            self._rotate()
+            for table in self.tables:
+                if table[self._find(table, hash)] == hash:
+                    return False
+
+            current = self.tables[-1]
+            current[self._find(current, hash)] = hash
+            self.fill += 1
+            return True
+
+    def __contains__(self, id):
+        hash = self._hash(id)
+        with self.lock:
+            self._rotate()
+            return any(table[self._find(table, hash)] == hash
+                       for table in self.tables)
+
+    def discard(self, id):
+        """Removes an id, if it's there.
+
+        Shifts later entries in the same probe sequence back into the freed
+        slot, so that lookups for them still find them.
+        """
+        hash = self._hash(id)
+        mask = self.num_slots - 1
+        with self.lock:
+            for table in self.tables:
+                i = self._find(table, hash)
+                if table[i] != hash:
+                    continue
+
+                j = i
+                while table[j := (j + 1) & mask]:
+                    home = table[j] & mask
+                    # can table[j] move back to i, ie is its home outside (i, j]?
+                    if not (i < home <= j if i <= j else home > i or home <= j):
+                        table[i] = table[j]
+                        i = j
+                table[i] = 0
+                if table is self.tables[-1]:
+                    self.fill -= 1
+
+
+def _key(id):
+    """Returns a short, fixed length key for an activity id."""
+    return 'seen-' + sha256(id.encode()).hexdigest()
+
+
+class MemcacheSeenIds:
+    """Activity ids stored in memcache, shared across instances.
+
+    If memcache is unavailable, :meth:`add` treats every id as new, so callers
+    fall back to their own durable check.
+    """
+    def __init__(self, client, ttl=TTL):
+        """
+        Args:
+          client: :class:`pymemcache.client.base.Client` or compatible
+          ttl: :class:`datetime.timedelta`, how long to remember ids
+        """
+        self.client = client
+        self.ttl = int(ttl.total_seconds())
+
+    def add(self, id):
+        # add is atomic: it only stores if the key doesn't exist yet
+        try:
+            return self.client.add(_key(id), b'1', expire=self.ttl, noreply=False)
+        except (MemcacheError, OSError) as e:
+            logger.warning(f"Couldn't check memcache for {id}: {e}")
+            return True
+
+    def __contains__(self, id):
+        try:
+            return self.client.get(_key(id)) is not None
+        except (MemcacheError, OSError) as e:
+            logger.warning(f"Couldn't check memcache for {id}: {e}")
+            return False
+
+    def discard(self, id):
+        try:
+            self.client.delete(_key(id), noreply=False)
+        except (MemcacheError, OSError) as e:
+            logger.warning(f"Couldn't remove {id} from memcache: {e}")
+
+
+class RedisSeenIds:
+    """Activity ids stored in Redis, shared across instances.
+
+    If Redis is unavailable, :meth:`add` treats every id as new, so callers
+    fall back to their own durable check.
+    """
+    def __init__(self, client, ttl=TTL):
+        """
+        Args:
+          client: :class:`redis.Redis`
+          ttl: :class:`datetime.timedelta`, how long to remember ids
+        """
+        self.client = client
+        self.ttl = int(ttl.total_seconds())
+
+    def add(self, id):
+        # SET NX is atomic: it only stores if the key doesn't exist yet
+        try:
+            return bool(self.client.set(_key(id), 1, nx=True, ex=self.ttl))
+        except redis.RedisError as e:
+            logger.warning(f"Couldn't check Redis for {id}: {e}")
+            return True
+
+    def __contains__(self, id):
+        try:
+            return bool(self.client.exists(_key(id)))
+        except redis.RedisError as e:
+            logger.warning(f"Couldn't check Redis for {id}: {e}")
+            return False
+
+    def discard(self, id):
+        try:
+            self.client.delete(_key(id))
+        except redis.RedisError as e:
+            logger.warning(f"Couldn't remove {id} from Redis: {e}")
+
+
+class FakeSeenIds:
+    """In-memory stand-in for the shared backends, for tests.
+
+    Multiple instances can share the same ``store`` dict to simulate multiple
+    App Engine instances talking to the same memcache or Redis.
+    """
+    def __init__(self, store=None, ttl=TTL):
+        """
+        Args:
+          store: dict, maps key to expiration timestamp
+          ttl: :class:`datetime.timedelta`, how long to remember ids
+        """
+        self.store = store if store is not None else {}
+        self.ttl = ttl.total_seconds()
+        self.lock = threading.Lock()
+
+    def add(self, id):
+        key = _key(id)
+        now = time.time()
+        with self.lock:
+            if self.store.get(key, 0) > now:
+                return False
+            self.store[key] = now + self.ttl
+            return True
+
+    def __contains__(self, id):
+        with self.lock:
+            return self.store.get(_key(id), 0) > time.time()
+
+    def discard(self, id):
+        with self.lock:
+            self.store.pop(_key(id), None)
+
+    def clear(self):
+        with self.lock:
+            self.store.clear()
+
+
+def from_env():
+    """Returns the backend configured by environment variables."""
+    name = os.getenv('DEDUPE_BACKEND', 'hashed')
+    logger.info(f'Using {name} backend for inbox dedupe')
+
+    if name == 'hashed':
+        return HashedSeenIds()
+    elif name == 'lru':
+        return LruSeenIds()
+    elif name == 'memcache':
+        return MemcacheSeenIds(PooledClient(os.environ['MEMCACHE_HOST'],
+                                            timeout=1, connect_timeout=1))
+    elif name == 'redis':
+        return RedisSeenIds(redis.Redis.from_url(os.environ['REDIS_URL'],
+                                                 socket_timeout=1))
+
+    raise ValueError(f'Unknown DEDUPE_BACKEND {name}')
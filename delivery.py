@@ -0,0 +1,155 @@
+"""Concurrent outbound delivery, eg of ActivityPub activities to inboxes.
+
+Sends run in a bounded thread pool, with a global concurrency limit and a
+smaller per-host limit so that we don't hammer any single instance.
+:class:`Checkpoint` batches the datastore writes that record progress.
+"""
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import itertools
+import logging
+import threading
+import time
+
+from flask import copy_current_request_context, has_request_context
+from oauth_dropins.webutil import util
+
+import host_health
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = 20
+MAX_PER_HOST = 2
+
+# save delivery progress after this many targets or this much time,
+# whichever comes first
+CHECKPOINT_EVERY = 50
+CHECKPOINT_INTERVAL = timedelta(seconds=10)
+
+Result = namedtuple('Result', ('url', 'response', 'exception', 'latency'))
+"""Outcome of one send.
+
+Fields:
+  url: str
+  response: :class:`requests.Response`, or None if the send raised
+  exception: the exception the send raised, or None
+  latency: float, seconds
+"""
+
+
+def deliver(urls, send, max_workers=MAX_WORKERS, max_per_host=MAX_PER_HOST):
+    """Calls ``send`` on each URL concurrently, with global and per-host limits.
+
+    Logs each URL's latency and the total wall time.
+
+    Args:
+      urls: sequence of str
+      send: callable that takes a URL and returns a :class:`requests.Response`
+        or raises an exception. Runs in a worker thread, with a copy of the
+        current Flask request context if there is one, but no ndb context, so
+        it shouldn't touch the datastore.
+      max_workers: int, global concurrency limit
+      max_per_host: int, per-host concurrency limit
+
+    Yields: :class:`Result` for each URL, in the same order as ``urls``. If the
+      caller stops early, sends that haven't started yet are cancelled, and
+      their hosts' half open circuit trials are released.
+    """
+    urls = list(urls)
+    if not urls:
+        return
+
+    hosts = [util.domain_from_link(url, minimize=False) for url in urls]
+    host_limits = {host: threading.BoundedSemaphore(max_per_host)
+                   for host in set(hosts)}
+
+    def run(i):
+        with host_limits[hosts[i]]:
+            start = time.perf_counter()
+            try:
+                return send(urls[i]), None, time.perf_counter() - start
+            except BaseException as e:
+                return None, e, time.perf_counter() - start
+
+    # submit round robin across hosts so that workers don't all end up blocked
+    # on the same host's limit
+    by_host = defaultdict(list)
+    for i, host in enumerate(hosts):
+        by_host[host].append(i)
+    order = [i for batch in itertools.zip_longest(*by_host.values())
+             for i in batch if i is not None]
+
+    start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(urls)),
+                                  thread_name_prefix='deliver')
+    futures = {}
+    try:
+        for i in order:
+            fn = copy_current_request_context(run) if has_request_context() else run
+            futures[i] = executor.submit(fn, i)
+
+        for i, url in enumerate(urls):
+            resp, exc, latency = futures[i].result()
+            logger.info(f'{url} {"failed" if exc else "succeeded"} in {latency:.3f}s')
+            yield Result(url, resp, exc, latency)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        for i, future in futures.items():
+            if future.cancelled():
+                host_health.hosts.release(urls[i])
+        logger.info(f'Delivered to {len(urls)} URLs in {time.perf_counter() - start:.3f}s')
+
+
+class Checkpoint:
+    """Saves delivery progress every so often instead of after every target.
+
+    Use as a context manager and call :meth:`changed` after recording each
+    target's outcome. Saves after :data:`CHECKPOINT_EVERY` changes or
+    :data:`CHECKPOINT_INTERVAL`, whichever comes first, and once more on exit,
+    including if the block raises.
+
+    If we die without exiting, eg the instance is killed, we lose at most one
+    checkpoint's worth of progress. Those targets are still undelivered, so
+    resuming sends to them again.
+
+    Attributes:
+      saves: int, number of times we've called ``save``
+    """
+    def __init__(self, save, every=CHECKPOINT_EVERY,
+                 interval=CHECKPOINT_INTERVAL, clock=time.monotonic):
+        """
+        Args:
+          save: callable that takes no args, eg :meth:`ndb.Model.put`
+          every: int, max changes between saves
+          interval: :class:`datetime.timedelta`, max time between saves
+          clock: callable that returns the current time in seconds
+        """
+        self.save = save
+        self.every = every
+        self.interval = interval.total_seconds()
+        self.clock = clock
+        self.pending = 0
+        self.saves = 0
+        self.last_save = clock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def changed(self):
+        """Records a change and saves if it's time to."""
+        self.pending += 1
+        if (self.pending >= self.every
+                or self.clock() - self.last_save >= self.interval):
+            self.flush()
+
+    def flush(self):
+        """Saves if there are any changes since the last save."""
+        if self.pending:
+            self.save()
+            self.saves += 1
+            self.pending = 0
+            self.last_save = self.clock()
@@ -0,0 +1,120 @@
+"""Cache for webmention endpoint discovery.
+
+Discovery is a full HTTP fetch and HTML parse of the target, and likes and
+reposts of popular posts send webmentions to the same targets over and over.
+So we cache each target URL's endpoint in the datastore, as
+:class:`models.WebmentionEndpoint`, for :data:`TTL`, or the lack of one for
+:data:`NO_ENDPOINT_TTL`, since sites that add webmention support should start
+getting them soon.
+
+We also cache each domain's most recent endpoint and use it for URLs on that
+domain that we haven't discovered yet, since sites almost always use the same
+endpoint for every page. If sending to a cached endpoint fails, callers
+should :func:`delete` it so that the next attempt discovers it again.
+
+:func:`get` and :func:`put` batch the datastore reads and writes so that
+callers can do them in the main thread and discover and send elsewhere.
+"""
+from datetime import timedelta
+import logging
+
+from google.cloud import ndb
+from oauth_dropins.webutil import util, webmention
+
+import http_client
+import metrics
+from models import WebmentionEndpoint
+
+logger = logging.getLogger(__name__)
+
+TTL = timedelta(days=1)
+NO_ENDPOINT_TTL = timedelta(hours=1)
+
+
+def _domain(url):
+    return util.domain_from_link(url, minimize=False)
+
+
+def _fresh(entry, now):
+    ttl = TTL if entry.endpoint else NO_ENDPOINT_TTL
+    return entry.fetched and entry.fetched + ttl > now
+
+
+def get(urls):
+    """Returns cached webmention endpoints for URLs.
+
+    Args:
+      urls: sequence of str
+
+    Returns: dict, str URL => str endpoint, or None if it doesn't have one.
+      URLs that don't have a fresh cached endpoint, either their own or their
+      domain's, aren't included.
+    """
+    urls = list(urls)
+    ids = list(set(urls) | set(filter(None, (_domain(url) for url in urls))))
+    cached = {entry.key.id(): entry for entry in
+              ndb.get_multi(ndb.Key(WebmentionEndpoint, id) for id in ids)
+              if entry}
+
+    now = util.now()
+    endpoints = {}
+    for url in urls:
+        for id, source in (url, 'url'), (_domain(url), 'domain'):
+            entry = cached.get(id)
+            if entry and _fresh(entry, now):
+                endpoints[url] = entry.endpoint
+                metrics.incr(f'webmention.discover.cached.{source}')
+                break
+        else:
+            metrics.incr('webmention.discover.miss')
+
+    return endpoints
+
+
+def put(endpoints):
+    """Caches discovered webmention endpoints.
+
+    Args:
+      endpoints: dict, str URL => str endpoint, or None if it doesn't have one
+    """
+    now = util.now()
+    entries = {}
+    for url, endpoint in endpoints.items():
+        entries[url] = WebmentionEndpoint(id=url, endpoint=endpoint, fetched=now)
+        domain = _domain(url)
+        if endpoint and domain:
+            entries[domain] = WebmentionEndpoint(id=domain, endpoint=endpoint,
+                                                 fetched=now)
+
+    ndb.put_multi(entries.values())
+
+
+def delete(urls):
+    """Forgets the cached webmention endpoints for URLs and their domains.
+
+    Args:
+      urls: sequence of str
+    """
+    ids = set()
+    for url in urls:
+        ids.update(filter(None, (url, _domain(url))))
+    ndb.delete_multi(ndb.Key(WebmentionEndpoint, id) for id in ids)
+
+
+def discover(url):
+    """Returns a URL's webmention endpoint, from the cache if possible.
+
+    Args:
+      url: str
+
+    Returns: str endpoint, or None if it doesn't have one
+
+    Raises: whatever :func:`oauth_dropins.webutil.webmention.discover` raises
+    """
+    cached = get([url])
+    if url in cached:
+        return cached[url]
+
+    endpoint = webmention.discover(url, session=http_client.session).endpoint
+    put({url: endpoint})
+    return endpoint
@@ -0,0 +1,176 @@
+"""Circuit breakers for hosts we send to, eg fediverse instances.
+
+:func:`common.signed_request` and :func:`common.send_webmentions` record each
+request's outcome here. After :data:`FAILURE_THRESHOLD` consecutive failures,
+ie connection errors, timeouts, or 5xx responses, a host's circuit opens, and
+we skip it for :data:`OPEN_TIME`. After that, it's half open: we let one
+request through. If that succeeds, the circuit closes again; if it fails, it
+reopens for twice as long as last time, up to :data:`MAX_OPEN_TIME`. If the
+trial request is cancelled before it's sent, :func:`delivery.deliver`
+releases it so that a later request can be the trial.
+
+State is in memory, per instance.
+"""
+from datetime import timedelta
+import logging
+import threading
+
+from cachetools import LRUCache
+from oauth_dropins.webutil import util
+
+import http_client
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+FAILURE_THRESHOLD = 5
+OPEN_TIME = timedelta(minutes=5)
+MAX_OPEN_TIME = timedelta(days=1)
+MAX_HOSTS = 20000
+
+
+class Host:
+    """One host's health.
+
+    Attributes:
+      state: str, :data:`CLOSED`, :data:`OPEN`, or :data:`HALF_OPEN`
+      failures: int, consecutive failures
+      last_success: :class:`datetime.datetime`
+      last_failure: :class:`datetime.datetime`
+      open_until: :class:`datetime.datetime`, when an open circuit goes half open
+      open_time: :class:`datetime.timedelta`, how long the circuit was last open
+      trial: boolean, whether a half open circuit's trial request is in flight
+    """
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.last_success = self.last_failure = self.open_until = None
+        self.open_time = None
+        self.trial = False
+
+
+class HostHealth:
+    """Thread-safe registry of :class:`Host`s by domain."""
+    def __init__(self, size=MAX_HOSTS):
+        self.hosts = LRUCache(size)
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.hosts.clear()
+
+    def get(self, host):
+        """Returns: :class:`Host`, or None if we haven't seen this host"""
+        with self.lock:
+            return self.hosts.get(host)
+
+    def allow(self, url):
+        """Returns True if we should send a request to this URL's host now.
+
+        If the host's circuit is half open, allows one trial request and
+        returns False for the rest until it's recorded.
+        """
+        host = util.domain_from_link(url, minimize=False)
+        with self.lock:
+            h = self.hosts.get(host)
+            if not h or h.state == CLOSED:
+                return True
+
+            if h.state == OPEN:
+                if util.now() < h.open_until:
+                    return False
+                logger.info(f'Circuit for {host} is now half open')
+                h.state = HALF_OPEN
+
+            if h.trial:
+                return False
+            h.trial = True
+            return True
+
+    def release(self, url):
+        """Releases a half open circuit's trial without recording an outcome.
+
+        For requests that were allowed but never sent, eg cancelled, so that a
+        later request can be the trial instead.
+        """
+        host = util.domain_from_link(url, minimize=False)
+        with self.lock:
+            h = self.hosts.get(host)
+            if h and h.state == HALF_OPEN:
+                h.trial = False
+
+    def partition(self, urls):
+        """Splits URLs into ones we should send to now and ones to defer.
+
+        Args:
+          urls: sequence of str
+
+        Returns: (list of str allowed URLs, list of str deferred URLs)
+        """
+        allowed = []
+        deferred = []
+        for url in urls:
+            (allowed if self.allow(url) else deferred).append(url)
+
+        if deferred:
+            logger.info(f'Deferring {len(deferred)} URLs with open circuits: {deferred}')
+            metrics.incr('delivery.deferred', len(deferred))
+        return allowed, deferred
+
+    def record(self, url, ok):
+        """Records the outcome of a request.
+
+        Args:
+          url: str
+          ok: boolean, False if we couldn't connect, timed out, or got a 5xx
+        """
+        host = util.domain_from_link(url, minimize=False)
+        now = util.now()
+        with self.lock:
+            h = self.hosts.get(host)
+            if not h:
+                h = self.hosts[host] = Host()
+            h.trial = False
+
+            if ok:
+                if h.state != CLOSED:
+                    logger.info(f'Closing circuit for {host}')
+                h.state = CLOSED
+                h.failures = 0
+                h.open_time = None
+                h.last_success = now
+                return
+
+            h.failures += 1
+            h.last_failure = now
+            if h.state == HALF_OPEN:
+                h.open_time = min(h.open_time * 2, MAX_OPEN_TIME)
+            elif h.state == CLOSED and h.failures >= FAILURE_THRESHOLD:
+                h.open_time = OPEN_TIME
+            else:
+                # still closed, or already open and this request was in flight
+                return
+
+            logger.info(f'Opening circuit for {host} for {h.open_time}')
+            metrics.incr('delivery.circuit_opened')
+            h.state = OPEN
+            h.open_until = now + h.open_time
+
+    def record_exception(self, url, exception):
+        """Records a request that raised an exception.
+
+        4xx responses count as successes, since the host is up.
+
+        Args:
+          url: str
+          exception: :class:`BaseException`
+        """
+        code = http_client.status_code(exception)
+        self.record(url, code is not None and code < 500)
+
+
+hosts = HostHealth()
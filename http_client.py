@@ -0,0 +1,119 @@
+"""Shared HTTP connection pools, so that we reuse connections to each host.
+
+Outbound requests that go through here share one :class:`requests.Session`
+with a connection pool per host and keep-alive, so that many deliveries and
+fetches to the same instance don't each pay for a new TCP connection and TLS
+handshake. Configure with environment variables, eg in app.yaml:
+
+* ``HTTP_POOL``: ``true`` or ``false``. Defaults to ``true`` in production,
+  ``false`` in dev and tests, where we mock out ``requests.get`` etc.
+* ``HTTP_POOL_HOSTS``: number of hosts to keep pools for
+* ``HTTP_POOL_SIZE``: max connections to keep open per host
+* ``HTTP_TIMEOUT``: seconds
+
+requests and urllib3 don't support HTTP/2, so there's no multiplexing; each
+concurrent request to a host uses its own connection.
+"""
+import logging
+import os
+
+from oauth_dropins.webutil import util
+from oauth_dropins.webutil.appengine_info import DEBUG
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+POOLED = os.getenv('HTTP_POOL', 'false' if DEBUG else 'true').lower() == 'true'
+POOL_HOSTS = int(os.getenv('HTTP_POOL_HOSTS', 500))
+POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+TIMEOUT = float(os.getenv('HTTP_TIMEOUT', util.HTTP_TIMEOUT))
+
+
+def new_session(pool_hosts=POOL_HOSTS, pool_size=POOL_SIZE):
+    """Returns a :class:`requests.Session` with per-host connection pools.
+
+    Args:
+      pool_hosts: int, number of hosts to keep pools for
+      pool_size: int, max connections to keep open per host
+    """
+    session = requests.Session()
+    # don't block when a pool is full, just open another connection and don't
+    # keep it afterward
+    adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size,
+                          pool_block=False)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# None if pooling is disabled
+session = new_session() if POOLED else None
+
+
+def get(url, **kwargs):
+    """Like :func:`util.requests_get`, but uses the shared pools."""
+    kwargs.setdefault('timeout', TIMEOUT)
+    return util.requests_get(url, session=session, **kwargs)
+
+
+def post(url, **kwargs):
+    """Like :func:`util.requests_post`, but uses the shared pools."""
+    kwargs.setdefault('timeout', TIMEOUT)
+    return util.requests_post(url, session=session, **kwargs)
+
+
+def stats(sess=None):
+    """Returns connection reuse stats for the hosts currently in the pools.
+
+    Args:
+      sess: :class:`requests.Session`, defaults to the shared session
+
+    Returns: dict with int ``http.requests``, int ``http.connections``, and
+      float ``http.connection_reuse``, the fraction of requests that reused an
+      existing connection. Empty if pooling is disabled.
+    """
+    sess = sess or session
+    if not sess:
+        return {}
+
+    num_requests = num_connections = 0
+    for adapter in set(sess.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool:
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+
+    return {
+        'http.requests': num_requests,
+        'http.connections': num_connections,
+        'http.connection_reuse': ((num_requests - num_connections) / num_requests
+                                  if num_requests else 0),
+    }
+
+
+def status_code(exception):
+    """Returns the HTTP status code behind a failed request, or None.
+
+    With ``gateway=True``, :func:`util.requests_fn` converts
+    :class:`requests.HTTPError`s into 502s, so we look at the original
+    exception first.
+
+    Args:
+      exception: :class:`BaseException`
+
+    Returns: int, or None if there was no HTTP response, eg the connection
+      failed or timed out
+    """
+    cause = exception.__context__
+    if isinstance(cause, requests.RequestException):
+        exception = cause
+
+    if isinstance(exception, requests.RequestException):
+        resp = exception.response
+        return resp.status_code if resp is not None else None
+
+    code, _ = util.interpret_http_exception(exception)
+    return int(code) if str(code).isdigit() else None
@@ -0,0 +1,38 @@
+"""In-process counters for things we want to watch but not store.
+
+Counts are per instance and reset when the instance restarts. They're exposed
+as JSON at ``/metrics``, to App Engine cron only.
+"""
+import collections
+import threading
+
+_counts = collections.Counter()
+_lock = threading.Lock()
+
+
+def incr(name, amount=1):
+    """Increments a counter.
+
+    Args:
+      name: str, dot-separated counter name, eg ``inbox.dropped.foo``
+      amount: int
+    """
+    with _lock:
+        _counts[name] += amount
+
+
+def get(name):
+    """Returns a counter's current value, 0 if it's never been incremented."""
+    with _lock:
+        return _counts[name]
+
+
+def snapshot():
+    """Returns a dict snapshot of all counters."""
+    with _lock:
+        return dict(_counts)
+
+
+def clear():
+    with _lock:
+        _counts.clear()
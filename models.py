@@ -1,8 +1,11 @@
 """Datastore model classes."""
 import base64
+from datetime import timezone
 import difflib
 import logging
+import os
 import urllib.parse
+import zlib
 
 import requests
 from werkzeug.exceptions import BadRequest, NotFound
@@ -14,11 +17,12 @@ from flask import request
 from google.cloud import ndb
 from granary import as1, as2, bluesky, microformats2
 from oauth_dropins.webutil.appengine_info import DEBUG
-from oauth_dropins.webutil.models import ComputedJsonProperty, JsonProperty, StringIdModel
+from oauth_dropins.webutil.models import ComputedJsonProperty, StringIdModel
 from oauth_dropins.webutil import util
 from oauth_dropins.webutil.util import json_dumps, json_loads
 
 import common
+from conversions import convert
 
 # https://github.com/snarfed/bridgy-fed/issues/314
 WWW_DOMAINS = frozenset((
@@ -28,9 +32,58 @@ PROTOCOLS = ('activitypub', 'bluesky', 'ostatus', 'webmention', 'ui')
 # 2048 bits makes tests slow, so use 1024 for them
 KEY_BITS = 1024 if DEBUG else 2048
 
+# whether queries can filter out tombstones with deleted == False. Objects
+# stored before deleted had a default have it None, which that doesn't match, so
+# only turn this on once scripts/backfill_object_deleted.py has run. Set via
+# environment variable, eg in app.yaml.
+DELETED_INDEXED = bool(os.getenv('DELETED_INDEXED'))
+
+# every zlib stream with the default window size starts with this. JSON never does.
+ZLIB_HEADER = b'\x78'
+
 logger = logging.getLogger(__name__)
 
 
+class CompressedJsonProperty(ndb.BlobProperty):
+    """JSON property stored zlib-compressed, as a blob.
+
+    Activities that embed full actors and reply collections can be big, and
+    their JSON compresses well, so this cuts both storage and the bandwidth
+    of every datastore read. Like all ndb properties, values are decompressed
+    and parsed lazily, on first access.
+
+    Also reads values stored as uncompressed JSON text by
+    :class:`oauth_dropins.webutil.models.JsonProperty`, so it can replace one
+    without migrating existing entities first. They're rewritten compressed
+    the next time they're stored, or by ``scripts/migrate_compressed_json.py``.
+    """
+    def _validate(self, value):
+        if not isinstance(value, dict):
+            raise TypeError('JSON property must be a dict')
+
+    def _to_base_type(self, value):
+        return zlib.compress(json_dumps(value).encode())
+
+    def _from_base_type(self, value):
+        if isinstance(value, bytes) and value.startswith(ZLIB_HEADER):
+            value = zlib.decompress(value)
+        return json_loads(value)
+
+    @staticmethod
+    def is_compressed(entity, name):
+        """Returns False if a property is stored as uncompressed JSON text.
+
+        Only works on entities loaded from the datastore whose property
+        hasn't been accessed or set yet; returns True otherwise.
+
+        Args:
+          entity: :class:`ndb.Model`
+          name: str, property name
+        """
+        return not isinstance(getattr(entity._values.get(name), 'b_val', None),
+                              str)
+
+
 def base64_to_long(x):
     """Converts x from URL safe base64 encoding to a long integer.
 
@@ -64,7 +117,7 @@ class User(StringIdModel):
     has_redirects = ndb.BooleanProperty()
     redirects_error = ndb.TextProperty()
     has_hcard = ndb.BooleanProperty()
-    actor_as2 = JsonProperty()
+    actor_as2 = CompressedJsonProperty()
     use_instead = ndb.KeyProperty()
 
     created = ndb.DateTimeProperty(auto_now_add=True)
@@ -130,7 +183,7 @@ class User(StringIdModel):
     def to_as1(self):
         """Returns this user as an AS1 actor dict, if possible."""
         if self.actor_as2:
-            return as2.to_as1(self.actor_as2)
+            return convert(as2.to_as1, self.actor_as2)
 
     def username(self):
         """Returns the user's preferred username.
@@ -244,8 +297,24 @@ class User(StringIdModel):
         return self
 
 
+class SourceJsonProperty(CompressedJsonProperty):
+    """CompressedJsonProperty for one of :class:`Object`'s source formats, eg as2.
+
+    Setting or deleting it clears the :class:`Object`'s memoized as1.
+    """
+    def _set_value(self, entity, value):
+        entity.__dict__.pop('_as1_memo', None)
+        super()._set_value(entity, value)
+
+    def _delete_value(self, entity):
+        entity.__dict__.pop('_as1_memo', None)
+        super()._delete_value(entity)
+
+
 class Target(ndb.Model):
-    """Delivery destinations. ActivityPub inboxes, webmention targets, etc.
+    """Legacy delivery destinations. ActivityPub inboxes, webmention targets, etc.
+
+    Replaced by :class:`Delivery`.
 
     Used in StructuredPropertys inside Object; not stored directly in the
     datastore.
@@ -278,14 +347,24 @@ class Object(StringIdModel):
     source_protocol = ndb.StringProperty(choices=PROTOCOLS)
     labels = ndb.StringProperty(repeated=True, choices=LABELS)
 
-    # TODO: switch back to ndb.JsonProperty if/when they fix it for the web console
-    # https://github.com/googleapis/python-ndb/issues/874
-    as2 = JsonProperty()  # only one of the rest will be populated...
-    bsky = JsonProperty() # Bluesky / AT Protocol
-    mf2 = JsonProperty()  # HTML microformats2
+    as2 = SourceJsonProperty()  # only one of the rest will be populated...
+    bsky = SourceJsonProperty() # Bluesky / AT Protocol
+    mf2 = SourceJsonProperty()  # HTML microformats2
 
     @ComputedJsonProperty
     def as1(self):
+        """Converted from as2, bsky, or mf2.
+
+        Memoized per instance, since it's used a lot, eg by type, object_ids,
+        and page rendering. Setting as2, bsky, or mf2 clears it. The returned
+        dict is shared, so callers shouldn't modify it; modifying as2 et al in
+        place doesn't clear it either.
+        """
+        if '_as1_memo' not in self.__dict__:
+            self._as1_memo = self._convert_as1()
+        return self._as1_memo
+
+    def _convert_as1(self):
         # TODO: switch back to assert
         # assert (self.as2 is not None) ^ (self.bsky is not None) ^ (self.mf2 is not None), \
         #     f'{self.as2} {self.bsky} {self.mf2}'
@@ -293,11 +372,11 @@ class Object(StringIdModel):
             logging.warning(f'{self.key} has multiple! {self.as2 is not None} {self.bsky is not None} {self.mf2 is not None}')
 
         if self.as2 is not None:
-            return as2.to_as1(common.redirect_unwrap(self.as2))
+            return convert(as2.to_as1, common.redirect_unwrap(self.as2))
         elif self.bsky is not None:
-            return bluesky.to_as1(self.bsky)
+            return convert(bluesky.to_as1, self.bsky)
         elif self.mf2 is not None:
-            return microformats2.json_to_object(self.mf2)
+            return convert(microformats2.json_to_object, self.mf2)
 
     @ndb.ComputedProperty
     def type(self):  # AS1 objectType, or verb if it's an activity
@@ -309,8 +388,26 @@ class Object(StringIdModel):
             return as1.get_ids(self.as1, 'object')
     object_ids = ndb.ComputedProperty(_object_ids, repeated=True)
 
-    deleted = ndb.BooleanProperty()
-
+    # default False so that queries can filter out tombstones in the index
+    deleted = ndb.BooleanProperty(default=False)
+    # when common.get_object last fetched as2
+    fetched = ndb.DateTimeProperty(tzinfo=timezone.utc)
+    # outbound AS2 activity as we last sent it, with its reply target, mentions,
+    # and Update wrapping, so that retries.sweep can redeliver it as is
+    sent_as2 = CompressedJsonProperty()
+
+    # number of targets in each Delivery status. per-target state is in
+    # Delivery entities. single deliveries and retries update these as they
+    # change Deliveries; chunked fan-outs recount them afterward, in
+    # webmention.finalize_deliveries.
+    delivered_count = ndb.IntegerProperty(default=0, indexed=False)
+    undelivered_count = ndb.IntegerProperty(default=0, indexed=False)
+    failed_count = ndb.IntegerProperty(default=0, indexed=False)
+
+    # Legacy, replaced by Delivery. Nothing reads or writes these except
+    # scripts/migrate_delivery_state.py, which moves them into Delivery
+    # entities. They're only declared so that it can load them, and so that
+    # re-storing an unmigrated Object doesn't drop them.
     delivered = ndb.StructuredProperty(Target, repeated=True)
     undelivered = ndb.StructuredProperty(Target, repeated=True)
     failed = ndb.StructuredProperty(Target, repeated=True)
@@ -325,6 +422,56 @@ class Object(StringIdModel):
         if self.type != 'activity' and '#' not in self.key.id():
             key = common.get_object.cache_key(self.key.id())
             common.get_object.cache[key] = self
+            common.fetch_failures.discard(key)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        """Remove from :func:`common.get_object` cache."""
+        common.get_object.cache.pop(common.get_object.cache_key(key.id()), None)
+
+    @classmethod
+    def query_live(cls, *filters):
+        """Queries for Objects, excluding tombstones if :data:`DELETED_INDEXED`.
+
+        Until then, callers still need to skip Objects with deleted set.
+
+        Args:
+          filters: ndb filters, passed through to :meth:`query`
+
+        Returns: :class:`ndb.Query`
+        """
+        if DELETED_INDEXED:
+            filters += (cls.deleted == False,)
+        return cls.query(*filters)
+
+    def set_delivery(self, delivery, status):
+        """Sets a :class:`Delivery`'s status and updates our counts to match.
+
+        Doesn't store anything.
+
+        Args:
+          delivery: :class:`Delivery` for one of our targets
+          status: str, one of :attr:`Delivery.STATUSES`
+
+        Returns: boolean, True if the status changed
+        """
+        if delivery.status == status:
+            return False
+
+        for old_new, delta in (delivery.status, -1), (status, 1):
+            if old_new:
+                prop = f'{old_new}_count'
+                setattr(self, prop, getattr(self, prop) + delta)
+
+        delivery.status = status
+        return True
+
+    def delivery_status(self):
+        """Returns our overall status based on our :class:`Delivery` counts."""
+        return ('in progress' if self.undelivered_count
+                else 'complete' if self.delivered_count
+                else 'failed' if self.failed_count
+                else 'ignored')
 
     def proxy_url(self):
         """Returns the Bridgy Fed proxy URL to render this post as HTML."""
@@ -361,6 +508,100 @@ class Object(StringIdModel):
         </a>"""
 
 
+class Delivery(StringIdModel):
+    """Delivery state for one target of one :class:`Object`.
+
+    Key name is 'OBJECT_ID TARGET_URI'. The :class:`Object` only has aggregate
+    counts, so that big fan-outs don't make it huge.
+
+    Once delivery to a target fails with an error that's worth retrying, also
+    tracks retries; see :func:`common.schedule_retry`.
+    """
+    STATUSES = ('undelivered', 'delivered', 'failed')
+
+    obj_id = ndb.StringProperty()
+    target = ndb.StringProperty()
+    protocol = ndb.StringProperty(choices=PROTOCOLS)
+    status = ndb.StringProperty(choices=STATUSES)
+    attempts = ndb.IntegerProperty(default=0)
+    # None after the last attempt
+    next_attempt = ndb.DateTimeProperty(tzinfo=timezone.utc)
+    last_error = ndb.TextProperty()
+
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def _id(cls, obj_id, target):
+        assert obj_id
+        assert target
+        return f'{obj_id} {target}'
+
+    @classmethod
+    def load(cls, obj_id, targets, protocol='activitypub'):
+        """Loads the :class:`Delivery`\\s for some of an :class:`Object`'s targets.
+
+        Args:
+          obj_id: str, :class:`Object` id
+          targets: sequence of str target URIs
+          protocol: str, for new :class:`Delivery`\\s
+
+        Returns: dict, str target URI => :class:`Delivery`. Targets that
+          don't have one yet get a new, unstored one with status None.
+        """
+        targets = list(targets)
+        keys = [ndb.Key(cls, cls._id(obj_id, t)) for t in targets]
+        return {
+            target: delivery or cls(id=key.id(), obj_id=obj_id, target=target,
+                                    protocol=protocol)
+            for target, key, delivery in zip(targets, keys, ndb.get_multi(keys))
+        }
+
+    @classmethod
+    def targets(cls, obj_id, status):
+        """Returns the URIs of an :class:`Object`'s targets with a given status.
+
+        Uses a keys-only query, so it doesn't load the :class:`Delivery`\\s.
+
+        Args:
+          obj_id: str, :class:`Object` id
+          status: str, one of :attr:`STATUSES`
+
+        Returns: list of str
+        """
+        prefix = len(obj_id) + 1
+        return [key.id()[prefix:] for key in
+                cls.query(cls.obj_id == obj_id, cls.status == status)
+                   .iter(keys_only=True)]
+
+    @classmethod
+    def counts(cls, obj_id):
+        """Counts an :class:`Object`'s :class:`Delivery`\\s in each status.
+
+        Runs one count query per status, concurrently.
+
+        Args:
+          obj_id: str, :class:`Object` id
+
+        Returns: dict, str status => int
+        """
+        futures = {status: cls.query(cls.obj_id == obj_id,
+                                     cls.status == status).count_async()
+                   for status in cls.STATUSES}
+        return {status: future.get_result() for status, future in futures.items()}
+
+
+class WebmentionEndpoint(StringIdModel):
+    """Cached result of webmention endpoint discovery. See :mod:`discovery`.
+
+    Key name is either a target URL or a domain. A domain's entry is the most
+    recent endpoint we discovered for any URL on it.
+    """
+    # None if the target doesn't have an endpoint
+    endpoint = ndb.StringProperty(indexed=False)
+    fetched = ndb.DateTimeProperty(tzinfo=timezone.utc, indexed=False)
+
+
 class Follower(StringIdModel):
     """A follower of a Bridgy Fed user.
 
@@ -375,12 +616,33 @@ class Follower(StringIdModel):
     dest = ndb.StringProperty()
     # Most recent AP (AS2) JSON Follow activity. If inbound, must have a
     # composite actor object with an inbox, publicInbox, or sharedInbox.
-    last_follow = JsonProperty()
+    last_follow = CompressedJsonProperty()
     status = ndb.StringProperty(choices=STATUSES, default='active')
+    # Copied from last_follow's actor by _pre_put_hook so that we can query for
+    # inboxes to deliver to without loading and parsing last_follow.
+    inbox = ndb.StringProperty()
+    # sharedInbox if available, otherwise publicInbox, otherwise inbox
+    shared_inbox = ndb.StringProperty()
 
     created = ndb.DateTimeProperty(auto_now_add=True)
     updated = ndb.DateTimeProperty(auto_now=True)
 
+    def _pre_put_hook(self):
+        self.inbox, self.shared_inbox = self.inboxes_from_last_follow()
+
+    def inboxes_from_last_follow(self):
+        """Returns this follower's inbox and shared inbox from last_follow.
+
+        Returns: (str inbox, str shared inbox) tuple. Either may be None.
+        """
+        actor = (self.last_follow or {}).get('actor')
+        if not isinstance(actor, dict):
+            return None, None
+
+        return actor.get('inbox'), (actor.get('endpoints', {}).get('sharedInbox') or
+                                    actor.get('publicInbox') or
+                                    actor.get('inbox'))
+
     def _post_put_hook(self, future):
         logger.info(f'Wrote Follower {self.key.id()} {self.status}')
 
@@ -402,7 +664,7 @@ class Follower(StringIdModel):
 
     def to_as1(self):
         """Returns this follower as an AS1 actor dict, if possible."""
-        return as2.to_as1(self.to_as2())
+        return convert(as2.to_as1, self.to_as2())
 
     def to_as2(self):
         """Returns this follower as an AS2 actor dict, if possible."""
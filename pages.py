@@ -16,7 +16,10 @@ from oauth_dropins.webutil.util import json_dumps, json_loads
 
 from app import app, cache
 import common
+import http_client
+import metrics
 from common import DOMAIN_RE, PAGE_SIZE
+from conversions import convert
 from models import Follower, Object, User
 
 FOLLOWERS_UI_LIMIT = 999
@@ -82,7 +85,7 @@ def user(domain):
 
     assert not user.use_instead
 
-    query = Object.query(
+    query = Object.query_live(
         Object.domains == domain,
         Object.labels.IN(('notification', 'user')),
     )
@@ -138,7 +141,7 @@ def feed(domain):
     if not (user := User.get_by_id(domain)):
       return render_template('user_not_found.html', domain=domain), 404
 
-    objects, _, _ = Object.query(
+    objects, _, _ = Object.query_live(
         Object.domains == domain, Object.labels == 'feed') \
         .order(-Object.created) \
         .fetch_page(PAGE_SIZE)
@@ -151,7 +154,7 @@ def feed(domain):
     title = f'Bridgy Fed feed for {domain}'
 
     if format == 'html':
-        entries = [microformats2.object_to_html(a) for a in activities]
+        entries = [convert(microformats2.object_to_html, a) for a in activities]
         return render_template('feed.html', util=util, **locals())
     elif format == 'atom':
         body = atom.activities_to_atom(activities, actor=actor, title=title,
@@ -215,20 +218,23 @@ def fetch_objects(query, user):
                    or inner_obj.get('displayName')
                    or inner_obj.get('summary'))
         url = util.get_first(inner_obj, 'url') or inner_obj.get('id')
+        # obj.as1 is memoized and shared, so don't modify it
+        obj_as1 = obj.as1
         if (obj.domains and
               inner_obj.get('id', '').strip('/') == f'https://{obj.domains[0]}'):
             obj.phrase = 'updated'
-            obj.as1.update({
+            obj_as1 = {
+                **obj_as1,
                 'content': 'their profile',
                 'url': f'https://{obj.domains[0]}',
-            })
+            }
         elif url:
             content = common.pretty_link(url, text=content, user=user)
 
-        obj.content = (obj.as1.get('content')
-                       or obj.as1.get('displayName')
-                       or obj.as1.get('summary'))
-        obj.url = util.get_first(obj.as1, 'url')
+        obj.content = (obj_as1.get('content')
+                       or obj_as1.get('displayName')
+                       or obj_as1.get('summary'))
+        obj.url = util.get_first(obj_as1, 'url')
 
         if (type in ('like', 'follow', 'repost', 'share') or
             not obj.content):
@@ -255,6 +261,19 @@ def stats():
     )
 
 
+@app.get('/metrics')
+def metrics_json():
+    """This instance's in-process counters and HTTP connection stats, as JSON.
+
+    Only for App Engine cron, since they're internal. App Engine strips
+    X-Appengine-* headers from external requests.
+    """
+    if request.headers.get('X-Appengine-Cron') != 'true':
+        error('Only App Engine cron can read this', status=403)
+
+    return {**metrics.snapshot(), **http_client.stats()}
+
+
 @app.get('/.well-known/nodeinfo')
 @flask_util.cached(cache, datetime.timedelta(days=1))
 def nodeinfo_jrd():
@@ -27,6 +27,7 @@ from common import (
     CONTENT_TYPE_HTML,
     postprocess_as2,
 )
+from conversions import convert
 from models import Object, User
 
 logger = logging.getLogger(__name__)
@@ -82,7 +83,7 @@ def redir(to):
                 obj = Object.get_by_id(to)
                 if not obj or obj.deleted:
                     return f'Object not found: {to}', 404
-                ret = postprocess_as2(as2.from_as1(obj.as1),
+                ret = postprocess_as2(convert(as2.from_as1, obj.as1),
                                       user, create=False)
                 logger.info(f'Returning: {json_dumps(ret, indent=2)}')
                 return ret, {
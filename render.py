@@ -12,6 +12,7 @@ from oauth_dropins.webutil import util
 
 from app import app, cache
 import common
+from conversions import convert
 from models import Object
 
 logger = logging.getLogger(__name__)
@@ -42,7 +43,7 @@ def render():
 
     # add HTML meta redirect to source page. should trigger for end users in
     # browsers but not for webmention receivers (hopefully).
-    html = microformats2.activities_to_html([obj.as1])
+    html = convert(microformats2.activities_to_html, [obj.as1])
     utf8 = '<meta charset="utf-8">'
     url = util.get_url(obj.as1)
     if url:
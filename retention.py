@@ -0,0 +1,167 @@
+"""Retention policy for :class:`Object`\\s, and the job that enforces it.
+
+We store every activity we receive, including Accepts, Deletes, Likes, and
+Updates, and every deleted object as a tombstone, so the Object kind and its
+indices grow without bound. :data:`POLICY` says how long to keep each kind of
+:class:`Object`, by label, type, and/or status, based on when it was last
+updated.
+
+:func:`compact` is a cron job that starts one :func:`compact_task` per
+:class:`Rule`. Each task deletes one batch of expired :class:`Object`\\s,
+along with their :class:`Delivery`\\s, then enqueues itself again with the
+query cursor, so runs are resumable and never time out. Pass ``dry_run=true``
+to count what would be deleted without deleting anything.
+
+Reports the number of :class:`Object`\\s and bytes reclaimed in task
+responses, logs, and the ``retention.[RULE].deleted`` and
+``retention.[RULE].bytes`` metrics. Bytes are estimates from the size of each
+:class:`Object`'s JSON source data; they don't include other properties,
+compression, or index entries.
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+import logging
+
+from flask import request
+from google.cloud import ndb
+from google.cloud.ndb import Cursor
+from oauth_dropins.webutil import flask_util, util
+from oauth_dropins.webutil.flask_util import error
+from oauth_dropins.webutil.util import json_dumps
+
+from app import app
+import common
+import metrics
+from models import Delivery, Object
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+
+# never delete these, regardless of policy. user is Bridgy Fed users' own
+# posts and activities, which we serve. feed and notification are what user
+# pages, feeds, and XRPC feeds render. None of the rules below are safe for
+# them: tombstones are only filtered out of those queries once
+# models.DELETED_INDEXED is on, and likes et al show up as notifications.
+KEEP_LABELS = frozenset(('feed', 'notification', 'user'))
+KEEP_STATUSES = frozenset(('new', 'in progress'))
+
+Rule = namedtuple('Rule', ('name', 'max_age', 'filters'))
+"""A retention rule.
+
+name: str
+max_age: :class:`datetime.timedelta`, delete matching objects that haven't
+  been updated for this long
+filters: dict, :class:`Object` property name to value. Objects must match all.
+"""
+
+POLICY = (
+    Rule('tombstones', timedelta(days=90), {'deleted': True}),
+    Rule('ignored', timedelta(days=30), {'status': 'ignored'}),
+    Rule('accepts', timedelta(days=30), {'type': 'accept'}),
+    Rule('deletes', timedelta(days=30), {'type': 'delete'}),
+    Rule('updates', timedelta(days=30), {'type': 'update'}),
+    Rule('likes', timedelta(days=180), {'type': 'like'}),
+)
+RULES = {rule.name: rule for rule in POLICY}
+
+
+def query(rule, cutoff):
+    """Returns a query for a rule's :class:`Object`\\s last updated before cutoff.
+
+    Args:
+      rule: :class:`Rule`
+      cutoff: :class:`datetime.datetime`, naive UTC
+
+    Returns: :class:`ndb.Query`
+    """
+    filters = [getattr(Object, name) == val for name, val in rule.filters.items()]
+    return Object.query(*filters, Object.updated < cutoff)
+
+
+def expired(obj):
+    """Returns True if we're allowed to delete an :class:`Object`."""
+    return not (KEEP_LABELS & set(obj.labels) or obj.status in KEEP_STATUSES)
+
+
+def stored_size(obj):
+    """Estimates an :class:`Object`'s stored size in bytes from its JSON data."""
+    return sum(len(json_dumps(val).encode())
+               for val in (obj.as2, obj.bsky, obj.mf2) if val is not None)
+
+
+@app.get('/cron/compact-objects')
+def compact():
+    """Cron job that starts a :func:`compact_task` for each rule in :data:`POLICY`.
+
+    Parameters:
+      dry_run: optional, 'true' to only count what we'd delete
+    """
+    if request.headers.get('X-Appengine-Cron') != 'true':
+        error('Only App Engine cron can run this', status=403)
+
+    dry_run = request.values.get('dry_run') == 'true'
+    now = util.now().replace(tzinfo=None)
+    for rule in POLICY:
+        common.create_task('compact-objects', rule=rule.name,
+                           cutoff=(now - rule.max_age).isoformat(),
+                           dry_run='true' if dry_run else 'false')
+
+    return f'Started compacting {len(POLICY)} rules{" (dry run)" if dry_run else ""}'
+
+
+@app.post('/_ah/queue/compact-objects')
+def compact_task():
+    """Task handler that deletes one batch of a rule's expired :class:`Object`\\s.
+
+    Enqueues itself again for the next batch until the rule's query is done.
+
+    Parameters:
+      rule: str, :class:`Rule` name
+      cutoff: str, ISO 8601 naive UTC datetime. Deletes objects updated before
+        this.
+      dry_run: 'true' to only count what we'd delete
+      cursor: str, optional, urlsafe query cursor to resume from
+      count: int, optional, objects deleted by previous batches
+      bytes: int, optional, bytes reclaimed by previous batches
+    """
+    name = flask_util.get_required_param('rule')
+    rule = RULES.get(name)
+    if not rule:
+        error(f'Unknown retention rule {name}')
+
+    cutoff = flask_util.get_required_param('cutoff')
+    dry_run = request.values.get('dry_run') == 'true'
+    cursor = request.values.get('cursor')
+    count = int(request.values.get('count') or 0)
+    size = int(request.values.get('bytes') or 0)
+
+    objs, next_cursor, more = query(rule, datetime.fromisoformat(cutoff)).fetch_page(
+        BATCH_SIZE, start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+    to_delete = [obj for obj in objs if expired(obj)]
+    batch_size = sum(stored_size(obj) for obj in to_delete)
+    count += len(to_delete)
+    size += batch_size
+
+    if to_delete and not dry_run:
+        ids = [obj.key.id() for obj in to_delete]
+        futures = [Delivery.query(Delivery.obj_id == id).fetch_async(keys_only=True)
+                   for id in ids]
+        delivery_keys = [future.get_result() for future in futures]
+        ndb.delete_multi([obj.key for obj in to_delete] +
+                         [key for keys in delivery_keys for key in keys])
+        metrics.incr(f'retention.{name}.deleted', len(to_delete))
+        metrics.incr(f'retention.{name}.bytes', batch_size)
+
+    verb = 'Would delete' if dry_run else 'Deleted'
+    msg = f'{verb} {count} {name} objects, {size} bytes'
+    if more and next_cursor:
+        common.create_task('compact-objects', rule=name, cutoff=cutoff,
+                           dry_run='true' if dry_run else 'false',
+                           cursor=next_cursor.urlsafe().decode(),
+                           count=count, bytes=size)
+        msg += ' so far'
+
+    logger.info(msg)
+    return msg
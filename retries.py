@@ -0,0 +1,136 @@
+"""Retries failed deliveries and sweeps up stuck ones.
+
+:func:`common.schedule_retry` schedules retries with exponential backoff for
+deliveries that fail with errors worth retrying. ActivityPub inbox retries
+are handled by :func:`webmention.deliver_task`, webmention retries by
+:func:`send_webmention_task` here.
+
+:func:`sweep` is a cron job that finds :class:`Object`\\s that have been in
+progress with undelivered targets for longer than :data:`STUCK_AGE`, eg
+because an instance died mid-delivery or a host's circuit was open, and
+re-enqueues delivery to those targets.
+"""
+from datetime import timedelta
+import logging
+
+from flask import request
+from oauth_dropins.webutil import flask_util, util, webmention
+from oauth_dropins.webutil.flask_util import error
+
+from app import app
+import common
+import discovery
+import host_health
+import http_client
+from models import Delivery, Object, User
+from webmention import (
+    enqueue_deliveries,
+    finalize_deliveries,
+    record_deliveries,
+    update_deliveries,
+)
+
+logger = logging.getLogger(__name__)
+
+STUCK_AGE = timedelta(hours=1)
+SWEEP_LIMIT = 200
+
+
+@app.post('/_ah/queue/send-webmention')
+def send_webmention_task():
+    """Task handler that sends one webmention for an :class:`Object`.
+
+    Idempotent: skips targets that are no longer undelivered or failed.
+
+    Parameters:
+      obj_id: str, :class:`Object` id
+      source: str, webmention source URL
+      target: str, webmention target URL
+    """
+    obj_id = flask_util.get_required_param('obj_id')
+    source = flask_util.get_required_param('source')
+    target = flask_util.get_required_param('target')
+
+    obj = Object.get_by_id(obj_id)
+    if not obj:
+        error(f'No object found for {obj_id}')
+    record = Delivery.get_by_id(Delivery._id(obj_id, target))
+    if not record or record.status not in ('undelivered', 'failed'):
+        return f'{target} is already handled for {obj_id}'
+
+    if not host_health.hosts.allow(target):
+        record_deliveries(obj.key, [], [], deferred=[target])
+        return f"Deferred webmention to {target}, its circuit is open"
+
+    logger.info(f'Sending webmention from {source} to {target}')
+    try:
+        endpoint = discovery.discover(target)
+        if endpoint:
+            webmention.send(endpoint, source, target, session=http_client.session)
+        host_health.hosts.record(target, True)
+    except BaseException as e:
+        host_health.hosts.record_exception(target, e)
+        code, body = util.interpret_http_exception(e)
+        if not code and not body:
+            raise
+        discovery.delete([target])
+        record_deliveries(obj.key, [], [target])
+        common.schedule_retry(obj_id, target, e, 'send-webmention', {
+            'obj_id': obj_id,
+            'source': source,
+            'target': target,
+        })
+        return f'Webmention to {target} failed: {code} {body}'
+
+    if not endpoint:
+        record_deliveries(obj.key, [], [target])
+        return f'No webmention endpoint for {target}'
+
+    record_deliveries(obj.key, [target], [])
+    return f'Sent webmention to {target}'
+
+
+@app.get('/cron/sweep-deliveries')
+def sweep():
+    """Cron job that re-enqueues delivery for stuck :class:`Object`\\s.
+
+    Handles at most :data:`SWEEP_LIMIT` :class:`Object`\\s per run, oldest
+    first. :class:`Object`\\s that are in progress without any undelivered
+    targets just get their final status.
+    """
+    if request.headers.get('X-Appengine-Cron') != 'true':
+        error('Only App Engine cron can run this', status=403)
+
+    cutoff = util.now().replace(tzinfo=None) - STUCK_AGE
+    query = Object.query(Object.status == 'in progress',
+                         Object.updated < cutoff).order(Object.updated)
+
+    swept = 0
+    for obj in query.fetch(SWEEP_LIMIT):
+        uris = Delivery.targets(obj.key.id(), 'undelivered')
+        if not uris:
+            finalize_deliveries(obj.key)
+            continue
+
+        logger.info(f'Re-enqueueing {obj.key.id()} to {len(uris)} targets, last updated {obj.updated}')
+        if obj.source_protocol == 'activitypub':
+            # inbound, so targets are webmention targets
+            for uri in uris:
+                common.create_task('send-webmention', obj_id=obj.key.id(),
+                                   source=obj.proxy_url(), target=uri)
+        else:
+            # outbound, so targets are ActivityPub inboxes. redeliver the
+            # activity exactly as we first sent it.
+            user = User.get_by_id(obj.domains[0]) if obj.domains else None
+            if not user:
+                logger.warning(f'No user for {obj.key.id()}, skipping')
+                continue
+            elif not obj.sent_as2:
+                logger.warning(f"No sent activity stored for {obj.key.id()}, can't redeliver; marking failed")
+                update_deliveries(obj.key.id(), [], uris)
+                finalize_deliveries(obj.key)
+                continue
+            enqueue_deliveries(obj, uris, user, obj.sent_as2)
+        swept += 1
+
+    return f'Re-enqueued {swept} stuck objects'
@@ -0,0 +1,45 @@
+"""Populate Follower.inbox and shared_inbox from last_follow.
+
+Follower._pre_put_hook fills them in, so this just loads and re-stores every
+Follower, in batches. Once it's done, set the FOLLOWER_INBOXES_INDEXED
+environment variable in app.yaml so that webmention delivery uses them.
+
+Run with:
+
+source local/bin/activate.csh
+env PYTHONPATH=. GOOGLE_APPLICATION_CREDENTIALS=service_account_creds.json \
+  python scripts/backfill_follower_inboxes.py [START_CURSOR]
+"""
+import sys
+
+from google.cloud import ndb
+from google.cloud.ndb import Cursor
+from oauth_dropins.webutil import appengine_config
+
+import common
+from models import Follower
+
+BATCH_SIZE = 200
+
+
+def run():
+    # don't bump updated, since the followers UI sorts by it
+    Follower.updated._auto_now = False
+
+    cursor = Cursor(urlsafe=sys.argv[1]) if len(sys.argv) > 1 else None
+    count = 0
+
+    while True:
+        followers, cursor, more = Follower.query().fetch_page(
+            BATCH_SIZE, start_cursor=cursor)
+        ndb.put_multi(followers)
+        count += len(followers)
+        print(f'{count} done, cursor {cursor.urlsafe().decode() if cursor else None}',
+              flush=True)
+        if not more:
+            break
+
+
+if __name__ == '__main__':
+    with appengine_config.ndb_client.context():
+        run()
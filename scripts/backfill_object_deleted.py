@@ -0,0 +1,54 @@
+"""Set Object.deleted to False where it's None.
+
+Objects stored before deleted had a default have deleted None, either stored
+explicitly or missing entirely, so filtering out tombstones in queries with
+deleted == False doesn't match them. Run this, then set the DELETED_INDEXED
+environment variable in app.yaml so that Object.query_live filters them out in
+the index. Only re-stores Objects with deleted None, in batches, and doesn't bump
+updated, since the UI sorts by it.
+
+Run with:
+
+source local/bin/activate.csh
+env PYTHONPATH=. GOOGLE_APPLICATION_CREDENTIALS=service_account_creds.json \
+  python scripts/backfill_object_deleted.py [START_CURSOR]
+"""
+import sys
+
+from google.cloud import ndb
+from google.cloud.ndb import Cursor
+from oauth_dropins.webutil import appengine_config
+
+import common
+from models import Object
+
+BATCH_SIZE = 200
+
+
+def run():
+    Object.updated._auto_now = False
+
+    cursor = Cursor(urlsafe=sys.argv[1]) if len(sys.argv) > 1 else None
+    count = backfilled = 0
+
+    while True:
+        objs, cursor, more = Object.query().fetch_page(BATCH_SIZE,
+                                                       start_cursor=cursor)
+        # stored as None or not stored at all. don't use obj.deleted, since it
+        # returns the default, False, when deleted isn't stored.
+        to_put = [obj for obj in objs if obj._values.get('deleted') is None]
+        for obj in to_put:
+            obj.deleted = False
+        ndb.put_multi(to_put)
+
+        count += len(objs)
+        backfilled += len(to_put)
+        print(f'{count} done, {backfilled} backfilled, cursor {cursor.urlsafe().decode() if cursor else None}',
+              flush=True)
+        if not more:
+            break
+
+
+if __name__ == '__main__':
+    with appengine_config.ndb_client.context():
+        run()
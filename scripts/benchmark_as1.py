@@ -0,0 +1,74 @@
+"""Count AS1 conversions per page render, with and without memoized Object.as1.
+
+Stores a user and a page of activities, then renders the user page and feed
+and counts calls to the as2, bsky, and mf2 to AS1 converters. Uses the
+datastore emulator; doesn't make any HTTP requests.
+
+Run with:
+
+gcloud beta emulators datastore start --use-firestore-in-datastore-mode --no-store-on-disk --host-port=localhost:8089 --quiet < /dev/null >& /dev/null &
+source local/bin/activate.csh
+env PYTHONPATH=. python scripts/benchmark_as1.py
+"""
+import time
+from unittest import mock
+
+from granary import as2, bluesky, microformats2
+from oauth_dropins.webutil.appengine_config import ndb_client
+
+from app import app
+from common import PAGE_SIZE
+from models import Object, User
+
+DOMAIN = 'user.com'
+
+
+def store():
+    User.get_or_create(DOMAIN)
+    for i in range(PAGE_SIZE):
+        id = f'https://mas.to/users/alice/statuses/{i}'
+        Object(id=id, domains=[DOMAIN], labels=['notification', 'feed'],
+               source_protocol='activitypub', as2={
+                   '@context': 'https://www.w3.org/ns/activitystreams',
+                   'type': 'Create',
+                   'id': f'{id}/activity',
+                   'actor': {
+                       'type': 'Person',
+                       'id': 'https://mas.to/users/alice',
+                       'name': 'Alice',
+                       'icon': {'type': 'Image', 'url': 'https://mas.to/alice.png'},
+                   },
+                   'object': {
+                       'type': 'Note',
+                       'id': id,
+                       'content': f'reply number {i} ' * 20,
+                       'inReplyTo': f'https://{DOMAIN}/post',
+                       'tag': [{'type': 'Mention', 'href': f'https://{DOMAIN}/'}],
+                   },
+               }).put()
+
+
+def run(name, path):
+    client = app.test_client()
+    with mock.patch.object(as2, 'to_as1', wraps=as2.to_as1) as from_as2, \
+         mock.patch.object(bluesky, 'to_as1', wraps=bluesky.to_as1) as from_bsky, \
+         mock.patch.object(microformats2, 'json_to_object',
+                           wraps=microformats2.json_to_object) as from_mf2:
+        start = time.perf_counter()
+        resp = client.get(path)
+        elapsed = time.perf_counter() - start
+
+    assert resp.status_code == 200, resp.status_code
+    conversions = from_as2.call_count + from_bsky.call_count + from_mf2.call_count
+    print(f'{name:>10} {path}: {conversions} conversions, '
+          f'{conversions / PAGE_SIZE:.1f} per object, {elapsed * 1000:.0f}ms')
+
+
+if __name__ == '__main__':
+    with ndb_client.context():
+        store()
+
+    for path in f'/user/{DOMAIN}', f'/user/{DOMAIN}/feed':
+        with mock.patch.object(Object.as1, '_func', Object._convert_as1):
+            run('unmemoized', path)
+        run('memoized', path)
@@ -0,0 +1,120 @@
+"""Measure datastore writes for recording delivery progress to many inboxes.
+
+Compares putting the Object with its legacy Target lists after every inbox,
+which we used to do, against :class:`delivery.Checkpoint`, both with those
+lists and with per-inbox :class:`Delivery` entities. Counts puts, serialized
+entity bytes, and indexed property values written. Uses the datastore
+emulator; doesn't make any HTTP requests.
+
+Run with:
+
+gcloud beta emulators datastore start --use-firestore-in-datastore-mode --no-store-on-disk --host-port=localhost:8089 --quiet < /dev/null >& /dev/null &
+source local/bin/activate.csh
+env PYTHONPATH=. python scripts/benchmark_checkpoints.py [NUM_INBOXES]
+"""
+import sys
+import time
+
+from google.cloud import ndb
+from oauth_dropins.webutil.appengine_config import ndb_client
+
+import common
+import delivery
+from models import Delivery, Object, Target
+
+NOTE = {
+    '@context': 'https://www.w3.org/ns/activitystreams',
+    'type': 'Note',
+    'id': 'https://example.com/post',
+    'content': 'hello world ' * 100,
+}
+
+
+def indexed_values(pb):
+    """Returns the number of indexed property values in an entity protobuf."""
+    count = 0
+    for value in pb.properties.values():
+        values = value.array_value.values if value.HasField('array_value') else [value]
+        count += sum(1 for v in values if not v.exclude_from_indexes)
+    return count
+
+
+def measure(entities, stats):
+    for entity in entities:
+        pb = ndb.model._entity_to_protobuf(entity)
+        pb = getattr(pb, '_pb', pb)  # unwrap proto-plus
+        stats['bytes'] += pb.ByteSize()
+        stats['indexed'] += indexed_values(pb)
+
+
+def run_lists(name, n, every):
+    """Delivery state in the Object's legacy Target lists."""
+    obj = Object(id=f'https://example.com/post-{name}', domains=['example.com'],
+                 labels=['user'], source_protocol='webmention',
+                 status='in progress', as2=NOTE,
+                 undelivered=[Target(uri=f'https://inbox{i}.example/inbox',
+                                     protocol='activitypub')
+                              for i in range(n)])
+    obj.put()
+    stats = {'bytes': 0, 'indexed': 0}
+
+    def save():
+        measure([obj], stats)
+        obj.put()
+
+    with delivery.Checkpoint(save, every=every) as checkpoint:
+        for target in list(obj.undelivered):
+            obj.undelivered.remove(target)
+            obj.delivered.append(target)
+            checkpoint.changed()
+
+        obj.status = 'complete'
+        checkpoint.changed()
+
+    return checkpoint.saves, stats
+
+
+def run_deliveries(name, n, every):
+    """Delivery state in Delivery entities."""
+    obj_id = f'https://example.com/post-{name}'
+    obj = Object(id=obj_id, domains=['example.com'], labels=['user'],
+                 source_protocol='webmention', status='in progress', as2=NOTE)
+    deliveries = Delivery.load(
+        obj_id, [f'https://inbox{i}.example/inbox' for i in range(n)]).values()
+    for d in deliveries:
+        obj.set_delivery(d, 'undelivered')
+    ndb.put_multi(list(deliveries) + [obj])
+    stats = {'bytes': 0, 'indexed': 0}
+    dirty = []
+
+    def save():
+        measure(dirty + [obj], stats)
+        ndb.put_multi(dirty + [obj])
+        dirty.clear()
+
+    with delivery.Checkpoint(save, every=every) as checkpoint:
+        for d in deliveries:
+            obj.set_delivery(d, 'delivered')
+            dirty.append(d)
+            checkpoint.changed()
+
+        obj.status = obj.delivery_status()
+        checkpoint.changed()
+
+    return checkpoint.saves, stats
+
+
+def run(name, fn, n, every):
+    start = time.perf_counter()
+    puts, stats = fn(name, n, every)
+    elapsed = time.perf_counter() - start
+    print(f'{name:>10}: {puts} puts, {stats["bytes"] / 1024 / 1024:.1f}MB, '
+          f'{stats["indexed"]} indexed values, {elapsed:.2f}s for {n} inboxes')
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    with ndb_client.context():
+        run('per-target', run_lists, n, every=1)
+        run('checkpoint', run_lists, n, every=delivery.CHECKPOINT_EVERY)
+        run('deliveries', run_deliveries, n, every=delivery.CHECKPOINT_EVERY)
@@ -0,0 +1,108 @@
+"""Compare stored bytes and read latency for compressed and text JSON properties.
+
+Serializes an inbound reply that embeds its full actor and a page of its
+replies collection, like many we receive, into an Object entity protobuf,
+once with the current compressed as2 property and once as uncompressed JSON
+text, which we used to store. Then times reading each back, ie parsing the
+protobuf and accessing as2. Uses the datastore emulator only for the ndb
+context; doesn't make any datastore or HTTP requests.
+
+Run with:
+
+gcloud beta emulators datastore start --use-firestore-in-datastore-mode --no-store-on-disk --host-port=localhost:8089 --quiet < /dev/null >& /dev/null &
+source local/bin/activate.csh
+env PYTHONPATH=. python scripts/benchmark_compressed_json.py [ITERATIONS]
+"""
+import sys
+import time
+
+from google.cloud import ndb
+from oauth_dropins.webutil.appengine_config import ndb_client
+from oauth_dropins.webutil.util import json_dumps
+
+import common
+from models import Object
+
+ACTOR = {
+    'type': 'Person',
+    'id': 'https://mas.to/users/alice',
+    'url': 'https://mas.to/@alice',
+    'preferredUsername': 'alice',
+    'name': 'Alice',
+    'summary': '<p>I post about things and stuff. ' * 10 + '</p>',
+    'icon': {'type': 'Image', 'url': 'https://mas.to/alice.png'},
+    'image': {'type': 'Image', 'url': 'https://mas.to/alice-header.png'},
+    'inbox': 'https://mas.to/users/alice/inbox',
+    'outbox': 'https://mas.to/users/alice/outbox',
+    'followers': 'https://mas.to/users/alice/followers',
+    'following': 'https://mas.to/users/alice/following',
+    'endpoints': {'sharedInbox': 'https://mas.to/inbox'},
+    'publicKey': {
+        'id': 'https://mas.to/users/alice#main-key',
+        'owner': 'https://mas.to/users/alice',
+        'publicKeyPem': '-----BEGIN PUBLIC KEY-----\n' + 'MIIBIjANBgkqhkiG9w0B' * 20
+                        + '\n-----END PUBLIC KEY-----\n',
+    },
+}
+ID = 'https://mas.to/users/alice/statuses/123'
+AS2 = {
+    '@context': 'https://www.w3.org/ns/activitystreams',
+    'type': 'Note',
+    'id': ID,
+    'attributedTo': ACTOR,
+    'content': '<p>reply to <a href="https://user.com/post">your post</a>. ' * 5 + '</p>',
+    'inReplyTo': 'https://user.com/post',
+    'to': ['https://www.w3.org/ns/activitystreams#Public'],
+    'cc': ['https://mas.to/users/alice/followers', 'https://user.com/'],
+    'tag': [{'type': 'Mention', 'href': 'https://user.com/', 'name': '@user.com'}],
+    'replies': {
+        'type': 'Collection',
+        'id': f'{ID}/replies',
+        'first': {
+            'type': 'CollectionPage',
+            'items': [{
+                'type': 'Note',
+                'id': f'https://mas.to/users/bob/statuses/{i}',
+                'attributedTo': 'https://mas.to/users/bob',
+                'inReplyTo': ID,
+                'content': f'<p>reply number {i}</p>',
+            } for i in range(20)],
+        },
+    },
+}
+
+
+def stored_size(pb):
+    pb = getattr(pb, '_pb', pb)  # unwrap proto-plus
+    return pb.ByteSize()
+
+
+def as2_size(pb):
+    value = pb.properties['as2']
+    return len(value.blob_value) or len(value.string_value.encode())
+
+
+def read(pbs):
+    start = time.perf_counter()
+    for pb in pbs:
+        ndb.model._entity_from_protobuf(pb).as2
+    return (time.perf_counter() - start) / len(pbs)
+
+
+def run(n):
+    compressed = ndb.model._entity_to_protobuf(Object(id=ID, as2=AS2))
+
+    # what JsonProperty used to store
+    text = ndb.model._entity_to_protobuf(Object(id=ID, as2=AS2))
+    text.properties['as2'].string_value = json_dumps(AS2)
+
+    for name, pb in ('text', text), ('compressed', compressed):
+        latency = read([pb] * n)
+        print(f'{name:>10}: as2 {as2_size(pb)} bytes, entity {stored_size(pb)} bytes, '
+              f'read {latency * 1000000:.0f}µs')
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    with ndb_client.context():
+        run(n)
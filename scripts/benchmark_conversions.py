@@ -0,0 +1,52 @@
+"""Compare cached and uncached granary conversions.
+
+Converts the same inbound reply that scripts/benchmark_compressed_json.py
+uses, which embeds its full actor and a page of its replies collection, with
+a few converters we cache in :mod:`conversions`. Times each one uncached,
+as a cache miss, ie converting and storing the result, and as a cache hit,
+ie hashing the input and copying the stored result. Doesn't make any
+datastore or HTTP requests.
+
+Run with:
+
+source local/bin/activate.csh
+env PYTHONPATH=. python scripts/benchmark_conversions.py [ITERATIONS]
+"""
+import sys
+import time
+
+from granary import as2, microformats2
+
+from conversions import ConversionCache
+from scripts.benchmark_compressed_json import AS2
+
+
+def timed(n, fn):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n
+
+
+def run(n):
+    as1 = as2.to_as1(AS2)
+    for converter, input in ((as2.to_as1, AS2),
+                             (as2.from_as1, as1),
+                             (microformats2.object_to_html, as1)):
+        cache = ConversionCache()
+
+        def miss():
+            cache.clear()
+            cache.convert(converter, input)
+
+        uncached = timed(n, lambda: converter(input))
+        missed = timed(n, miss)
+        hit = timed(n, lambda: cache.convert(converter, input))
+
+        name = f'{converter.__module__}.{converter.__name__}'
+        print(f'{name:>36}: uncached {uncached * 1000000:.0f}µs, '
+              f'miss {missed * 1000000:.0f}µs, hit {hit * 1000000:.0f}µs')
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
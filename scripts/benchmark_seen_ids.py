@@ -0,0 +1,58 @@
+"""Compare memory and throughput of inbox dedupe backends.
+
+Adds N synthetic activity ids to each in-process backend, then checks them all
+again, and reports memory allocated and operations per second.
+
+Run with:
+
+source local/bin/activate.csh
+env PYTHONPATH=. python scripts/benchmark_seen_ids.py [N]
+"""
+import sys
+import time
+import tracemalloc
+
+from cachetools import LRUCache
+
+import dedupe
+
+
+def ids(n):
+    return (f'https://mastodon.example/users/someone/statuses/{i:018d}/activity'
+            for i in range(n))
+
+
+def add_all(seen, n):
+    for id in ids(n):
+        if isinstance(seen, LRUCache):
+            seen[id] = True
+        else:
+            seen.add(id)
+
+
+def run(name, make, n):
+    # measure memory and speed separately since tracemalloc slows things down
+    tracemalloc.start()
+    add_all(make(), n)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    seen = make()
+    start = time.perf_counter()
+    add_all(seen, n)
+    added = time.perf_counter() - start
+
+    start = time.perf_counter()
+    hits = sum(1 for id in ids(n) if id in seen)
+    checked = time.perf_counter() - start
+
+    print(f'{name:>10}: {peak / 1024 / 1024:7.1f} MB peak, '
+          f'{n / added:10,.0f} adds/s, {n / checked:10,.0f} checks/s, '
+          f'{hits:,} of {n:,} remembered')
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else dedupe.LRU_SIZE
+    run('cachetools', lambda: LRUCache(dedupe.LRU_SIZE), n)
+    run('lru', dedupe.LruSeenIds, n)
+    run('hashed', dedupe.HashedSeenIds, n)
@@ -0,0 +1,80 @@
+"""Measure the per-inbox cost of preparing a signed ActivityPub delivery.
+
+Compares serializing, digesting, and importing the signing key for every
+inbox, which we used to do, against preparing the payload and key once and
+only signing per inbox. Doesn't make any HTTP requests or datastore calls.
+
+Run with:
+
+source local/bin/activate.csh
+env PYTHONPATH=. python scripts/benchmark_signing.py [NUM_INBOXES]
+"""
+from base64 import b64encode
+from hashlib import sha256
+import sys
+import time
+
+from Crypto import Random
+from Crypto.PublicKey import RSA
+from httpsig.requests_auth import HTTPSignatureAuth
+from oauth_dropins.webutil.util import json_dumps
+import requests
+
+import common
+from models import KEY_BITS, long_to_base64, User
+
+ACTIVITY = {
+    '@context': 'https://www.w3.org/ns/activitystreams',
+    'type': 'Create',
+    'id': 'https://fed.brid.gy/r/https://example.com/post#bridgy-fed-create',
+    'actor': 'https://fed.brid.gy/example.com',
+    'object': {
+        'type': 'Note',
+        'id': 'https://fed.brid.gy/r/https://example.com/post',
+        'content': 'hello world ' * 100,
+        'to': ['https://www.w3.org/ns/activitystreams#Public'],
+    },
+}
+KEY_ID = 'https://fed.brid.gy/example.com'
+
+
+def sign(auth, url, body, digest):
+    req = requests.Request('POST', url, data=body, auth=auth, headers={
+        'Date': 'Mon, 01 Jan 2023 00:00:00 GMT',
+        'Host': 'inbox.example',
+        'Content-Type': 'application/activity+json',
+        'Digest': digest,
+    })
+    return req.prepare()
+
+
+def before(user, urls):
+    for url in urls:
+        body = json_dumps(ACTIVITY).encode()
+        digest = f'SHA-256={b64encode(sha256(body).digest()).decode()}'
+        auth = HTTPSignatureAuth(secret=user.private_pem(), key_id=KEY_ID,
+                                 algorithm='rsa-sha256', sign_header='signature',
+                                 headers=common.HTTP_SIG_HEADERS)
+        sign(auth, url, body, digest)
+
+
+def after(user, urls):
+    payload = common.SignedPayload(ACTIVITY, log_data=False)
+    for url in urls:
+        sign(common.signature_auth(user, KEY_ID), url, payload.body, payload.digest)
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    key = RSA.generate(KEY_BITS, Random.new().read)
+    user = User(id='example.com', mod=long_to_base64(key.n),
+                public_exponent=long_to_base64(key.e),
+                private_exponent=long_to_base64(key.d))
+    urls = [f'https://inbox{i}.example/inbox' for i in range(n)]
+
+    for name, fn in ('before', before), ('after', after):
+        start = time.perf_counter()
+        fn(user, urls)
+        elapsed = time.perf_counter() - start
+        print(f'{name:>6}: {elapsed:.3f}s for {n} inboxes, '
+              f'{elapsed / n * 1000:.2f}ms per inbox')
@@ -0,0 +1,60 @@
+"""Rewrite JSON properties stored as uncompressed text as compressed blobs.
+
+Covers every :class:`models.CompressedJsonProperty`, ie Object.as2, bsky, and
+mf2, User.actor_as2, and Follower.last_follow. Entities whose properties are
+all already compressed are skipped. Doesn't bump updated, since the UI sorts
+by it.
+
+Run with:
+
+source local/bin/activate.csh
+env PYTHONPATH=. GOOGLE_APPLICATION_CREDENTIALS=service_account_creds.json \
+  python scripts/migrate_compressed_json.py [KIND] [START_CURSOR]
+
+KIND is Object, User, or Follower. Defaults to all three, in that order.
+"""
+import sys
+
+from google.cloud import ndb
+from google.cloud.ndb import Cursor
+from oauth_dropins.webutil import appengine_config
+
+import common
+from models import CompressedJsonProperty, Follower, Object, User
+
+BATCH_SIZE = 100
+MODELS = {model.__name__: model for model in (Object, User, Follower)}
+
+
+def needs_migration(entity):
+    """Returns True if any of an entity's JSON properties are uncompressed."""
+    return any(not CompressedJsonProperty.is_compressed(entity, name)
+               for name, prop in entity._properties.items()
+               if isinstance(prop, CompressedJsonProperty))
+
+
+def run(model, cursor=None):
+    model.updated._auto_now = False
+    count = migrated = 0
+
+    while True:
+        entities, cursor, more = model.query().fetch_page(BATCH_SIZE,
+                                                          start_cursor=cursor)
+        to_put = [e for e in entities if needs_migration(e)]
+        ndb.put_multi(to_put)
+
+        count += len(entities)
+        migrated += len(to_put)
+        print(f'{model.__name__}: {count} done, {migrated} migrated, cursor {cursor.urlsafe().decode() if cursor else None}',
+              flush=True)
+        if not more:
+            break
+
+
+if __name__ == '__main__':
+    models = [MODELS[sys.argv[1]]] if len(sys.argv) > 1 else MODELS.values()
+    cursor = Cursor(urlsafe=sys.argv[2]) if len(sys.argv) > 2 else None
+
+    with appengine_config.ndb_client.context():
+        for model in models:
+            run(model, cursor)
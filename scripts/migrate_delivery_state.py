@@ -0,0 +1,68 @@
+"""Move Object.delivered, undelivered, and failed into Delivery entities.
+
+Stores a Delivery for each Target in those lists, sets the Object's counts,
+and clears the lists. Objects that don't have any Targets are skipped.
+Doesn't bump Object.updated, since the UI sorts by it.
+
+Run with:
+
+source local/bin/activate.csh
+env PYTHONPATH=. GOOGLE_APPLICATION_CREDENTIALS=service_account_creds.json \
+  python scripts/migrate_delivery_state.py [START_CURSOR]
+"""
+import sys
+
+from google.cloud import ndb
+from google.cloud.ndb import Cursor
+from oauth_dropins.webutil import appengine_config
+
+import common
+from models import Delivery, Object
+
+BATCH_SIZE = 100
+
+
+def migrate(obj):
+    """Returns the :class:`Delivery`\\s for an :class:`Object`'s Targets.
+
+    Also sets its counts and clears its lists.
+    """
+    deliveries = []
+    for status in Delivery.STATUSES:
+        for target in getattr(obj, status):
+            delivery = Delivery(id=Delivery._id(obj.key.id(), target.uri),
+                                obj_id=obj.key.id(), target=target.uri,
+                                protocol=target.protocol)
+            obj.set_delivery(delivery, status)
+            deliveries.append(delivery)
+        setattr(obj, status, [])
+
+    return deliveries
+
+
+def run():
+    Object.updated._auto_now = False
+
+    cursor = Cursor(urlsafe=sys.argv[1]) if len(sys.argv) > 1 else None
+    count = migrated = 0
+
+    while True:
+        objs, cursor, more = Object.query().fetch_page(BATCH_SIZE,
+                                                       start_cursor=cursor)
+        to_put = []
+        for obj in objs:
+            if obj.delivered or obj.undelivered or obj.failed:
+                to_put.extend(migrate(obj) + [obj])
+                migrated += 1
+
+        ndb.put_multi(to_put)
+        count += len(objs)
+        print(f'{count} done, {migrated} migrated, cursor {cursor.urlsafe().decode() if cursor else None}',
+              flush=True)
+        if not more:
+            break
+
+
+if __name__ == '__main__':
+    with appengine_config.ndb_client.context():
+        run()
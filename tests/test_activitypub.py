@@ -5,6 +5,7 @@ import copy
 from datetime import datetime, timedelta
 from hashlib import sha256
 import logging
+import threading
 from unittest.mock import ANY, call, patch
 import urllib.parse
 
@@ -12,15 +13,19 @@ from google.cloud import ndb
 from granary import as2, microformats2
 from httpsig import HeaderSigner
 from oauth_dropins.webutil import util
+from oauth_dropins.webutil.appengine_config import ndb_client
 from oauth_dropins.webutil.testutil import requests_response
 from oauth_dropins.webutil.util import json_dumps, json_loads
 import requests
 from urllib3.exceptions import ReadTimeoutError
+from werkzeug.exceptions import BadGateway
 
 import activitypub
 from app import app
 import common
-from models import Follower, Object, User
+import dedupe
+import metrics
+from models import Delivery, Follower, Object, User
 from . import testutil
 
 ACTOR = {
@@ -213,7 +218,7 @@ class ActivityPubTest(testutil.TestCase):
                 },
             }).put()
 
-    def sign(self, path, body):
+    def sign(self, path, body, user=None):
         """Constructs HTTP Signature, returns headers."""
         digest = b64encode(sha256(body.encode()).digest()).decode()
         headers = {
@@ -222,7 +227,8 @@ class ActivityPubTest(testutil.TestCase):
             'Content-Type': as2.CONTENT_TYPE,
             'Digest': f'SHA-256={digest}',
         }
-        hs = HeaderSigner('http://my/key/id#unused', self.user.private_pem().decode(),
+        hs = HeaderSigner('http://my/key/id#unused',
+                          (user or self.user).private_pem().decode(),
                           algorithm='rsa-sha256', sign_header='signature',
                           headers=('Date', 'Host', 'Digest', '(request-target)'))
         return hs.sign(headers, method='POST', path=path)
@@ -569,6 +575,104 @@ class ActivityPubTest(testutil.TestCase):
                            labels=['notification', 'activity'],
                            object_ids=[LIKE['object']])
 
+    @patch('activitypub.ASYNC_INBOX', True)
+    @patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    def test_inbox_async(self, local_tasks, mock_head, mock_get, mock_post):
+        mock_head.return_value = requests_response(url='http://or.ig/post')
+        mock_get.side_effect = [
+            # source actor
+            self.as2_resp(LIKE_WITH_ACTOR['actor']),
+            WEBMENTION_DISCOVERY,
+        ]
+        mock_post.return_value = requests_response()
+
+        got = self.post('/foo.com/inbox', json=LIKE)
+        self.assertEqual(202, got.status_code)
+
+        # only enqueued so far. not stored until the task verifies it.
+        mock_get.assert_not_called()
+        mock_post.assert_not_called()
+        self.assertEqual(1, len(local_tasks.tasks))
+        self.assertIsNone(Object.get_by_id('http://th.is/like#ok'))
+
+        [resp] = local_tasks.run(self.client)
+        self.assertEqual(200, resp.status_code, resp.get_data(as_text=True))
+
+        args, kwargs = mock_post.call_args
+        self.assertEqual(('http://or.ig/webmention',), args)
+        self.assert_object('http://th.is/like#ok',
+                           domains=['or.ig'],
+                           source_protocol='activitypub',
+                           status='complete',
+                           as2=LIKE_WITH_ACTOR,
+                           delivered=['http://or.ig/post'],
+                           type='like',
+                           labels=['notification', 'activity'],
+                           object_ids=[LIKE['object']])
+
+    @patch('activitypub.ASYNC_INBOX', True)
+    @patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    def test_inbox_async_retries_failed_processing(self, local_tasks, mock_head,
+                                                   mock_get, mock_post):
+        mock_head.return_value = requests_response(url='http://or.ig/post')
+        mock_get.side_effect = [
+            # source actor
+            self.as2_resp(LIKE_WITH_ACTOR['actor']),
+            WEBMENTION_DISCOVERY,
+        ]
+        mock_post.return_value = requests_response()
+
+        got = self.post('/foo.com/inbox', json=LIKE)
+        self.assertEqual(202, got.status_code)
+        [task] = local_tasks.tasks
+        req = task['app_engine_http_request']
+
+        with patch('activitypub.process_activity', side_effect=BadGateway('boom')):
+            got = self.client.post(req['relative_uri'], data=req['body'],
+                                   headers=req['headers'])
+        self.assertEqual(502, got.status_code)
+        self.assertNotIn(LIKE['id'], activitypub.seen_ids)
+        self.assertIsNone(Object.get_by_id(LIKE['id']))
+
+        # Cloud Tasks retries it, and this time it's processed, not skipped
+        got = self.client.post(req['relative_uri'], data=req['body'],
+                               headers=req['headers'])
+        self.assertEqual(200, got.status_code, got.get_data(as_text=True))
+        self.assertEqual('complete', Object.get_by_id(LIKE['id']).status)
+        self.assertEqual(('http://or.ig/webmention',), mock_post.call_args[0])
+
+    @patch('activitypub.ASYNC_INBOX', True)
+    @patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    def test_inbox_async_bad_signature(self, local_tasks, _, mock_get, mock_post):
+        body = json_dumps(LIKE)
+        headers = self.sign('/foo.com/inbox', body)
+        got = self.client.post('/foo.com/inbox', data=body,
+                               headers={**headers, 'Date': 'X'})
+        self.assertEqual(202, got.status_code)
+
+        # permanent, so don't let Cloud Tasks retry it
+        [resp] = local_tasks.run(self.client)
+        self.assertEqual(200, resp.status_code)
+        self.assertIn('HTTP Signature verification failed', resp.get_data(as_text=True))
+        mock_post.assert_not_called()
+        self.assertIsNone(Object.get_by_id(LIKE['id']))
+        self.assertEqual(1, metrics.get('inbox.rejected.signature'))
+
+    @patch('activitypub.ASYNC_INBOX', True)
+    @patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    def test_inbox_async_user_deleted(self, local_tasks, _, mock_get, mock_post):
+        got = self.post('/foo.com/inbox', json=LIKE)
+        self.assertEqual(202, got.status_code)
+        self.user.key.delete()
+
+        # permanent, so don't let Cloud Tasks retry it
+        [resp] = local_tasks.run(self.client)
+        self.assertEqual(200, resp.status_code)
+        self.assertIn('User foo.com not found', resp.get_data(as_text=True))
+        mock_get.assert_not_called()
+        self.assertIsNone(Object.get_by_id(LIKE['id']))
+        self.assertEqual(1, metrics.get('inbox.rejected.no_user'))
+
     def test_inbox_follow_accept_with_id(self, *mocks):
         self._test_inbox_follow_accept(FOLLOW_WRAPPED, ACCEPT, *mocks)
 
@@ -755,6 +859,24 @@ class ActivityPubTest(testutil.TestCase):
             'object': 'http://snarfed.org/',
         })
         self.assertEqual(501, got.status_code)
+        self.assertEqual(0, Object.query().count())
+        self.assertEqual(1, metrics.get('inbox.rejected.unsupported_type'))
+
+    def test_inbox_unknown_user_not_stored(self, *_):
+        got = self.post('/nope.com/inbox', json=LIKE)
+        self.assertEqual(404, got.status_code)
+        self.assertEqual(0, Object.query().count())
+        self.assertEqual(1, metrics.get('inbox.rejected.no_user'))
+
+    def test_inbox_bad_signature_not_stored(self, *_):
+        body = json_dumps(LIKE)
+        headers = self.sign('/foo.com/inbox', body)
+        got = self.client.post('/foo.com/inbox', data=body,
+                               headers={**headers, 'Date': 'X'})
+        self.assertEqual(401, got.status_code)
+        self.assertIsNone(Object.get_by_id(LIKE['id']))
+        self.assertNotIn(LIKE['id'], activitypub.seen_ids)
+        self.assertEqual(1, metrics.get('inbox.rejected.signature'))
 
     def test_inbox_bad_object_url(self, mock_head, mock_get, mock_post):
         # https://console.cloud.google.com/errors/detail/CMKn7tqbq-GIRA;time=P30D?project=bridgy-federated
@@ -847,6 +969,39 @@ class ActivityPubTest(testutil.TestCase):
         self.assertEqual({'error': 'No HTTP Signature'}, resp.json)
         mock_info.assert_any_call('Returning 401: No HTTP Signature')
 
+    def test_inbox_verify_http_signature_caches_parsed_key(self, *_):
+        for id in 'https://a/note#update', 'https://a/note#update-2':
+            got = self.post('/inbox', json={**UPDATE_NOTE, 'id': id})
+            self.assertEqual(200, got.status_code, got.get_data(as_text=True))
+
+        self.assertEqual({'miss': 1, 'hit': 1},
+                         activitypub.public_keys.stats['http://my/key/id#unused'])
+
+    def test_inbox_verify_http_signature_key_rotated(self, _, mock_get, __):
+        # stored actor has our old key, remote actor now has a new one
+        new_user = User.get_or_create('new.key')
+        new_actor = {
+            **ACTOR,
+            'publicKey': {
+                'id': 'http://my/key/id#unused',
+                'owner': 'http://own/er',
+                'publicKeyPem': new_user.public_pem().decode(),
+            },
+        }
+        mock_get.return_value = self.as2_resp(new_actor)
+
+        body = json_dumps(UPDATE_NOTE)
+        got = self.client.post('/inbox', data=body,
+                               headers=self.sign('/inbox', body, user=new_user))
+        self.assertEqual(200, got.status_code, got.get_data(as_text=True))
+
+        mock_get.assert_has_calls((
+            self.as2_req('http://my/key/id'),
+        ))
+        self.assertEqual({'miss': 1, 'refetch': 1},
+                         activitypub.public_keys.stats['http://my/key/id#unused'])
+        self.assertEqual(new_actor, Object.get_by_id('http://my/key/id').as2)
+
     def test_delete_actor(self, _, mock_get, ___):
         follower = Follower.get_or_create('foo.com', DELETE['actor'])
         followee = Follower.get_or_create(DELETE['actor'], 'snarfed.org')
@@ -864,6 +1019,38 @@ class ActivityPubTest(testutil.TestCase):
         self.assertEqual('inactive', followee.key.get().status)
         self.assertEqual('active', other.key.get().status)
 
+    def test_delete_unknown_actor_dropped(self, _, mock_get, ___):
+        other = Follower.get_or_create('foo.com', 'https://mas.to/users/other')
+
+        got = self.post('/inbox', json=DELETE)
+        self.assertEqual(200, got.status_code)
+        mock_get.assert_not_called()
+        self.assertIsNone(Object.get_by_id(DELETE['id']))
+        self.assertEqual('active', other.key.get().status)
+        self.assertEqual(1, metrics.get('inbox.dropped.unknown_actor_delete'))
+
+    def test_delete_unknown_actor_already_seen_skips_queries(self, *_):
+        activitypub.seen_ids.add(DELETE['id'])
+
+        with patch.object(Follower, 'query') as follower_query:
+            got = self.post('/inbox', json=DELETE)
+            follower_query.assert_not_called()
+
+        self.assertEqual(200, got.status_code)
+        self.assertIn('Already handled', got.get_data(as_text=True))
+        self.assertEqual(0, metrics.get('inbox.dropped.unknown_actor_delete'))
+
+    def test_delete_known_actor_object_not_dropped(self, _, mock_get, ___):
+        Object(id=DELETE['actor'], as2=ACTOR).put()
+        mock_get.side_effect = [
+            self.as2_resp(ACTOR),
+        ]
+
+        got = self.post('/inbox', json=DELETE)
+        self.assertEqual(200, got.status_code)
+        self.assertTrue(Object.get_by_id(DELETE['actor']).deleted)
+        self.assertEqual(0, metrics.get('inbox.dropped.unknown_actor_delete'))
+
     def test_delete_note(self, _, mock_get, ___):
         obj = Object(id='http://an/obj', as2={})
         obj.put()
@@ -910,8 +1097,10 @@ class ActivityPubTest(testutil.TestCase):
         self.assert_entities_equal(Object.get_by_id('https://a/note'),
                                    common.get_object.cache['https://a/note'])
 
-    def test_inbox_webmention_discovery_connection_fails(self, mock_head,
-                                                         mock_get, mock_post):
+    @patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    def test_inbox_webmention_discovery_connection_fails(self, local_tasks,
+                                                         mock_head, mock_get,
+                                                         mock_post):
         mock_get.side_effect = [
             # source actor
             self.as2_resp(LIKE_WITH_ACTOR['actor']),
@@ -922,6 +1111,13 @@ class ActivityPubTest(testutil.TestCase):
         got = self.post('/foo.com/inbox', json=LIKE)
         self.assertEqual(504, got.status_code)
 
+        # retried later
+        [task] = local_tasks.tasks
+        self.assertEqual('/_ah/queue/send-webmention',
+                         task['app_engine_http_request']['relative_uri'])
+        self.assertEqual(1, Delivery.get_by_id(
+            'http://th.is/like#ok http://or.ig/post').attempts)
+
     def test_inbox_no_webmention_endpoint(self, mock_head, mock_get, mock_post):
         mock_get.side_effect = [
             # source actor
@@ -955,6 +1151,71 @@ class ActivityPubTest(testutil.TestCase):
         self.assertEqual(200, got.status_code)
         self.assertEqual(0, Follower.query().count())
 
+    def test_store_if_unseen_parallel_distinct_ids_dont_serialize(self, *_):
+        # if store_if_unseen held a lock across the datastore insert, only one thread at
+        # a time could get to the barrier, and it would time out.
+        num = 5
+        barrier = threading.Barrier(num, timeout=5)
+
+        def insert(obj):
+            barrier.wait()
+            return True
+
+        results = []
+        def run(i):
+            with ndb_client.context():
+                results.append(activitypub.store_if_unseen(f'http://a/{i}', {}) is not None)
+
+        with patch('activitypub._insert_if_absent', side_effect=insert):
+            threads = [threading.Thread(target=run, args=(i,)) for i in range(num)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        self.assertFalse(barrier.broken)
+        self.assertEqual([True] * num, results)
+
+    def test_store_if_unseen_parallel_duplicates_rejected_once(self, *_):
+        results = []
+        def run():
+            with ndb_client.context():
+                results.append(activitypub.store_if_unseen('http://a/dupe', {}))
+
+        threads = [threading.Thread(target=run) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(1, len([r for r in results if r]))
+        self.assertIsNotNone(Object.get_by_id('http://a/dupe'))
+
+        # not in memory, but already in the datastore
+        activitypub.seen_ids.clear()
+        self.assertIsNone(activitypub.store_if_unseen('http://a/dupe', {}))
+
+    def test_store_if_unseen_insert_fails_forgets_id(self, *_):
+        with patch('activitypub._insert_if_absent', side_effect=RuntimeError('boom')), \
+             self.assertRaises(RuntimeError):
+            activitypub.store_if_unseen('http://a/1', {})
+
+        self.assertNotIn('http://a/1', activitypub.seen_ids)
+        self.assertIsNotNone(activitypub.store_if_unseen('http://a/1', {}))
+
+    def test_inbox_shared_dedupe_skips_datastore(self, *_):
+        # another instance already handled this activity
+        store = {}
+        dedupe.FakeSeenIds(store=store).add(FOLLOW_WRAPPED['id'])
+
+        with patch('activitypub.seen_ids', dedupe.FakeSeenIds(store=store)), \
+             patch('activitypub._insert_if_absent') as mock_insert:
+            got = self.post('/foo.com/inbox', json=FOLLOW_WRAPPED)
+
+        self.assertEqual(200, got.status_code)
+        mock_insert.assert_not_called()
+        self.assertEqual(0, Follower.query().count())
+
     def test_followers_collection_unknown_user(self, *args):
         resp = self.client.get('/nope.com/followers')
         self.assertEqual(404, resp.status_code)
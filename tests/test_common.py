@@ -1,16 +1,21 @@
 # coding=utf-8
 """Unit tests for common.py."""
+from datetime import datetime, timedelta, timezone
+import threading
+import time
 from unittest import mock
 
 from granary import as2
 from oauth_dropins.webutil import appengine_config, util
-from oauth_dropins.webutil.testutil import requests_response
+from oauth_dropins.webutil.testutil import NOW, requests_response
 import requests
 from werkzeug.exceptions import BadGateway
 
 from app import app
 import common
-from models import Object, User
+import http_client
+import metrics
+from models import Delivery, Object, User
 from . import testutil
 
 HTML = requests_response('<html></html>', headers={
@@ -254,6 +259,24 @@ class CommonTest(testutil.TestCase):
         mock_post.assert_called_once()
         self.assertEqual(302, resp.status_code)
 
+    @mock.patch('requests.post')
+    def test_signed_post_reuses_payload_and_key(self, mock_post):
+        mock_post.return_value = requests_response('OK')
+        payload = common.SignedPayload({'foo': 'bar'})
+        common.signed_post('https://a/inbox', user=self.user, data=payload)
+        common.signed_post('https://b/inbox', user=self.user, data=payload)
+
+        first, second = [kwargs for _, kwargs in mock_post.call_args_list]
+        self.assertIs(payload.body, first['data'])
+        self.assertIs(payload.body, second['data'])
+        self.assertEqual(payload.digest, first['headers']['Digest'])
+        self.assertEqual('a', first['headers']['Host'])
+        self.assertEqual('b', second['headers']['Host'])
+        self.assertIs(first['auth'], second['auth'])
+
+        rsa_key = first['auth'].header_signer._rsa._key
+        self.assertEqual(self.user.private_pem(), rsa_key.exportKey())
+
     @mock.patch('requests.get', return_value=AS2)
     def test_get_object_http(self, mock_get):
         self.assertEqual(0, Object.query().count())
@@ -320,3 +343,342 @@ class CommonTest(testutil.TestCase):
                            source_protocol='activitypub',
                            # check that it reused our original Object
                            status='in progress')
+
+    @mock.patch('requests.get', return_value=requests_response(status=410))
+    def test_get_object_caches_failure(self, mock_get):
+        with self.assertRaises(BadGateway):
+            common.get_object('http://the/id')
+        self.assertEqual(1, mock_get.call_count)
+
+        # doesn't fetch again, raises a new exception each time
+        cached = []
+        for _ in range(2):
+            with self.assertRaises(BadGateway) as e:
+                common.get_object('http://the/id#frag')
+            cached.append(e.exception)
+        self.assertEqual(1, mock_get.call_count)
+        self.assertEqual(2, metrics.get('get_object.failure_cached'))
+        self.assertIsNot(cached[0], cached[1])
+        self.assertEqual(410, http_client.status_code(cached[0]))
+
+        # ...until it expires
+        with mock.patch.object(util, 'now', return_value=NOW + common.FAILURE_TTL_GONE), \
+             self.assertRaises(BadGateway):
+            common.get_object('http://the/id')
+        self.assertEqual(2, mock_get.call_count)
+
+        # refresh skips it, and success clears it
+        mock_get.return_value = AS2
+        got = common.get_object('http://the/id', refresh=True)
+        self.assert_equals(AS2_OBJ, got.as2)
+        self.assertEqual(3, mock_get.call_count)
+        self.assertIsNone(common.fetch_failures.get('http://the/id'))
+
+    @mock.patch('requests.get')
+    def test_get_object_refresh(self, mock_get):
+        Object(id='http://the/id', as2={'old': 'stuff'}).put()
+        self.assertEqual({'old': 'stuff'}, common.get_object('http://the/id').as2)
+        mock_get.assert_not_called()
+
+        mock_get.return_value = AS2
+        got = common.get_object('http://the/id', refresh=True)
+        self.assert_equals(AS2_OBJ, got.as2)
+        self.assert_equals(AS2_OBJ, common.get_object('http://the/id').as2)
+        self.assertEqual(1, mock_get.call_count)
+
+    @mock.patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    @mock.patch('requests.get')
+    def test_get_object_stale_refreshes_in_background(self, mock_get, local_tasks):
+        actor = {'type': 'Person', 'id': 'http://the/actor', 'name': 'old'}
+        Object(id='http://the/actor', as2=actor, source_protocol='activitypub',
+               fetched=NOW - common.ACTOR_TTL).put()
+        common.get_object.cache.clear()
+
+        # served stale, twice, with one refresh queued
+        for _ in range(2):
+            self.assertEqual('old', common.get_object('http://the/actor').as2['name'])
+        mock_get.assert_not_called()
+        [task] = local_tasks.tasks
+        self.assertEqual('/_ah/queue/refresh-object',
+                         task['app_engine_http_request']['relative_uri'])
+
+        mock_get.return_value = requests_response({**actor, 'name': 'new'}, headers={
+            'Content-Type': as2.CONTENT_TYPE,
+        })
+        [resp] = local_tasks.run(self.client)
+        self.assertEqual(200, resp.status_code, resp.get_data(as_text=True))
+        self.assertEqual(1, mock_get.call_count)
+
+        got = Object.get_by_id('http://the/actor')
+        self.assertEqual('new', got.as2['name'])
+        self.assertEqual(NOW, got.fetched)
+        self.assertEqual('new', common.get_object('http://the/actor').as2['name'])
+
+    @mock.patch('requests.get', return_value=AS2)
+    def test_get_object_expired_refetches(self, mock_get):
+        Object(id='http://the/id', as2={'old': 'stuff'}, source_protocol='activitypub',
+               fetched=NOW - common.OBJECT_MAX_AGE).put()
+
+        got = common.get_object('http://the/id')
+        self.assert_equals(AS2_OBJ, got.as2)
+        self.assertEqual(NOW, got.fetched)
+        self.assertEqual(1, mock_get.call_count)
+
+    @mock.patch('requests.get', return_value=requests_response(status=410))
+    def test_get_object_expired_refetch_fails_returns_stored(self, mock_get):
+        Object(id='http://the/id', as2=AS2_OBJ, source_protocol='activitypub',
+               fetched=NOW - common.OBJECT_MAX_AGE).put()
+        common.get_object.cache.clear()
+
+        got = common.get_object('http://the/id')
+        self.assert_equals(AS2_OBJ, got.as2)
+        self.assertEqual(1, mock_get.call_count)
+        self.assertEqual(1, metrics.get('get_object.expired.fetch_failed'))
+        self.assertIsNone(common.fetch_failures.get('http://the/id'))
+
+    @mock.patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    @mock.patch('requests.get')
+    def test_get_object_inbound_activity_not_refreshed(self, mock_get, local_tasks):
+        Object(id='http://the/like', source_protocol='activitypub', as2={
+            'type': 'Like',
+            'id': 'http://the/like',
+            'actor': 'http://the/actor',
+            'object': 'http://or.ig/post',
+        }).put()
+        common.get_object.cache.clear()
+
+        # Object.updated is the real time, not NOW
+        later = datetime.now(timezone.utc) + common.OBJECT_MAX_AGE
+        with mock.patch.object(util, 'now', return_value=later):
+            self.assertEqual('Like', common.get_object('http://the/like').as2['type'])
+        mock_get.assert_not_called()
+        self.assertEqual(0, len(local_tasks.tasks))
+
+    @mock.patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    @mock.patch('requests.get', return_value=AS2)
+    def test_get_object_refresh_unchanged_skips_write(self, mock_get, local_tasks):
+        fetched = NOW - common.OBJECT_TTL
+        Object(id='http://the/id', as2=AS2_OBJ, source_protocol='activitypub',
+               fetched=fetched).put()
+
+        with mock.patch.object(Object, 'put') as mock_put:
+            got = common.get_object('http://the/id', refresh=True)
+        self.assert_equals(AS2_OBJ, got.as2)
+        mock_put.assert_not_called()
+        self.assertEqual(fetched, Object.get_by_id('http://the/id').fetched)
+        self.assertEqual(1, metrics.get('get_object.refresh.unchanged'))
+
+        # stale, but we just checked it, so loading it doesn't queue another
+        # refresh on this instance
+        common.get_object.cache.clear()
+        common._refresh_queued['http://the/id'] = True
+        self.assert_equals(AS2_OBJ, common.get_object('http://the/id').as2)
+        self.assertEqual(0, len(local_tasks.tasks))
+        self.assertEqual(1, mock_get.call_count)
+
+    @mock.patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    @mock.patch('requests.get', return_value=AS2)
+    def test_get_object_refresh_unchanged_updates_old_fetched(self, mock_get, local_tasks):
+        Object(id='http://the/id', as2=AS2_OBJ, source_protocol='activitypub',
+               fetched=NOW - common.OBJECT_MAX_AGE / 2).put()
+
+        got = common.get_object('http://the/id', refresh=True)
+        self.assert_equals(AS2_OBJ, got.as2)
+        self.assertEqual(NOW, Object.get_by_id('http://the/id').fetched)
+
+        # fresh now, so loading it again doesn't queue another refresh
+        common.get_object.cache.clear()
+        common._refresh_queued.clear()
+        self.assert_equals(AS2_OBJ, common.get_object('http://the/id').as2)
+        self.assertEqual(0, len(local_tasks.tasks))
+        self.assertEqual(1, mock_get.call_count)
+
+    def test_fetch_failures_ttl(self):
+        def http_error(status):
+            return requests.HTTPError(response=requests_response(status=status))
+
+        ttl = common.FetchFailures.ttl
+        self.assertEqual(common.FAILURE_TTL_GONE, ttl(http_error(410)))
+        self.assertEqual(common.FAILURE_TTL, ttl(http_error(404)))
+        self.assertEqual(common.FAILURE_TTL_UNAVAILABLE, ttl(http_error(503)))
+        self.assertEqual(common.FAILURE_TTL_UNAVAILABLE, ttl(requests.Timeout()))
+
+        no_as2 = BadGateway('no AS2 available')
+        no_as2.requests_response = HTML
+        self.assertEqual(common.FAILURE_TTL, ttl(no_as2))
+
+    def test_get_object_coalesces_concurrent_fetches(self):
+        fetching = threading.Event()
+        release = threading.Event()
+
+        def get_as2(id, user=None):
+            fetching.set()
+            release.wait()
+            return AS2_OBJ
+
+        got = []
+
+        def load():
+            with appengine_config.ndb_client.context():
+                got.append(common.get_object('http://the/id#frag'))
+
+        threads = [threading.Thread(target=load) for _ in range(10)]
+        with mock.patch.object(common, 'get_as2', side_effect=get_as2) as mock_get_as2:
+            threads[0].start()
+            self.assertTrue(fetching.wait(timeout=5))
+            for thread in threads[1:]:
+                thread.start()
+
+            # wait until the others are waiting on the first fetch
+            for _ in range(500):
+                if metrics.get('get_object.coalesced') == 9:
+                    break
+                time.sleep(.01)
+
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        mock_get_as2.assert_called_once()
+        self.assertEqual(9, metrics.get('get_object.coalesced'))
+        self.assertEqual(10, len(got))
+        for obj in got:
+            self.assertIs(got[0], obj)
+        self.assert_equals(AS2_OBJ, got[0].as2)
+
+    def test_single_flight_shares_exception(self):
+        release = threading.Event()
+        calls = []
+
+        @common.single_flight({}, key=lambda x: x)
+        def fn(x):
+            calls.append(x)
+            release.wait()
+            raise ValueError('uh oh')
+
+        errors = []
+
+        def call():
+            try:
+                fn(1)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for _ in range(500):
+            if metrics.get('fn.coalesced') == 2:
+                break
+            time.sleep(.01)
+
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([1], calls)
+        self.assertEqual(3, len(errors))
+        self.assertEqual(['uh oh'] * 3, [str(e) for e in errors])
+        # each caller gets its own exception
+        self.assertEqual(3, len(set(id(e) for e in errors)))
+        self.assertEqual({}, fn.cache)
+
+        # exceptions aren't cached
+        with self.assertRaises(ValueError):
+            fn(1)
+        self.assertEqual([1, 1], calls)
+
+    @mock.patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    def test_create_task_local_schedule_time(self, local_tasks):
+        later = util.now() + timedelta(minutes=5)
+        common.create_task('webmention', schedule_time=later, source='http://a/b')
+        common.create_task('webmention', source='http://c/d')
+        self.assertEqual(later, local_tasks.tasks[0]['schedule_time'])
+
+        with mock.patch.object(self.client, 'post') as mock_post:
+            local_tasks.run(self.client, now=util.now())
+            mock_post.assert_called_once_with(
+                '/_ah/queue/webmention', data=b'source=http%3A%2F%2Fc%2Fd',
+                headers={'Content-Type': 'application/x-www-form-urlencoded'})
+
+        self.assertEqual(1, len(local_tasks.tasks))
+
+    def test_is_retryable(self):
+        self.assertTrue(common.is_retryable(requests.ConnectionError()))
+        self.assertTrue(common.is_retryable(requests.Timeout()))
+        for status in 408, 429, 500, 503:
+            self.assertTrue(common.is_retryable(requests.HTTPError(
+                response=requests_response(status=status))), status)
+        for status in 400, 401, 404, 410:
+            self.assertFalse(common.is_retryable(requests.HTTPError(
+                response=requests_response(status=status))), status)
+
+    def test_retry_delay(self):
+        for attempts in range(1, 20):
+            longest = min(common.RETRY_BASE_DELAY * 2 ** (attempts - 1),
+                      common.RETRY_MAX_DELAY)
+            delay = common.retry_delay(attempts)
+            self.assertLessEqual(longest / 2, delay)
+            self.assertLessEqual(delay, longest)
+
+    @mock.patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    def test_create_task_local(self, local_tasks):
+        common.create_task('webmention', source='http://a/b')
+        self.assertEqual([{
+            'app_engine_http_request': {
+                'http_method': 'POST',
+                'relative_uri': '/_ah/queue/webmention',
+                'body': b'source=http%3A%2F%2Fa%2Fb',
+                'headers': {'Content-Type': 'application/x-www-form-urlencoded'},
+            },
+        }], list(local_tasks.tasks))
+
+        with mock.patch.object(self.client, 'post') as mock_post:
+            local_tasks.run(self.client)
+            mock_post.assert_called_once_with(
+                '/_ah/queue/webmention', data=b'source=http%3A%2F%2Fa%2Fb',
+                headers={'Content-Type': 'application/x-www-form-urlencoded'})
+
+        self.assertEqual(0, len(local_tasks.tasks))
+
+    @mock.patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    @mock.patch('requests.post')
+    @mock.patch('requests.get')
+    def test_send_webmentions_concurrently(self, mock_get, mock_post, local_tasks):
+        def get(url, **kwargs):
+            return requests_response(
+                '<html><head><link rel="webmention" href="/webmention"></html>',
+                url=url)
+
+        # both sends have to be in flight at once to get past this. if they ran
+        # one at a time, the first would time out waiting for the second.
+        barrier = threading.Barrier(2, timeout=5)
+
+        def post(url, **kwargs):
+            barrier.wait()
+            return requests_response(status=502 if url.startswith('http://b.com')
+                                     else 200)
+
+        mock_get.side_effect = get
+        mock_post.side_effect = post
+
+        obj = Object(id='http://th.is/reply', as2={
+            'type': 'Note',
+            'id': 'http://th.is/reply',
+            'url': 'http://th.is/reply',
+            'inReplyTo': ['http://a.com/post', 'http://b.com/post'],
+        })
+        with app.test_request_context('/'), self.assertRaises(BadGateway):
+            common.send_webmentions(obj.as1, obj)
+
+        self.assertFalse(barrier.broken)
+        self.assertCountEqual(['http://a.com/webmention', 'http://b.com/webmention'],
+                              [args[0] for args, _ in mock_post.call_args_list])
+
+        # errors are still aggregated, and failures retried
+        self.assertEqual(['http://a.com/post'],
+                         Delivery.targets('http://th.is/reply', 'delivered'))
+        self.assertEqual(['http://b.com/post'],
+                         Delivery.targets('http://th.is/reply', 'failed'))
+        self.assertEqual(1, len(local_tasks.tasks))
+        self.assertEqual(['a.com', 'b.com'], sorted(obj.domains))
@@ -0,0 +1,83 @@
+"""Unit tests for conversions.py."""
+from unittest.mock import Mock
+
+from conversions import ConversionCache
+import metrics
+from . import testutil
+
+
+def to_upper(obj):
+    return {key: val.upper() for key, val in obj.items()}
+
+
+def to_html(obj):
+    return f'<p>{obj["content"]}</p>'
+
+
+class ConversionCacheTest(testutil.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = ConversionCache()
+
+    def test_hit_returns_copy(self):
+        fn = Mock(wraps=to_upper, __name__='to_upper')
+        self.assertEqual({'a': 'B'}, self.cache.convert(fn, {'a': 'b'}))
+
+        got = self.cache.convert(fn, {'a': 'b'})
+        self.assertEqual({'a': 'B'}, got)
+        self.assertEqual(1, fn.call_count)
+
+        got['a'] = 'changed'
+        self.assertEqual({'a': 'B'}, self.cache.convert(fn, {'a': 'b'}))
+
+    def test_metrics(self):
+        self.cache.convert(to_upper, {'a': 'b'})
+        self.cache.convert(to_upper, {'a': 'b'})
+        self.cache.convert(to_upper, {'a': 'c'})
+        self.assertEqual(1, metrics.get('conversions.to_upper.hit'))
+        self.assertEqual(2, metrics.get('conversions.to_upper.miss'))
+
+    def test_key_includes_converter_and_kwargs(self):
+        self.assertEqual({'content': 'X'},
+                         self.cache.convert(to_upper, {'content': 'x'}))
+        self.assertEqual('<p>x</p>', self.cache.convert(to_html, {'content': 'x'}))
+
+        fn = Mock(return_value={'x': 'y'}, __name__='fn')
+        self.cache.convert(fn, {'a': 'b'}, foo=1)
+        self.cache.convert(fn, {'a': 'b'}, foo=2)
+        self.assertEqual(2, fn.call_count)
+
+    def test_string_result(self):
+        self.assertEqual('<p>x</p>', self.cache.convert(to_html, {'content': 'x'}))
+        self.assertEqual('<p>x</p>', self.cache.convert(to_html, {'content': 'x'}))
+        self.assertEqual(1, metrics.get('conversions.to_html.hit'))
+
+    def test_evicts_over_budget(self):
+        cache = ConversionCache(max_bytes=30)
+        cache.convert(to_html, {'content': 'a' * 5})
+        cache.convert(to_html, {'content': 'b' * 5})
+        cache.convert(to_html, {'content': 'a' * 5})
+        self.assertEqual(2, metrics.get('conversions.to_html.miss'))
+
+        # evicts the least recently used, b
+        cache.convert(to_html, {'content': 'c' * 5})
+        cache.convert(to_html, {'content': 'b' * 5})
+        self.assertEqual(4, metrics.get('conversions.to_html.miss'))
+
+    def test_too_large_not_cached(self):
+        cache = ConversionCache(max_bytes=5)
+        self.assertEqual('<p>xyz</p>', cache.convert(to_html, {'content': 'xyz'}))
+        self.assertEqual(0, cache.cache.currsize)
+
+    def test_size_in_bytes(self):
+        # 12 characters, 17 bytes
+        cache = ConversionCache(max_bytes=15)
+        self.assertEqual('<p>ééééé</p>', cache.convert(to_html, {'content': 'ééééé'}))
+        self.assertEqual(0, cache.cache.currsize)
+
+    def test_uncacheable_args(self):
+        fn = Mock(return_value={'x': 'y'}, __name__='fn')
+        self.assertEqual({'x': 'y'}, self.cache.convert(fn, object()))
+        self.assertEqual(1, metrics.get('conversions.fn.uncacheable'))
+        self.assertEqual(0, self.cache.cache.currsize)
@@ -0,0 +1,180 @@
+"""Unit tests for dedupe.py."""
+from datetime import timedelta
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from pymemcache.exceptions import MemcacheUnexpectedCloseError
+import redis
+
+import dedupe
+from dedupe import (
+    FakeSeenIds,
+    HashedSeenIds,
+    LruSeenIds,
+    MemcacheSeenIds,
+    RedisSeenIds,
+)
+
+
+class DedupeTest(TestCase):
+
+    def test_lru(self):
+        seen = LruSeenIds(size=32, shards=4)
+        self.assertNotIn('http://a', seen)
+        self.assertTrue(seen.add('http://a'))
+        self.assertFalse(seen.add('http://a'))
+        self.assertIn('http://a', seen)
+        self.assertTrue(seen.add('http://b'))
+
+        seen.clear()
+        self.assertNotIn('http://a', seen)
+
+    def test_hashed(self):
+        seen = HashedSeenIds(slots=16)
+        self.assertNotIn('http://a', seen)
+        self.assertTrue(seen.add('http://a'))
+        self.assertFalse(seen.add('http://a'))
+        self.assertIn('http://a', seen)
+        self.assertTrue(seen.add('http://b'))
+        self.assertNotIn('http://c', seen)
+
+        seen.clear()
+        self.assertNotIn('http://a', seen)
+
+    def test_discard(self):
+        for seen in (LruSeenIds(size=32, shards=4), HashedSeenIds(slots=16),
+                     FakeSeenIds()):
+            with self.subTest(seen=seen.__class__.__name__):
+                seen.add('http://a')
+                seen.add('http://b')
+                seen.discard('http://a')
+                seen.discard('http://c')
+                self.assertNotIn('http://a', seen)
+                self.assertIn('http://b', seen)
+                self.assertTrue(seen.add('http://a'))
+
+    def test_hashed_discard_keeps_colliding_ids(self):
+        # with 8 slots, these hash to slots 6, 6, 0, 0, and 1, so they share a
+        # probe sequence that wraps around
+        seen = HashedSeenIds(generations=1, slots=8, clock=lambda: 0)
+        ids = ['http://d', 'http://g', 'http://a', 'http://b', 'http://c']
+        for id in ids:
+            seen.add(id)
+
+        for removed in ids:
+            seen.discard(removed)
+            for id in ids:
+                self.assertEqual(id != removed, id in seen, (removed, id))
+            seen.add(removed)
+
+    def test_hashed_expires_by_time(self):
+        now = [0]
+        seen = HashedSeenIds(window=timedelta(seconds=40), generations=4,
+                             slots=16, clock=lambda: now[0])
+        seen.add('http://a')
+
+        now[0] = 25
+        seen.add('http://b')
+        self.assertIn('http://a', seen)
+
+        # a has aged out, b is still in its window
+        now[0] = 45
+        self.assertNotIn('http://a', seen)
+        self.assertIn('http://b', seen)
+
+        # long gap clears everything
+        now[0] = 1000
+        self.assertNotIn('http://b', seen)
+
+    def test_hashed_full_generation_rotates_early(self):
+        seen = HashedSeenIds(generations=2, slots=8, clock=lambda: 0)
+        ids = [f'http://{i}' for i in range(12)]
+        for id in ids:
+            self.assertTrue(seen.add(id))
+
+        # max 6 per generation, 2 generations, so the first 6 have been evicted
+        # even though no time has passed, and memory stays bounded
+        self.assertEqual(2, len(seen.tables))
+        self.assertNotIn(ids[0], seen)
+        self.assertIn(ids[-1], seen)
+
+    def test_fake_shared_across_instances(self):
+        store = {}
+        one = FakeSeenIds(store=store)
+        two = FakeSeenIds(store=store)
+        self.assertTrue(one.add('http://a'))
+        self.assertFalse(two.add('http://a'))
+        self.assertIn('http://a', two)
+
+    def test_fake_expires(self):
+        seen = FakeSeenIds(ttl=timedelta(0))
+        self.assertTrue(seen.add('http://a'))
+        self.assertNotIn('http://a', seen)
+        self.assertTrue(seen.add('http://a'))
+
+    def test_memcache(self):
+        mock_client = MagicMock()
+        seen = MemcacheSeenIds(mock_client, ttl=timedelta(hours=1))
+        key = dedupe._key('http://a')
+
+        mock_client.add.return_value = True
+        self.assertTrue(seen.add('http://a'))
+        mock_client.add.assert_called_with(key, b'1', expire=3600, noreply=False)
+
+        mock_client.add.return_value = False
+        self.assertFalse(seen.add('http://a'))
+
+        # fail open if memcache is down
+        mock_client.add.side_effect = MemcacheUnexpectedCloseError()
+        self.assertTrue(seen.add('http://a'))
+        mock_client.add.side_effect = ConnectionRefusedError()
+        self.assertTrue(seen.add('http://a'))
+        mock_client.get.side_effect = TimeoutError()
+        self.assertNotIn('http://a', seen)
+
+        # but don't hide bugs
+        mock_client.add.side_effect = TypeError()
+        with self.assertRaises(TypeError):
+            seen.add('http://a')
+
+        seen.discard('http://a')
+        mock_client.delete.assert_called_with(key, noreply=False)
+        mock_client.delete.side_effect = ConnectionRefusedError()
+        seen.discard('http://a')
+
+    def test_redis(self):
+        mock_client = MagicMock()
+        seen = RedisSeenIds(mock_client, ttl=timedelta(hours=1))
+        key = dedupe._key('http://a')
+
+        mock_client.set.return_value = True
+        self.assertTrue(seen.add('http://a'))
+        mock_client.set.assert_called_with(key, 1, nx=True, ex=3600)
+
+        mock_client.set.return_value = None
+        self.assertFalse(seen.add('http://a'))
+
+        # fail open if redis is down
+        mock_client.set.side_effect = redis.ConnectionError()
+        self.assertTrue(seen.add('http://a'))
+
+        seen.discard('http://a')
+        mock_client.delete.assert_called_with(key)
+        mock_client.delete.side_effect = redis.ConnectionError()
+        seen.discard('http://a')
+
+    def test_key_is_short(self):
+        self.assertLess(len(dedupe._key('http://a/' + 'x' * 1000)), 100)
+
+    def test_from_env_default(self):
+        self.assertIsInstance(dedupe.from_env(), HashedSeenIds)
+
+    @patch.dict('os.environ', {'DEDUPE_BACKEND': 'redis',
+                               'REDIS_URL': 'redis://localhost:6379'})
+    def test_from_env(self):
+        self.assertIsInstance(dedupe.from_env(), RedisSeenIds)
+
+    @patch.dict('os.environ', {'DEDUPE_BACKEND': 'nope'})
+    def test_from_env_unknown(self):
+        with self.assertRaises(ValueError):
+            dedupe.from_env()
@@ -0,0 +1,120 @@
+"""Unit tests for delivery.py."""
+from collections import Counter
+from datetime import timedelta
+import threading
+import time
+from unittest import TestCase
+
+import delivery
+
+
+class DeliveryTest(TestCase):
+
+    def test_empty(self):
+        self.assertEqual([], list(delivery.deliver([], lambda url: None)))
+
+    def test_results_in_order(self):
+        urls = [f'http://{host}/inbox/{i}' for i in range(3) for host in 'abc']
+
+        def send(url):
+            # finish in roughly reverse order
+            time.sleep(.01 * (10 - len(url) % 10))
+            if url.endswith('/1'):
+                raise ValueError(url)
+            return url.upper()
+
+        results = list(delivery.deliver(urls, send))
+        self.assertEqual(urls, [r.url for r in results])
+        for r in results:
+            if r.url.endswith('/1'):
+                self.assertIsNone(r.response)
+                self.assertIsInstance(r.exception, ValueError)
+            else:
+                self.assertEqual(r.url.upper(), r.response)
+                self.assertIsNone(r.exception)
+            self.assertGreater(r.latency, 0)
+
+    def test_concurrency_limits(self):
+        lock = threading.Lock()
+        running = Counter()
+        max_running = Counter()
+
+        def send(url):
+            host = url.split('/')[2]
+            with lock:
+                running[host] += 1
+                running['total'] += 1
+                for key in host, 'total':
+                    max_running[key] = max(max_running[key], running[key])
+            time.sleep(.02)
+            with lock:
+                running[host] -= 1
+                running['total'] -= 1
+
+        urls = [f'http://{host}/inbox/{i}' for host in 'abcdef' for i in range(4)]
+        list(delivery.deliver(urls, send, max_workers=4, max_per_host=2))
+
+        self.assertLessEqual(max_running.pop('total'), 4)
+        self.assertGreater(max(max_running.values()), 1)
+        for host, max_host in max_running.items():
+            self.assertLessEqual(max_host, 2, host)
+
+    def test_stop_early_cancels_rest(self):
+        sent = []
+
+        def send(url):
+            sent.append(url)
+            time.sleep(.01)
+
+        urls = [f'http://a/{i}' for i in range(20)]
+        for result in delivery.deliver(urls, send, max_workers=1):
+            break
+
+        self.assertLess(len(sent), 20)
+
+
+class CheckpointTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.saves = 0
+        self.now = 0
+
+    def save(self):
+        self.saves += 1
+
+    def test_every(self):
+        with delivery.Checkpoint(self.save, every=3,
+                                 clock=lambda: self.now) as checkpoint:
+            for _ in range(7):
+                checkpoint.changed()
+            self.assertEqual(2, self.saves)
+
+        # final flush
+        self.assertEqual(3, self.saves)
+        self.assertEqual(3, checkpoint.saves)
+
+    def test_interval(self):
+        with delivery.Checkpoint(self.save, every=100, interval=timedelta(seconds=5),
+                                 clock=lambda: self.now) as checkpoint:
+            checkpoint.changed()
+            self.assertEqual(0, self.saves)
+            self.now = 5
+            checkpoint.changed()
+            self.assertEqual(1, self.saves)
+
+        # nothing left to flush
+        self.assertEqual(1, self.saves)
+
+    def test_flushes_on_exception(self):
+        with self.assertRaises(RuntimeError):
+            with delivery.Checkpoint(self.save, every=100) as checkpoint:
+                checkpoint.changed()
+                raise RuntimeError()
+
+        self.assertEqual(1, self.saves)
+
+    def test_no_changes(self):
+        with delivery.Checkpoint(self.save):
+            pass
+        self.assertEqual(0, self.saves)
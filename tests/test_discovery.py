@@ -0,0 +1,78 @@
+"""Unit tests for discovery.py."""
+from unittest.mock import patch
+
+from oauth_dropins.webutil import util
+from oauth_dropins.webutil.testutil import NOW, requests_response
+
+import discovery
+from discovery import NO_ENDPOINT_TTL, TTL
+import metrics
+from models import WebmentionEndpoint
+from . import testutil
+
+ENDPOINT_HTML = requests_response(
+    '<html><head><link rel="webmention" href="/webmention"></html>')
+NO_ENDPOINT_HTML = requests_response('<html><body>foo</body></html>')
+
+
+@patch('requests.get')
+class DiscoveryTest(testutil.TestCase):
+
+    def test_discover_caches(self, mock_get):
+        mock_get.return_value = ENDPOINT_HTML
+
+        self.assertEqual('http://or.ig/webmention',
+                         discovery.discover('http://or.ig/post'))
+        self.assertEqual('http://or.ig/webmention',
+                         discovery.discover('http://or.ig/post'))
+        self.assertEqual(1, mock_get.call_count)
+        self.assertEqual(1, metrics.get('webmention.discover.cached.url'))
+
+        self.assertEqual('http://or.ig/webmention',
+                         WebmentionEndpoint.get_by_id('or.ig').endpoint)
+
+    def test_discover_expires(self, mock_get):
+        mock_get.return_value = ENDPOINT_HTML
+        discovery.discover('http://or.ig/post')
+
+        with patch.object(util, 'now', return_value=NOW + TTL):
+            discovery.discover('http://or.ig/post')
+
+        self.assertEqual(2, mock_get.call_count)
+
+    def test_no_endpoint_expires_sooner(self, mock_get):
+        mock_get.return_value = NO_ENDPOINT_HTML
+        self.assertIsNone(discovery.discover('http://or.ig/post'))
+        self.assertEqual({'http://or.ig/post': None},
+                         discovery.get(['http://or.ig/post']))
+
+        # don't cache the domain
+        self.assertIsNone(WebmentionEndpoint.get_by_id('or.ig'))
+
+        with patch.object(util, 'now', return_value=NOW + NO_ENDPOINT_TTL):
+            self.assertEqual({}, discovery.get(['http://or.ig/post']))
+
+    def test_get_falls_back_to_domain(self, mock_get):
+        discovery.put({'http://or.ig/post': 'http://or.ig/webmention'})
+
+        self.assertEqual({
+            'http://or.ig/other': 'http://or.ig/webmention',
+        }, discovery.get(['http://or.ig/other', 'http://ot.her/post']))
+        self.assertEqual(1, metrics.get('webmention.discover.cached.domain'))
+        self.assertEqual(1, metrics.get('webmention.discover.miss'))
+
+    def test_url_overrides_domain(self, mock_get):
+        discovery.put({
+            'http://or.ig/post': 'http://or.ig/webmention',
+            'http://or.ig/none': None,
+        })
+        self.assertEqual({
+            'http://or.ig/post': 'http://or.ig/webmention',
+            'http://or.ig/none': None,
+        }, discovery.get(['http://or.ig/post', 'http://or.ig/none']))
+
+    def test_delete(self, mock_get):
+        discovery.put({'http://or.ig/post': 'http://or.ig/webmention'})
+        discovery.delete(['http://or.ig/post'])
+        self.assertEqual({}, discovery.get(['http://or.ig/post',
+                                            'http://or.ig/other']))
@@ -0,0 +1,68 @@
+"""Unit tests for http_client.py."""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+from unittest import TestCase
+
+from oauth_dropins.webutil.testutil import requests_response
+import requests
+from werkzeug.exceptions import BadGateway
+
+import http_client
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'OK')
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpClientTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('localhost', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://localhost:{self.server.server_port}/'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def test_disabled_in_tests(self):
+        self.assertIsNone(http_client.session)
+        self.assertEqual({}, http_client.stats())
+
+    def test_reuses_connections(self):
+        session = http_client.new_session(pool_hosts=2, pool_size=2)
+        for _ in range(3):
+            self.assertEqual('OK', session.get(self.url, timeout=5).text)
+
+        self.assertEqual({
+            'http.requests': 3,
+            'http.connections': 1,
+            'http.connection_reuse': 2 / 3,
+        }, http_client.stats(session))
+
+    def test_status_code(self):
+        self.assertIsNone(http_client.status_code(requests.ConnectionError()))
+        self.assertEqual(503, http_client.status_code(
+            requests.HTTPError(response=requests_response(status=503))))
+        self.assertEqual(502, http_client.status_code(BadGateway()))
+
+        # gateway=True wraps HTTP errors in a 502
+        try:
+            try:
+                raise requests.HTTPError(response=requests_response(status=404))
+            except requests.HTTPError:
+                raise BadGateway()
+        except BadGateway as e:
+            self.assertEqual(404, http_client.status_code(e))
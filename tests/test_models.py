@@ -3,12 +3,20 @@
 from unittest import mock
 
 from flask import get_flashed_messages
+from google.cloud import ndb
 from granary import as2
 from oauth_dropins.webutil.testutil import requests_response
 
 from app import app
 import common
-from models import Follower, Object, User
+from models import (
+    CompressedJsonProperty,
+    Delivery,
+    Follower,
+    Object,
+    User,
+    ZLIB_HEADER,
+)
 from . import testutil
 
 from .test_activitypub import ACTOR
@@ -297,6 +305,106 @@ class ObjectTest(testutil.TestCase):
     def test_computed_properties_without_as1(self):
         Object(id='a').put()
 
+    def test_as1_memoized(self):
+        obj = Object(id='x', as2={'type': 'Note', 'content': 'foo'})
+
+        with mock.patch.object(as2, 'to_as1', wraps=as2.to_as1) as to_as1:
+            self.assertEqual('foo', obj.as1['content'])
+            self.assertEqual('note', obj.type)
+            self.assertEqual([], obj.object_ids)
+            self.assertEqual(1, to_as1.call_count)
+
+            obj.as2 = {'type': 'Note', 'content': 'bar'}
+            self.assertEqual('bar', obj.as1['content'])
+            self.assertEqual(2, to_as1.call_count)
+
+        obj.populate(as2=None, mf2={'type': ['h-entry'], 'properties': {
+            'content': ['baz'],
+        }})
+        self.assertEqual('baz', obj.as1['content'])
+
+    def test_query_live(self):
+        Object(id='a', domains=['foo.com']).put()
+        Object(id='b', domains=['foo.com'], deleted=True).put()
+
+        ids = lambda: [obj.key.id() for obj in
+                       Object.query_live(Object.domains == 'foo.com')]
+        self.assertCountEqual(['a', 'b'], ids())
+        with mock.patch('models.DELETED_INDEXED', True):
+            self.assertEqual(['a'], ids())
+
+    def test_set_delivery(self):
+        obj = Object(id='x')
+        delivery = Delivery(id='x http://a', obj_id='x', target='http://a')
+        self.assertEqual('ignored', obj.delivery_status())
+
+        self.assertTrue(obj.set_delivery(delivery, 'undelivered'))
+        self.assertEqual(1, obj.undelivered_count)
+        self.assertEqual('in progress', obj.delivery_status())
+
+        self.assertTrue(obj.set_delivery(delivery, 'failed'))
+        self.assertEqual(0, obj.undelivered_count)
+        self.assertEqual(1, obj.failed_count)
+        self.assertEqual('failed', obj.delivery_status())
+
+        self.assertFalse(obj.set_delivery(delivery, 'failed'))
+        self.assertEqual(1, obj.failed_count)
+
+        self.assertTrue(obj.set_delivery(delivery, 'delivered'))
+        self.assertEqual(0, obj.failed_count)
+        self.assertEqual(1, obj.delivered_count)
+        self.assertEqual('complete', obj.delivery_status())
+
+
+class DeliveryTest(testutil.TestCase):
+
+    def test_load_and_targets(self):
+        self.store_deliveries(Object(id='x'), delivered=['http://a'],
+                              undelivered=['http://b', 'http://c'])
+        self.store_deliveries(Object(id='y'), undelivered=['http://d'])
+
+        got = Delivery.load('x', ['http://a', 'http://e'])
+        self.assertEqual(['http://a', 'http://e'], list(got.keys()))
+        self.assertEqual('delivered', got['http://a'].status)
+
+        new = got['http://e']
+        self.assertIsNone(new.status)
+        self.assertEqual('x http://e', new.key.id())
+        self.assertEqual('activitypub', new.protocol)
+        self.assertIsNone(Delivery.get_by_id('x http://e'))
+
+        self.assertEqual(['http://a'], Delivery.targets('x', 'delivered'))
+        self.assertEqual(['http://b', 'http://c'],
+                         sorted(Delivery.targets('x', 'undelivered')))
+        self.assertEqual([], Delivery.targets('x', 'failed'))
+
+
+class CompressedJsonPropertyTest(testutil.TestCase):
+
+    def test_stores_compressed(self):
+        Object(id='x', as2={'content': 'foo ' * 100}).put()
+
+        obj = Object.get_by_id('x')
+        self.assertTrue(CompressedJsonProperty.is_compressed(obj, 'as2'))
+        self.assertEqual({'content': 'foo ' * 100}, obj.as2)
+
+        pb = ndb.model._entity_to_protobuf(obj)
+        blob = pb.properties['as2'].blob_value
+        self.assertTrue(blob.startswith(ZLIB_HEADER))
+        self.assertLess(len(blob), 100)
+
+    def test_reads_uncompressed_text(self):
+        pb = ndb.model._entity_to_protobuf(Follower(id='a b', last_follow={}))
+        pb.properties['last_follow'].string_value = '{"id":"http://fol/low"}'
+
+        follower = ndb.model._entity_from_protobuf(pb)
+        self.assertFalse(CompressedJsonProperty.is_compressed(follower, 'last_follow'))
+        self.assertEqual({'id': 'http://fol/low'}, follower.last_follow)
+
+    def test_must_be_dict(self):
+        with self.assertRaises(TypeError):
+            User(actor_as2=['foo'])
+
 
 class FollowerTest(testutil.TestCase):
 
@@ -314,6 +422,23 @@ class FollowerTest(testutil.TestCase):
         self.assertEqual(as1_actor, self.inbound.to_as1())
         self.assertEqual(as1_actor, self.outbound.to_as1())
 
+    def test_inbox_fields(self):
+        self.inbound.put()
+        self.assertEqual('http://follower/inbox', self.inbound.inbox)
+        self.assertEqual('http://follower/inbox', self.inbound.shared_inbox)
+
+        self.inbound.last_follow['actor'] = {
+            **ACTOR,
+            'endpoints': {'sharedInbox': 'http://bar/shared'},
+        }
+        self.inbound.put()
+        self.assertEqual('http://follower/inbox', self.inbound.inbox)
+        self.assertEqual('http://bar/shared', self.inbound.shared_inbox)
+
+        self.outbound.put()
+        self.assertIsNone(self.outbound.inbox)
+        self.assertIsNone(self.outbound.shared_inbox)
+
     def test_to_as2(self):
         self.assertIsNone(Follower().to_as2())
         self.assertEqual(ACTOR, self.inbound.to_as2())
@@ -16,6 +16,7 @@ from oauth_dropins.webutil import util
 from oauth_dropins.webutil.testutil import requests_response
 
 import common
+import metrics
 from models import Object, Follower, User
 from . import testutil
 from .test_webmention import ACTOR_AS2, ACTOR_HTML, ACTOR_MF2
@@ -161,6 +162,15 @@ class PagesTest(testutil.TestCase):
         self.assert_equals(self.EXPECTED,
                            contents(microformats2.html_to_activities(got.text)))
 
+    @patch('models.DELETED_INDEXED', True)
+    @patch('pages.PAGE_SIZE', 2)
+    def test_feed_html_tombstones_dont_shorten_page(self):
+        self.add_objects()
+        got = self.client.get('/user/foo.com/feed')
+        self.assert_equals(200, got.status_code)
+        self.assert_equals(self.EXPECTED,
+                           contents(microformats2.html_to_activities(got.text)))
+
     def test_feed_atom_empty(self):
         got = self.client.get('/user/foo.com/feed?format=atom')
         self.assert_equals(200, got.status_code)
@@ -182,3 +192,14 @@ class PagesTest(testutil.TestCase):
         got = self.client.get('/user/foo.com/feed?format=rss')
         self.assert_equals(200, got.status_code)
         self.assert_equals(self.EXPECTED, contents(rss.to_activities(got.text)))
+
+    def test_metrics(self):
+        metrics.incr('foo')
+        metrics.incr('bar.baz', 3)
+        got = self.client.get('/metrics', headers={'X-Appengine-Cron': 'true'})
+        self.assert_equals(200, got.status_code)
+        self.assert_equals({'foo': 1, 'bar.baz': 3}, got.json)
+
+    def test_metrics_requires_cron(self):
+        got = self.client.get('/metrics')
+        self.assert_equals(403, got.status_code)
@@ -0,0 +1,138 @@
+"""Unit tests for retention.py."""
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from oauth_dropins.webutil import util
+
+import common
+import metrics
+from models import Delivery, Object
+import retention
+from . import testutil
+
+CRON_HEADERS = {'X-Appengine-Cron': 'true'}
+
+
+def like(id, **kwargs):
+    return Object(id=id, as2={
+        '@context': 'https://www.w3.org/ns/activitystreams',
+        'id': id,
+        'type': 'Like',
+        'object': 'http://or.ig/post',
+        'actor': 'http://th.is/actor',
+    }, **kwargs)
+
+
+@mock.patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+class RetentionTest(testutil.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Object.updated is the real time, not NOW
+        self.later = (datetime.now(timezone.utc) +
+                      max(rule.max_age for rule in retention.POLICY) +
+                      timedelta(days=1))
+
+    def compact(self, local_tasks, dry_run=False):
+        with mock.patch.object(util, 'now', return_value=self.later):
+            got = self.client.get(
+                f'/cron/compact-objects{"?dry_run=true" if dry_run else ""}',
+                headers=CRON_HEADERS)
+        self.assertEqual(200, got.status_code)
+
+        resps = local_tasks.run(self.client)
+        for resp in resps:
+            self.assertEqual(200, resp.status_code, resp.get_data(as_text=True))
+        return [resp.get_data(as_text=True) for resp in resps]
+
+    def test_requires_cron(self, local_tasks):
+        got = self.client.get('/cron/compact-objects')
+        self.assertEqual(403, got.status_code)
+
+    def test_unknown_rule(self, local_tasks):
+        got = self.client.post('/_ah/queue/compact-objects', data={
+            'rule': 'nope',
+            'cutoff': '2022-01-01T00:00:00',
+        })
+        self.assertEqual(400, got.status_code)
+
+    def test_compact(self, local_tasks):
+        self.store_deliveries(like('http://th.is/like', status='complete'),
+                              delivered=['http://or.ig/post'])
+        Object(id='http://th.is/note', deleted=True, as2={'type': 'Note'}).put()
+        # not covered by the policy
+        Object(id='http://th.is/post', as2={'type': 'Note'}).put()
+        # our user's own
+        like('http://user.com/like', labels=['user']).put()
+        # still delivering
+        like('http://th.is/new', status='in progress').put()
+
+        resps = self.compact(local_tasks)
+        self.assertIn('Deleted 1 likes objects', ' '.join(resps))
+        self.assertIn('Deleted 1 tombstones objects', ' '.join(resps))
+
+        self.assertIsNone(Object.get_by_id('http://th.is/like'))
+        self.assertIsNone(Object.get_by_id('http://th.is/note'))
+        self.assertEqual([], Delivery.query().fetch())
+        for id in 'http://th.is/post', 'http://user.com/like', 'http://th.is/new':
+            self.assertIsNotNone(Object.get_by_id(id), id)
+
+        self.assertEqual(1, metrics.get('retention.likes.deleted'))
+        self.assertGreater(metrics.get('retention.likes.bytes'), 0)
+
+    def test_rules_skip_rendered_objects(self, local_tasks):
+        # labels that user pages, feeds, and XRPC feeds query
+        ids = []
+        for rule in retention.POLICY:
+            props = dict(rule.filters)
+            type = props.pop('type', 'note')
+            for label in 'feed', 'notification', 'user':
+                id = f'http://th.is/{rule.name}/{label}'
+                Object(id=id, domains=['foo.com'], labels=[label], as2={
+                    'id': id,
+                    'type': type.capitalize(),
+                    'object': 'http://or.ig/post',
+                    'actor': 'http://th.is/actor',
+                }, **props).put()
+                ids.append(id)
+
+        resps = self.compact(local_tasks)
+        for resp in resps:
+            self.assertIn('Deleted 0 ', resp)
+        for id in ids:
+            self.assertIsNotNone(Object.get_by_id(id), id)
+
+    def test_not_expired_yet(self, local_tasks):
+        like('http://th.is/like').put()
+        self.later = datetime.now(timezone.utc)
+        self.compact(local_tasks)
+        self.assertIsNotNone(Object.get_by_id('http://th.is/like'))
+
+    def test_dry_run(self, local_tasks):
+        like('http://th.is/like').put()
+
+        resps = self.compact(local_tasks, dry_run=True)
+        self.assertIn('Would delete 1 likes objects', ' '.join(resps))
+        self.assertIsNotNone(Object.get_by_id('http://th.is/like'))
+        self.assertEqual(0, metrics.get('retention.likes.deleted'))
+
+    @mock.patch.object(retention, 'BATCH_SIZE', 1)
+    def test_batches_with_cursor(self, local_tasks):
+        for i in range(3):
+            like(f'http://th.is/like/{i}').put()
+
+        resps = self.compact(local_tasks)
+        likes = [resp for resp in resps if ' likes ' in resp]
+        self.assertIn('Deleted 1 likes objects', likes[0])
+        self.assertIn('so far', likes[0])
+        self.assertRegex(likes[-1], r'^Deleted 3 likes objects, \d+ bytes$')
+        self.assertEqual(0, Object.query().count())
+
+    def test_delete_clears_get_object_cache(self, local_tasks):
+        obj = like('http://th.is/like')
+        obj.put()
+        key = common.get_object.cache_key('http://th.is/like')
+        self.assertIn(key, common.get_object.cache)
+
+        obj.key.delete()
+        self.assertNotIn(key, common.get_object.cache)
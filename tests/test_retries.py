@@ -0,0 +1,206 @@
+"""Unit tests for retries.py."""
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from oauth_dropins.webutil import util
+from oauth_dropins.webutil.testutil import NOW, requests_response
+from oauth_dropins.webutil.util import json_loads
+
+import common
+import host_health
+from models import Delivery, Object, User
+import retries
+from . import testutil
+
+LIKE = {
+    '@context': 'https://www.w3.org/ns/activitystreams',
+    'id': 'http://th.is/like',
+    'type': 'Like',
+    'object': 'http://or.ig/post',
+    'actor': 'http://th.is/actor',
+}
+SOURCE = 'http://localhost/render?id=http%3A%2F%2Fth.is%2Flike'
+TARGET = 'http://or.ig/post'
+WEBMENTION_DISCOVERY = requests_response(
+    '<html><head><link rel="webmention" href="/webmention"></html>')
+CRON_HEADERS = {'X-Appengine-Cron': 'true'}
+
+
+@mock.patch('requests.post')
+@mock.patch('requests.get')
+class RetriesTest(testutil.TestCase):
+
+    def make_like(self, targets=None, **props):
+        self.store_deliveries(
+            Object(id='http://th.is/like', domains=['or.ig'], as2=LIKE,
+                   source_protocol='activitypub', **props),
+            **(targets or {'failed': [TARGET]}))
+
+    def send_webmention(self):
+        return self.client.post('/_ah/queue/send-webmention', data={
+            'obj_id': 'http://th.is/like',
+            'source': SOURCE,
+            'target': TARGET,
+        })
+
+    def test_send_webmention_task(self, mock_get, mock_post):
+        self.make_like(status='failed')
+        mock_get.return_value = WEBMENTION_DISCOVERY
+        mock_post.return_value = requests_response()
+
+        # updates counts by the change, doesn't recount
+        with mock.patch.object(Delivery, 'counts') as counts:
+            got = self.send_webmention()
+            counts.assert_not_called()
+        self.assertEqual(200, got.status_code, got.get_data(as_text=True))
+        self.assert_req(mock_post, 'http://or.ig/webmention',
+                        headers={'Accept': '*/*'}, allow_redirects=False,
+                        data={'source': SOURCE, 'target': TARGET})
+
+        obj = Object.get_by_id('http://th.is/like')
+        self.assertEqual('complete', obj.status)
+        self.assertEqual([TARGET], Delivery.targets('http://th.is/like', 'delivered'))
+        self.assertEqual(0, obj.failed_count)
+        self.assertEqual(1, obj.delivered_count)
+
+        # already delivered, don't resend
+        got = self.send_webmention()
+        self.assertEqual(200, got.status_code)
+        self.assertEqual(1, mock_post.call_count)
+
+    @mock.patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    def test_send_webmention_task_fails_retries(self, local_tasks, mock_get,
+                                                mock_post):
+        self.make_like(status='failed')
+        mock_get.return_value = WEBMENTION_DISCOVERY
+        mock_post.return_value = requests_response('uh oh', status=503)
+
+        got = self.send_webmention()
+        self.assertEqual(200, got.status_code, got.get_data(as_text=True))
+
+        delivery = Delivery.get_by_id(f'http://th.is/like {TARGET}')
+        self.assertEqual(1, delivery.attempts)
+        self.assertGreater(delivery.next_attempt, NOW)
+        self.assertIn('503', delivery.last_error)
+
+        [task] = local_tasks.tasks
+        self.assertEqual(delivery.next_attempt, task['schedule_time'])
+        self.assertEqual('/_ah/queue/send-webmention',
+                         task['app_engine_http_request']['relative_uri'])
+
+        # not due yet
+        self.assertEqual([], local_tasks.run(self.client, now=NOW))
+        self.assertEqual(1, mock_post.call_count)
+
+        # now it's due, and it succeeds
+        mock_post.return_value = requests_response()
+        [resp] = local_tasks.run(self.client, now=delivery.next_attempt)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(2, mock_post.call_count)
+        self.assertEqual('complete', Object.get_by_id('http://th.is/like').status)
+
+    @mock.patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    def test_send_webmention_task_gives_up(self, local_tasks, mock_get, mock_post):
+        self.make_like(status='failed')
+        Delivery(id=f'http://th.is/like {TARGET}', obj_id='http://th.is/like',
+                 target=TARGET, attempts=common.RETRY_MAX_ATTEMPTS - 1).put()
+        mock_get.return_value = WEBMENTION_DISCOVERY
+        mock_post.return_value = requests_response('uh oh', status=503)
+
+        got = self.send_webmention()
+        self.assertEqual(200, got.status_code)
+
+        delivery = Delivery.get_by_id(f'http://th.is/like {TARGET}')
+        self.assertEqual(common.RETRY_MAX_ATTEMPTS, delivery.attempts)
+        self.assertIsNone(delivery.next_attempt)
+        self.assertEqual(0, len(local_tasks.tasks))
+        self.assertEqual('failed', Object.get_by_id('http://th.is/like').status)
+
+    def test_send_webmention_task_defers_open_circuit(self, mock_get, mock_post):
+        self.make_like(status='failed')
+        for _ in range(host_health.FAILURE_THRESHOLD):
+            host_health.hosts.record(TARGET, False)
+
+        got = self.send_webmention()
+        self.assertEqual(200, got.status_code)
+        mock_get.assert_not_called()
+
+        # back to undelivered for the sweeper
+        obj = Object.get_by_id('http://th.is/like')
+        self.assertEqual('in progress', obj.status)
+        self.assertEqual([TARGET], Delivery.targets('http://th.is/like', 'undelivered'))
+
+    def test_sweep_requires_cron(self, mock_get, mock_post):
+        got = self.client.get('/cron/sweep-deliveries')
+        self.assertEqual(403, got.status_code)
+
+    @mock.patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    def test_sweep(self, local_tasks, mock_get, mock_post):
+        User.get_or_create('orig')
+        # inbound, stuck
+        self.make_like(status='in progress', targets={'undelivered': [TARGET]})
+        # outbound, stuck
+        sent = {
+            'type': 'Update',
+            'id': 'https://orig/post#update',
+            'actor': 'http://localhost/orig',
+            'object': {
+                'type': 'Note',
+                'id': 'https://orig/post',
+                'content': 'foo',
+                'inReplyTo': 'https://th.at/post',
+                'updated': NOW.isoformat(),
+            },
+        }
+        self.store_deliveries(
+            Object(id='https://orig/post', domains=['orig'], status='in progress',
+                   source_protocol='webmention', labels=['user'],
+                   as2={'type': 'Note', 'id': 'https://orig/post', 'content': 'foo'},
+                   sent_as2=sent),
+            undelivered=['https://inbox'])
+        # outbound, stuck, sent before we stored sent activities
+        self.store_deliveries(
+            Object(id='https://orig/old', domains=['orig'], status='in progress',
+                   source_protocol='webmention', as2={'type': 'Note'}),
+            undelivered=['https://inbox'])
+        # in progress with nothing left to deliver
+        self.store_deliveries(
+            Object(id='https://orig/done', domains=['orig'], status='in progress',
+                   source_protocol='webmention', as2={'type': 'Note'}),
+            delivered=['https://inbox'])
+        # complete
+        self.store_deliveries(
+            Object(id='https://orig/other', domains=['orig'], status='complete',
+                   source_protocol='webmention', as2={'type': 'Note'}),
+            undelivered=['https://inbox'])
+
+        # not stuck yet
+        got = self.client.get('/cron/sweep-deliveries', headers=CRON_HEADERS)
+        self.assertEqual(200, got.status_code)
+        self.assertEqual(0, len(local_tasks.tasks))
+
+        # Object.updated is the real time, not NOW
+        later = datetime.now(timezone.utc) + retries.STUCK_AGE + timedelta(minutes=1)
+        with mock.patch.object(util, 'now', return_value=later):
+            got = self.client.get('/cron/sweep-deliveries', headers=CRON_HEADERS)
+        self.assertEqual(200, got.status_code)
+        self.assertEqual('Re-enqueued 2 stuck objects', got.get_data(as_text=True))
+
+        send, deliver, finalize = [task['app_engine_http_request']
+                                   for task in local_tasks.tasks]
+        self.assertEqual('/_ah/queue/send-webmention', send['relative_uri'])
+        self.assertEqual('/_ah/queue/deliver', deliver['relative_uri'])
+        self.assertEqual('/_ah/queue/finalize-deliveries', finalize['relative_uri'])
+        self.assertEqual('complete', Object.get_by_id('https://orig/done').status)
+        self.assertEqual('failed', Object.get_by_id('https://orig/old').status)
+
+        mock_get.return_value = WEBMENTION_DISCOVERY
+        mock_post.return_value = requests_response()
+        for resp in local_tasks.run(self.client):
+            self.assertEqual(200, resp.status_code, resp.get_data(as_text=True))
+
+        self.assertEqual('complete', Object.get_by_id('http://th.is/like').status)
+        self.assertEqual('complete', Object.get_by_id('https://orig/post').status)
+        args, kwargs = mock_post.call_args_list[-1]
+        self.assertEqual(('https://inbox',), args)
+        self.assertEqual(sent, json_loads(kwargs['data']))
@@ -2,28 +2,33 @@
 """Unit tests for webmention.py."""
 import copy
 from unittest import mock
+import urllib.parse
 from urllib.parse import urlencode
 
 import feedparser
+from google.cloud import ndb
 from granary import as2, atom, microformats2
 from httpsig.sign import HeaderSigner
 from oauth_dropins.webutil import appengine_config, util
 from oauth_dropins.webutil.appengine_config import tasks_client
 from oauth_dropins.webutil.appengine_info import APP_ID
-from oauth_dropins.webutil.testutil import requests_response
+from oauth_dropins.webutil.testutil import NOW, requests_response
 from oauth_dropins.webutil.util import json_dumps, json_loads
 import requests
 
 import activitypub
 from app import app
+import common
 from common import (
     CONNEG_HEADERS_AS2_HTML,
     CONTENT_TYPE_HTML,
     redirect_unwrap,
 )
-from models import Follower, Object, Target, User
+import host_health
+import metrics
+from models import Delivery, Follower, Object, User
 import webmention
-from webmention import TASKS_LOCATION
+from common import TASKS_LOCATION
 from . import testutil
 
 ACTOR_HTML = """\
@@ -536,9 +541,10 @@ class WebmentionTest(testutil.TestCase):
     def test_skip_update_if_content_unchanged(self, mock_get, mock_post):
         """https://github.com/snarfed/bridgy-fed/issues/78"""
         with app.test_request_context('/'):
-            Object(id='http://a/reply', status='complete', mf2=self.reply_mf2['items'][0],
-                   delivered=[Target(uri='https://foo.com/inbox', protocol='activitypub')]
-                   ).put()
+            self.store_deliveries(
+                Object(id='http://a/reply', status='complete',
+                       mf2=self.reply_mf2['items'][0]),
+                delivered=['https://foo.com/inbox'])
         mock_get.side_effect = self.activitypub_gets
 
         got = self.client.post('/webmention', data={
@@ -754,40 +760,269 @@ class WebmentionTest(testutil.TestCase):
         mock_post.return_value = requests_response('abc xyz')
         self.make_followers()
 
+        # counts are updated as deliveries change, not recounted
+        with mock.patch.object(Delivery, 'counts') as counts:
+            got = self.client.post('/_ah/queue/webmention', data={
+                'source': 'https://orig/post',
+                'target': 'https://fed.brid.gy/',
+            })
+            counts.assert_not_called()
+        self.assertEqual(200, got.status_code)
+
+        mock_get.assert_has_calls((
+            self.req('https://orig/post'),
+        ))
+        inboxes = ('https://inbox', 'https://public/inbox', 'https://shared/inbox')
+        self.assert_deliveries(mock_post, inboxes, self.create_as2)
+
+        self.assert_object(f'https://orig/post',
+                           domains=['orig'],
+                           source_protocol='webmention',
+                           status='complete',
+                           mf2=self.create_mf2,
+                           as1=self.create_as1,
+                           delivered=inboxes,
+                           sent_as2=self.create_as2,
+                           type='note',
+                           labels=['user'],
+                           )
+
+    @mock.patch('webmention.FOLLOWER_INBOXES_INDEXED', True)
+    def test_create_post_run_task_followers_indexed(self, mock_get, mock_post):
+        mock_get.side_effect = [self.create, self.actor]
+        mock_post.return_value = requests_response('abc xyz')
+        self.make_followers()
+
+        # stored before Follower had inbox and shared_inbox. the backfill
+        # script has to run before FOLLOWER_INBOXES_INDEXED is turned on.
+        with mock.patch.dict(Follower._properties):
+            del Follower._properties['inbox']
+            del Follower._properties['shared_inbox']
+            Follower.get_or_create('orig', 'https://mastodon/fff',
+                                   last_follow={'actor': {
+                                       'inbox': 'https://unindexed/inbox',
+                                   }})
+
+        got = self.client.post('/_ah/queue/webmention', data={
+            'source': 'https://orig/post',
+            'target': 'https://fed.brid.gy/',
+        })
+        self.assertEqual(200, got.status_code)
+
+        inboxes = ('https://inbox', 'https://public/inbox', 'https://shared/inbox')
+        self.assert_deliveries(mock_post, inboxes, self.create_as2)
+
+    def test_create_post_run_task_followers_not_indexed(self, mock_get, mock_post):
+        mock_get.side_effect = [self.create, self.actor]
+        mock_post.return_value = requests_response('abc xyz')
+
+        # stored before Follower had inbox and shared_inbox
+        with mock.patch.dict(Follower._properties):
+            del Follower._properties['inbox']
+            del Follower._properties['shared_inbox']
+            self.make_followers()
+
         got = self.client.post('/_ah/queue/webmention', data={
             'source': 'https://orig/post',
             'target': 'https://fed.brid.gy/',
         })
         self.assertEqual(200, got.status_code)
 
-        mock_get.assert_has_calls((
-            self.req('https://orig/post'),
-        ))
         inboxes = ('https://inbox', 'https://public/inbox', 'https://shared/inbox')
         self.assert_deliveries(mock_post, inboxes, self.create_as2)
 
+    @mock.patch('webmention.DELIVER_CHUNK_SIZE', 2)
+    @mock.patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    def test_create_post_run_task_chunked(self, local_tasks, mock_get, mock_post):
+        mock_get.side_effect = [self.create, self.actor]
+        mock_post.return_value = requests_response('abc xyz')
+        self.make_followers()
+
+        got = self.client.post('/_ah/queue/webmention', data={
+            'source': 'https://orig/post',
+            'target': 'https://fed.brid.gy/',
+        })
+        self.assertEqual(200, got.status_code)
+        mock_post.assert_not_called()
+        self.assertEqual(3, len(local_tasks.tasks))
+        self.assertEqual('/_ah/queue/finalize-deliveries',
+                         local_tasks.tasks[-1]['app_engine_http_request']['relative_uri'])
+
+        inboxes = ['https://inbox', 'https://public/inbox', 'https://shared/inbox']
+        self.assert_object(f'https://orig/post',
+                           domains=['orig'],
+                           source_protocol='webmention',
+                           status='in progress',
+                           mf2=self.create_mf2,
+                           undelivered=inboxes,
+                           labels=['user'],
+                           )
+
+        for resp in local_tasks.run(self.client):
+            self.assertEqual(200, resp.status_code, resp.get_data(as_text=True))
+
+        self.assert_deliveries(mock_post, inboxes, self.create_as2)
         self.assert_object(f'https://orig/post',
                            domains=['orig'],
                            source_protocol='webmention',
                            status='complete',
                            mf2=self.create_mf2,
+                           delivered=inboxes,
+                           labels=['user'],
+                           )
+
+    def test_create_post_run_task_defers_open_circuit(self, mock_get, mock_post):
+        mock_get.side_effect = [self.create, self.actor]
+        mock_post.return_value = requests_response('abc xyz')
+        self.make_followers()
+        for _ in range(host_health.FAILURE_THRESHOLD):
+            host_health.hosts.record('https://shared/inbox', False)
+
+        got = self.client.post('/_ah/queue/webmention', data={
+            'source': 'https://orig/post',
+            'target': 'https://fed.brid.gy/',
+        })
+        self.assertEqual(200, got.status_code)
+
+        inboxes = ('https://inbox', 'https://public/inbox')
+        self.assert_deliveries(mock_post, inboxes, self.create_as2)
+        self.assert_object(f'https://orig/post',
+                           domains=['orig'],
+                           source_protocol='webmention',
+                           status='in progress',
+                           mf2=self.create_mf2,
                            as1=self.create_as1,
                            delivered=inboxes,
+                           undelivered=['https://shared/inbox'],
                            type='note',
                            labels=['user'],
                            )
+        self.assertEqual(1, metrics.get('delivery.deferred'))
+
+    @mock.patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    def test_deliver_task_idempotent(self, local_tasks, mock_get, mock_post):
+        mock_post.side_effect = [
+            requests_response('abc xyz'),
+            requests_response('uh oh', status=500),
+        ]
+        self.store_deliveries(
+            Object(id='https://orig/post', domains=['orig'], status='in progress',
+                   as2=self.create_as2),
+            delivered=['https://already'],
+            undelivered=['https://inbox', 'https://shared/inbox'])
+
+        params = {
+            'obj_id': 'https://orig/post',
+            'domain': 'orig',
+            'inboxes': json_dumps(['https://already', 'https://inbox']),
+            'activity': json_dumps(self.create_as2),
+        }
+        got = self.client.post('/_ah/queue/deliver', data=params)
+        self.assertEqual(200, got.status_code, got.get_data(as_text=True))
+        self.assertEqual(['https://inbox'],
+                         [args[0] for args, _ in mock_post.call_args_list])
+
+        # retry doesn't resend
+        got = self.client.post('/_ah/queue/deliver', data=params)
+        self.assertEqual(200, got.status_code)
+        self.assertEqual(1, mock_post.call_count)
+
+        # chunks only update Deliveries
+        self.assertEqual(1, Object.get_by_id('https://orig/post').delivered_count)
+        webmention.finalize_deliveries(ndb.Key(Object, 'https://orig/post'))
+        self.assert_object('https://orig/post',
+                           domains=['orig'],
+                           as2=self.create_as2,
+                           status='in progress',
+                           delivered=['https://already', 'https://inbox'],
+                           undelivered=['https://shared/inbox'],
+                           )
+
+        # last chunk, then finalize sets final status
+        got = self.client.post('/_ah/queue/deliver', data={
+            **params,
+            'inboxes': json_dumps(['https://shared/inbox']),
+        })
+        self.assertEqual(200, got.status_code)
+        got = self.client.post('/_ah/queue/finalize-deliveries', data={
+            'obj_id': 'https://orig/post',
+        })
+        self.assertEqual(200, got.status_code)
+        self.assert_object('https://orig/post',
+                           domains=['orig'],
+                           as2=self.create_as2,
+                           status='complete',
+                           delivered=['https://already', 'https://inbox'],
+                           failed=['https://shared/inbox'],
+                           )
+
+        # the 500 is retried later
+        self.assertEqual(1, Delivery.get_by_id(
+            'https://orig/post https://shared/inbox').attempts)
+        [task] = local_tasks.tasks
+        got = dict(urllib.parse.parse_qsl(
+            task['app_engine_http_request']['body'].decode()))
+        self.assertEqual(['https://shared/inbox'], json_loads(got['inboxes']))
+        self.assertEqual('true', got['retry'])
+
+    @mock.patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    def test_finalize_deliveries_task_requeues_while_progressing(
+            self, local_tasks, mock_get, mock_post):
+        self.store_deliveries(
+            Object(id='https://orig/post', domains=['orig'], status='in progress',
+                   as2=self.create_as2),
+            delivered=['https://a'],
+            undelivered=['https://b', 'https://c'])
+        obj = Object.get_by_id('https://orig/post')
+        obj.delivered_count = obj.undelivered_count = 0
+        obj.put()
+
+        got = self.client.post('/_ah/queue/finalize-deliveries', data={
+            'obj_id': 'https://orig/post',
+        })
+        self.assertEqual(200, got.status_code, got.get_data(as_text=True))
+        self.assert_object('https://orig/post',
+                           domains=['orig'],
+                           as2=self.create_as2,
+                           status='in progress',
+                           delivered=['https://a'],
+                           undelivered=['https://b', 'https://c'],
+                           )
+
+        # still undelivered, so check again later
+        [task] = local_tasks.tasks
+        self.assertGreater(task['schedule_time'], NOW)
+        params = dict(urllib.parse.parse_qsl(
+            task['app_engine_http_request']['body'].decode()))
+        self.assertEqual('2', params['undelivered'])
+
+        # progress, so check again
+        local_tasks.clear()
+        webmention.update_deliveries('https://orig/post', ['https://b'], [])
+        got = self.client.post('/_ah/queue/finalize-deliveries', data=params)
+        self.assertEqual(200, got.status_code)
+        self.assertEqual(1, len(local_tasks.tasks))
+
+        # no progress, so leave the rest to the sweeper
+        local_tasks.clear()
+        got = self.client.post('/_ah/queue/finalize-deliveries', data={
+            'obj_id': 'https://orig/post',
+            'undelivered': '1',
+        })
+        self.assertEqual(200, got.status_code)
+        self.assertEqual(0, len(local_tasks.tasks))
 
     def test_create_post_run_task_resume(self, mock_get, mock_post):
         mock_get.side_effect = [self.create, self.actor]
         mock_post.return_value = requests_response('abc xyz')
 
         with app.test_request_context('/'):
-            Object(id='https://orig/post', domains=['orig'], status='in progress',
-                   mf2=self.create_mf2['items'][0],
-                   delivered=[Target(uri='https://skipped/inbox', protocol='activitypub')],
-                   undelivered=[Target(uri='https://shared/inbox', protocol='activitypub')],
-                   failed=[Target(uri='https://public/inbox', protocol='activitypub')],
-                   ).put()
+            self.store_deliveries(
+                Object(id='https://orig/post', domains=['orig'], status='in progress',
+                       mf2=self.create_mf2['items'][0]),
+                delivered=['https://skipped/inbox'],
+                undelivered=['https://shared/inbox'],
+                failed=['https://public/inbox'])
 
         self.make_followers()
         # already sent, should be skipped
@@ -825,12 +1060,12 @@ class WebmentionTest(testutil.TestCase):
         mock_post.return_value = requests_response('abc xyz')
 
         with app.test_request_context('/'):
-            Object(id='https://orig/post', domains=['orig'], status='in progress',
-                   mf2={**self.create_mf2, 'content': 'different'},
-                   delivered=[Target(uri='https://delivered/inbox', protocol='activitypub')],
-                   undelivered=[Target(uri='https://shared/inbox', protocol='activitypub')],
-                   failed=[Target(uri='https://public/inbox', protocol='activitypub')],
-                   ).put()
+            self.store_deliveries(
+                Object(id='https://orig/post', domains=['orig'], status='in progress',
+                       mf2={**self.create_mf2, 'content': 'different'}),
+                delivered=['https://delivered/inbox'],
+                undelivered=['https://shared/inbox'],
+                failed=['https://public/inbox'])
 
         self.make_followers()
 
@@ -1047,6 +1282,50 @@ class WebmentionTest(testutil.TestCase):
                            object_ids=['http://followee'],
                            labels=['user', 'activity'],
                           )
+        # 4xxes aren't retried
+        self.assertEqual(0, Delivery.query().count())
+
+    @mock.patch('common.local_tasks', new_callable=common.LocalTaskQueue)
+    def test_error_retry(self, local_tasks, mock_get, mock_post):
+        mock_get.side_effect = [self.follow, self.actor]
+        mock_post.side_effect = [
+            requests_response('uh oh', status=503, url='https://foo.com/inbox'),
+            requests_response('abc xyz'),
+        ]
+
+        got = self.client.post('/webmention', data={
+            'source': 'http://a/follow',
+            'target': 'https://fed.brid.gy/',
+        })
+        self.assertEqual(502, got.status_code, got.get_data(as_text=True))
+
+        delivery = Delivery.get_by_id('http://a/follow https://foo.com/inbox')
+        self.assertEqual(1, delivery.attempts)
+        self.assertLessEqual(delivery.next_attempt, NOW + common.RETRY_BASE_DELAY)
+        self.assertGreaterEqual(delivery.next_attempt, NOW + common.RETRY_BASE_DELAY / 2)
+
+        # not due yet
+        self.assertEqual([], local_tasks.run(self.client, now=NOW))
+        self.assertEqual(1, len(local_tasks.tasks))
+
+        [resp] = local_tasks.run(self.client, now=delivery.next_attempt)
+        self.assertEqual(200, resp.status_code, resp.get_data(as_text=True))
+
+        args, kwargs = mock_post.call_args
+        self.assertEqual(('https://foo.com/inbox',), args)
+        self.assertEqual(self.follow_as2, json_loads(kwargs['data']))
+
+        self.assert_object('http://a/follow',
+                           domains=['a'],
+                           source_protocol='webmention',
+                           status='complete',
+                           mf2=self.follow_mf2,
+                           as1=self.follow_as1,
+                           delivered=['https://foo.com/inbox'],
+                           type='follow',
+                           object_ids=['http://followee'],
+                           labels=['user', 'activity'],
+                          )
 
     def test_repost_blocklisted_error(self, mock_get, mock_post):
         """Reposts of non-fediverse (ie blocklisted) sites aren't yet supported."""
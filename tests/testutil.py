@@ -5,6 +5,7 @@ import datetime
 import unittest
 from unittest.mock import ANY, call
 
+from google.cloud import ndb
 from granary import as2
 from granary.tests.test_as1 import (
     COMMENT,
@@ -17,8 +18,8 @@ from oauth_dropins.webutil.testutil import requests_response
 import requests
 
 from app import app, cache
-import activitypub, common
-from models import Object, Target
+import activitypub, common, conversions, host_health, metrics
+from models import Delivery, Object
 
 
 class TestCase(unittest.TestCase, testutil.Asserts):
@@ -29,7 +30,13 @@ class TestCase(unittest.TestCase, testutil.Asserts):
         app.testing = True
         cache.clear()
         activitypub.seen_ids.clear()
+        activitypub.public_keys.clear()
         common.get_object.cache.clear()
+        common.fetch_failures.clear()
+        common._refresh_queued.clear()
+        conversions.cache.clear()
+        metrics.clear()
+        host_health.hosts.clear()
 
         self.client = app.test_client()
         self.client.__enter__()
@@ -65,6 +72,28 @@ class TestCase(unittest.TestCase, testutil.Asserts):
             Object(id='f', domains=['foo.com'], labels=['feed', 'notification', 'user'],
                    as2=as2.from_as1(NOTE), deleted=True).put()
 
+    @staticmethod
+    def store_deliveries(obj, **targets):
+        """Stores an :class:`Object` and :class:`Delivery`\\s for its targets.
+
+        Args:
+          obj: :class:`Object`
+          targets: str status => list of str target URIs
+
+        Returns: obj
+        """
+        deliveries = []
+        for status, uris in targets.items():
+            for uri in uris:
+                delivery = Delivery(id=Delivery._id(obj.key.id(), uri),
+                                    obj_id=obj.key.id(), target=uri,
+                                    protocol='activitypub')
+                obj.set_delivery(delivery, status)
+                deliveries.append(delivery)
+
+        ndb.put_multi(deliveries + [obj])
+        return obj
+
     def req(self, url, **kwargs):
         """Returns a mock requests call."""
         kwargs.setdefault('headers', {}).update({
@@ -101,11 +130,11 @@ class TestCase(unittest.TestCase, testutil.Asserts):
         got = Object.get_by_id(id)
         assert got, id
 
-        # right now we only do ActivityPub
-        # TODO: revisit as soon as we launch the next protocol, eg bluesky
-        for field in 'delivered', 'undelivered', 'failed':
-            props[field] = [Target(uri=uri, protocol='activitypub')
-                            for uri in props.get(field, [])]
+        # delivery state is in Delivery entities
+        for status in Delivery.STATUSES:
+            expected = sorted(props.pop(status, []))
+            self.assertEqual(expected, sorted(Delivery.targets(id, status)), status)
+            props.setdefault(f'{status}_count', len(expected))
 
         mf2 = props.get('mf2')
         if mf2 and 'items' in mf2:
@@ -119,5 +148,8 @@ class TestCase(unittest.TestCase, testutil.Asserts):
         if expected_as1 := props.pop('as1', None):
             self.assert_equals(common.redirect_unwrap(expected_as1), got.as1)
 
-        self.assert_entities_equal(Object(id=id, **props), got,
-                                   ignore=['created', 'updated'])
+        ignore = ['created', 'updated']
+        for prop in 'fetched', 'sent_as2':
+            if prop not in props:
+                ignore.append(prop)
+        self.assert_entities_equal(Object(id=id, **props), got, ignore=ignore)
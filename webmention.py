@@ -3,19 +3,19 @@
 TODO tests:
 * actor/attributedTo could be string URL
 """
+from datetime import timedelta
 import logging
+import os
 import urllib.parse
-from urllib.parse import urlencode
 
 import feedparser
 from flask import redirect, request
 from flask.views import View
+from google.cloud import ndb
 from google.cloud.ndb import Key
 from granary import as1, as2, microformats2
 import mf2util
 from oauth_dropins.webutil import flask_util, util
-from oauth_dropins.webutil.appengine_config import tasks_client
-from oauth_dropins.webutil.appengine_info import APP_ID
 from oauth_dropins.webutil.flask_util import error, flash
 from oauth_dropins.webutil.util import json_dumps, json_loads
 import requests
@@ -24,14 +24,26 @@ from werkzeug.exceptions import BadGateway, HTTPException
 import activitypub
 from app import app
 import common
-from models import Follower, Object, Target, User
+from conversions import convert
+import delivery
+import host_health
+import http_client
+from models import Delivery, Follower, Object, User
 
 logger = logging.getLogger(__name__)
 
 SKIP_EMAIL_DOMAINS = frozenset(('localhost', 'snarfed.org'))
 
-# https://cloud.google.com/appengine/docs/locations
-TASKS_LOCATION = 'us-central1'
+# if we have more inboxes than this to deliver to, split them into chunks of
+# this size and deliver each chunk in its own task
+DELIVER_CHUNK_SIZE = 100
+# how long finalize_deliveries_task waits for deliver_tasks to make progress
+FINALIZE_DELAY = timedelta(seconds=30)
+# whether every Follower has inbox and shared_inbox, so that we can collect
+# followers' inboxes with a projection query instead of loading them all. Turn
+# on once scripts/backfill_follower_inboxes.py has run. Set via environment
+# variable, eg in app.yaml.
+FOLLOWER_INBOXES_INDEXED = bool(os.getenv('FOLLOWER_INBOXES_INDEXED'))
 
 
 class Webmention(View):
@@ -78,7 +90,7 @@ class Webmention(View):
 
         # fetch source page
         try:
-            source_resp = util.requests_get(source, gateway=True)
+            source_resp = http_client.get(source, gateway=True)
         except ValueError as e:
             error(f'Bad source URL: {source}: {e}')
         self.source_url = source_resp.url or source
@@ -133,7 +145,6 @@ class Webmention(View):
 
         error = None
         last_success = None
-        log_data = True
 
         type = as1.object_type(self.source_as1)
         obj_id = self.source_as1.get('id') or self.source_url
@@ -142,26 +153,33 @@ class Webmention(View):
 
         if obj:
             logger.info(f'Resuming existing {obj}')
-            obj.failed = []
-            seen = [t.uri for t in obj.delivered + obj.undelivered + obj.failed]
-            new_inboxes = [i for i in inboxes_to_targets.keys() if i not in seen]
-            if new_inboxes:
-                logger.info(f'Adding new inboxes: {new_inboxes}')
-                obj.undelivered += [Target(uri=uri, protocol='activitypub')
-                                    for uri in new_inboxes]
             if type in ('note', 'article', 'comment'):
                 changed = as1.activity_changed(obj.as1, self.source_as1)
                 if changed:
-                    obj.undelivered += obj.delivered
-                    obj.delivered = []
-                    logger.info(f'Content has changed from last time at {obj.updated}! Redelivering to all inboxes: {obj.undelivered}')
-
+                    logger.info(f'Content has changed from last time at {obj.updated}! Redelivering to all inboxes')
         else:
             logger.info(f'New Object {obj_id}')
-            obj = Object(id=obj_id, delivered=[], failed=[],
-                         undelivered=[Target(uri=uri, protocol='activitypub')
-                                      for uri in inboxes_to_targets.keys()],
-                         status='in progress')
+            obj = Object(id=obj_id, status='in progress')
+
+        inboxes = list(inboxes_to_targets.keys())
+        if changed:
+            # send the update to everyone who got the original
+            inboxes += [inbox for inbox in Delivery.targets(obj_id, 'delivered')
+                        if inbox not in inboxes_to_targets]
+
+        # str inbox URL => Delivery. new ones have status None.
+        deliveries = Delivery.load(obj_id, inboxes)
+        new_inboxes = [i for i, d in deliveries.items() if d.status is None]
+        if new_inboxes:
+            logger.info(f'Adding new inboxes: {new_inboxes}')
+
+        # retry failed inboxes, and redeliver everything if content changed
+        dirty = []
+        for record in deliveries.values():
+            if (record.status in (None, 'failed')
+                    or (record.status == 'delivered' and changed)):
+                obj.set_delivery(record, 'undelivered')
+                dirty.append(record)
 
         obj.populate(
             domains=[self.user.key.id()],
@@ -175,14 +193,15 @@ class Webmention(View):
         if self.source_as1.get('objectType') == 'activity':
             obj.labels.append('activity')
 
-        obj.put()
-
         # TODO: collect by inbox, add 'to' fields, de-dupe inboxes and recipients
         #
-        # make copy of undelivered because we modify it below
-        logger.info(f'Delivering to inboxes: {sorted(t.uri for t in obj.undelivered)}')
-        for target in list(obj.undelivered):
-            inbox = target.uri
+        # prepare the activity and any datastore writes here, in the main
+        # thread, then deliver concurrently. store the activity too, so that
+        # retries.sweep can redeliver it.
+        targets = [d for d in deliveries.values() if d.status == 'undelivered']
+        logger.info(f'Delivering to inboxes: {sorted(t.target for t in targets)}')
+        for target in targets:
+            inbox = target.target
             if inbox in inboxes_to_targets:
                 target_as2 = inboxes_to_targets[inbox]
             else:
@@ -191,7 +210,8 @@ class Webmention(View):
 
             if not self.source_as2:
                 self.source_as2 = common.postprocess_as2(
-                    as2.from_as1(self.source_as1), target=target_as2, user=self.user)
+                    convert(as2.from_as1, self.source_as1), target=target_as2,
+                    user=self.user)
             if not self.source_as2.get('actor'):
                 self.source_as2['actor'] = common.host_url(self.user.key.id())
             if changed:
@@ -214,30 +234,51 @@ class Webmention(View):
                 Follower.get_or_create(dest=dest, src=self.user.key.id(),
                                        last_follow=self.source_as2)
 
-            try:
-                last = common.signed_post(inbox, user=self.user, data=self.source_as2,
-                                          log_data=log_data)
-                obj.delivered.append(target)
-                last_success = last
-            except BaseException as e:
-                code, body = util.interpret_http_exception(e)
-                if not code and not body:
-                    raise
-                obj.failed.append(target)
-                error = e
-            finally:
-                log_data = False
-
-            obj.undelivered.remove(target)
-            obj.put()
-
-        obj.status = ('complete' if obj.delivered
-                      else 'failed' if obj.failed
-                      else 'ignored')
-        obj.put()
+        if targets:
+            obj.sent_as2 = self.source_as2
+
+        obj.status = obj.delivery_status()
+        ndb.put_multi(dirty + [obj])
+
+        inboxes = [t.target for t in targets]
+        if len(inboxes) > DELIVER_CHUNK_SIZE:
+            return enqueue_deliveries(obj, inboxes, self.user, self.source_as2)
+
+        inboxes, deferred = host_health.hosts.partition(inboxes)
+        targets = [t for t in targets if t.target not in deferred]
+
+        failures = []
+        dirty = []
+
+        def save():
+            obj.status = obj.delivery_status()
+            ndb.put_multi(dirty + [obj])
+            dirty.clear()
+
+        results = delivery.deliver(inboxes, send_fn(self.user, self.source_as2))
+        with delivery.Checkpoint(save) as checkpoint:
+            for target, result in zip(targets, results):
+                if result.exception:
+                    code, body = util.interpret_http_exception(result.exception)
+                    if not code and not body:
+                        raise result.exception
+                    obj.set_delivery(target, 'failed')
+                    failures.append((target.target, result.exception))
+                    error = result.exception
+                else:
+                    obj.set_delivery(target, 'delivered')
+                    last_success = result.response
+
+                dirty.append(target)
+                checkpoint.changed()
+
+        # deferred targets stay undelivered so that they can be retried later
+        retry_deliveries(obj, self.user, self.source_as2, failures)
 
         # Pass the AP response status code and body through as our response
-        if last_success:
+        if deferred and not (last_success or error):
+            return f'Deferred delivery to {len(deferred)} inboxes with open circuits'
+        elif last_success:
             return last_success.text or 'Sent!', last_success.status_code
         elif isinstance(error, BadGateway):
             raise error
@@ -261,22 +302,10 @@ class Webmention(View):
 
         if not targets:
             # interpret this as a Create or Update, deliver it to followers. use
-            # task queue since we send to each inbox in serial, which can take a
-            # long time with many followers/instances.
+            # task queue since sending to many followers/instances can take a
+            # long time, even in parallel.
             if not self.IS_TASK:
-                queue_path= tasks_client.queue_path(APP_ID, TASKS_LOCATION, 'webmention')
-                tasks_client.create_task(
-                    parent=queue_path,
-                    task={
-                        'app_engine_http_request': {
-                            'http_method': 'POST',
-                            'relative_uri': '/_ah/queue/webmention',
-                            'body': urlencode({'source': self.source_url}).encode(),
-                            # https://googleapis.dev/python/cloudtasks/latest/gapic/v2/types.html#google.cloud.tasks_v2.types.AppEngineHttpRequest.headers
-                            'headers': {'Content-Type': 'application/x-www-form-urlencoded'},
-                        },
-                    },
-                )
+                common.create_task('webmention', source=self.source_url)
                 # not actually an error
                 msg = ("Updating profile on followers' instances..."
                        if self.user.is_homepage(self.source_url)
@@ -284,17 +313,23 @@ class Webmention(View):
                 # TODO: switch this to return so that it doesn't log error
                 error(msg, status=202)
 
-            inboxes = set()
             domain = self.user.key.id()
-            for follower in Follower.query().filter(
-                Follower.key > Key('Follower', domain + ' '),
-                Follower.key < Key('Follower', domain + chr(ord(' ') + 1))):
-                if follower.status != 'inactive' and follower.last_follow:
-                    actor = follower.last_follow.get('actor')
-                    if actor and isinstance(actor, dict):
-                        inboxes.add(actor.get('endpoints', {}).get('sharedInbox') or
-                                    actor.get('publicInbox') or
-                                    actor.get('inbox'))
+            if FOLLOWER_INBOXES_INDEXED:
+                query = Follower.query(Follower.dest == domain,
+                                       Follower.status == 'active',
+                                       projection=[Follower.shared_inbox],
+                                       distinct=True)
+                inboxes = {f.shared_inbox for f in query if f.shared_inbox}
+            else:
+                inboxes = set()
+                for follower in Follower.query().filter(
+                    Follower.key > Key('Follower', domain + ' '),
+                    Follower.key < Key('Follower', domain + chr(ord(' ') + 1))):
+                    if follower.status != 'inactive':
+                        _, shared_inbox = follower.inboxes_from_last_follow()
+                        if shared_inbox:
+                            inboxes.add(shared_inbox)
+
             logger.info('Delivering to followers')
             return {inbox: None for inbox in inboxes}
 
@@ -344,6 +379,267 @@ class Webmention(View):
         return inboxes_to_targets
 
 
+def send_fn(user, activity):
+    """Returns a function that delivers an activity to an inbox.
+
+    For :func:`delivery.deliver`. Serializes and digests the activity once, up
+    front, instead of for every inbox.
+
+    Args:
+      user: :class:`User` to sign with
+      activity: dict, AS2 activity
+    """
+    payload = common.SignedPayload(activity)
+
+    def send(inbox):
+        return common.signed_post(inbox, user=user, data=payload)
+
+    return send
+
+
+def retry_deliveries(obj, user, activity, failures):
+    """Schedules :func:`deliver_task` retries for inboxes that failed.
+
+    Args:
+      obj: :class:`Object`
+      user: :class:`User` to sign with
+      activity: dict, AS2 activity
+      failures: sequence of (str inbox, :class:`BaseException`) tuples
+    """
+    if not failures:
+        return
+
+    activity = json_dumps(activity)
+    for inbox, exception in failures:
+        common.schedule_retry(obj.key.id(), inbox, exception, 'deliver', {
+            'obj_id': obj.key.id(),
+            'domain': user.key.id(),
+            'inboxes': json_dumps([inbox]),
+            'activity': activity,
+            'retry': 'true',
+        })
+
+
+def enqueue_deliveries(obj, inboxes, user, activity):
+    """Splits delivery into tasks of :data:`DELIVER_CHUNK_SIZE` inboxes each.
+
+    Each task is handled by :func:`deliver_task`. Also enqueues a
+    :func:`finalize_deliveries_task` to update the :class:`Object`'s counts
+    and status afterward.
+
+    Args:
+      obj: :class:`Object`, already stored, with undelivered
+        :class:`Delivery`\\s for ``inboxes``
+      inboxes: sequence of str
+      user: :class:`User` to sign with
+      activity: dict, AS2 activity
+
+    Returns: str, Flask response body
+    """
+    chunks = [inboxes[i:i + DELIVER_CHUNK_SIZE]
+              for i in range(0, len(inboxes), DELIVER_CHUNK_SIZE)]
+    for chunk in chunks:
+        common.create_task('deliver', obj_id=obj.key.id(), domain=user.key.id(),
+                           inboxes=json_dumps(chunk), activity=json_dumps(activity))
+
+    common.create_task('finalize-deliveries', obj_id=obj.key.id(),
+                       schedule_time=util.now() + FINALIZE_DELAY)
+
+    msg = f'Delivering to {len(inboxes)} inboxes in {len(chunks)} tasks'
+    logger.info(msg)
+    return msg
+
+
+@app.post('/_ah/queue/deliver')
+def deliver_task():
+    """Task handler that delivers an activity to one chunk of inboxes.
+
+    Idempotent: skips inboxes that are no longer undelivered, eg if this task
+    is retried. Failures that are worth
+    retrying are scheduled for retry with :func:`common.schedule_retry`.
+
+    Only updates the chunk's :class:`Delivery`\\s, not the :class:`Object`,
+    so that concurrent chunks don't contend on it.
+    :func:`finalize_deliveries_task` updates its counts and status afterward.
+    Retries are one inbox each, so they update the :class:`Object` directly.
+
+    Parameters:
+      obj_id: str, :class:`Object` id
+      domain: str, user domain to sign with
+      inboxes: str, JSON list of inbox URLs
+      activity: str, JSON AS2 activity
+      retry: optional, if set, this is a retry of inboxes that failed, so also
+        send to failed inboxes
+    """
+    obj_id = flask_util.get_required_param('obj_id')
+    domain = flask_util.get_required_param('domain')
+    inboxes = json_loads(flask_util.get_required_param('inboxes'))
+    activity = json_loads(flask_util.get_required_param('activity'))
+    retry = bool(request.values.get('retry'))
+
+    user = User.get_by_id(domain)
+    if not user:
+        error(f'No user found for domain {domain}')
+    obj = Object.get_by_id(obj_id)
+    if not obj:
+        error(f'No object found for {obj_id}')
+
+    pending = ('undelivered', 'failed') if retry else ('undelivered',)
+    deliveries = Delivery.load(obj_id, inboxes)
+    inboxes = [inbox for inbox in inboxes if deliveries[inbox].status in pending]
+    # deferred inboxes stay undelivered so that they can be retried later
+    inboxes, deferred = host_health.hosts.partition(inboxes)
+    delivered = []
+    failures = []
+
+    try:
+        for result in delivery.deliver(inboxes, send_fn(user, activity)):
+            if result.exception:
+                code, body = util.interpret_http_exception(result.exception)
+                if not code and not body:
+                    raise result.exception
+                failures.append((result.url, result.exception))
+            else:
+                delivered.append(result.url)
+    finally:
+        failed = [inbox for inbox, _ in failures]
+        if retry:
+            # deferred retries go back to undelivered for the sweeper to pick up
+            record_deliveries(obj.key, delivered, failed, deferred=deferred)
+        else:
+            update_deliveries(obj_id, delivered, failed)
+
+    retry_deliveries(obj, user, activity, failures)
+
+    return (f'Delivered to {len(delivered)}, failed {len(failed)}, deferred '
+            f'{len(deferred)}')
+
+
+@app.post('/_ah/queue/finalize-deliveries')
+def finalize_deliveries_task():
+    """Task handler that updates an :class:`Object`'s counts and status.
+
+    Enqueued by :func:`enqueue_deliveries` after its :func:`deliver_task`\\s.
+    Enqueues itself again after :data:`FINALIZE_DELAY` as long as chunks are
+    still making progress, ie the number of undelivered targets is going
+    down. Once it stops, :func:`retries.sweep` picks up whatever's left.
+
+    Parameters:
+      obj_id: str, :class:`Object` id
+      undelivered: int, optional, undelivered count from the previous run
+    """
+    obj_id = flask_util.get_required_param('obj_id')
+    last = request.values.get('undelivered')
+
+    obj = finalize_deliveries(ndb.Key(Object, obj_id))
+    if not obj:
+        error(f'No object found for {obj_id}')
+
+    if obj.undelivered_count and (last is None
+                                  or obj.undelivered_count < int(last)):
+        common.create_task('finalize-deliveries', obj_id=obj_id,
+                           undelivered=obj.undelivered_count,
+                           schedule_time=util.now() + FINALIZE_DELAY)
+
+    return (f'{obj_id} is {obj.status}: {obj.delivered_count} delivered, '
+            f'{obj.undelivered_count} undelivered, {obj.failed_count} failed')
+
+
+def update_deliveries(obj_id, delivered, failed, deferred=(), obj=None):
+    """Updates some of an :class:`Object`'s :class:`Delivery`\\s.
+
+    Moves delivered inboxes from undelivered or failed, eg after a successful
+    retry, failed inboxes from undelivered, and deferred inboxes from failed
+    back to undelivered, eg if their circuit was open when we tried to retry
+    them. Inboxes that aren't in the status they'd move from are ignored, so
+    this is idempotent.
+
+    Args:
+      obj_id: str, :class:`Object` id
+      delivered: sequence of str inbox URLs
+      failed: sequence of str inbox URLs
+      deferred: sequence of str inbox URLs
+      obj: :class:`Object`, optional. If provided, its counts are updated to
+        match, but it isn't stored. Otherwise, see :func:`finalize_deliveries`.
+
+    Returns: list of the changed :class:`Delivery`\\s
+    """
+    deliveries = Delivery.load(obj_id, set(delivered) | set(failed) | set(deferred))
+
+    changed = []
+    for uris, status, sources in ((delivered, 'delivered', ('undelivered', 'failed')),
+                                  (failed, 'failed', ('undelivered',)),
+                                  (deferred, 'undelivered', ('failed',))):
+        for uri in uris:
+            record = deliveries[uri]
+            if record.status in sources:
+                if obj:
+                    obj.set_delivery(record, status)
+                else:
+                    record.status = status
+                changed.append(record)
+
+    ndb.put_multi(changed)
+    return changed
+
+
+@ndb.transactional()
+def record_deliveries(key, delivered, failed, deferred=()):
+    """Updates an :class:`Object`'s :class:`Delivery`\\s, counts, and status.
+
+    For a few targets at a time, eg retries. Updates the counts by the status
+    changes in :func:`update_deliveries`, in the same transaction, instead of
+    recounting them like :func:`finalize_deliveries`.
+
+    Args:
+      key: :class:`ndb.Key` of the :class:`Object`
+      delivered: sequence of str inbox URLs
+      failed: sequence of str inbox URLs
+      deferred: sequence of str inbox URLs
+
+    Returns: the updated :class:`Object`, or None if it doesn't exist
+    """
+    obj = key.get()
+    if not obj:
+        return None
+
+    if update_deliveries(key.id(), delivered, failed, deferred=deferred, obj=obj):
+        obj.status = obj.delivery_status()
+        obj.put()
+
+    return obj
+
+
+def finalize_deliveries(key):
+    """Recounts an :class:`Object`'s :class:`Delivery`\\s and stores its status.
+
+    For after chunked fan-outs, whose :func:`deliver_task`\\s only update
+    :class:`Delivery`\\s, and for :func:`retries.sweep`. Counts with queries,
+    since datastore transactions only allow ancestor queries, then stores the
+    counts in a transaction. Idempotent, and never increments or decrements
+    counts, so concurrent calls don't clobber each other's updates.
+
+    Args:
+      key: :class:`ndb.Key` of the :class:`Object`
+
+    Returns: the stored :class:`Object`, or None if it doesn't exist
+    """
+    return _store_counts(key, Delivery.counts(key.id()))
+
+
+@ndb.transactional()
+def _store_counts(key, counts):
+    obj = key.get()
+    if not obj:
+        return None
+
+    for status, count in counts.items():
+        setattr(obj, f'{status}_count', count)
+    obj.status = obj.delivery_status()
+    obj.put()
+    return obj
+
+
 class WebmentionTask(Webmention):
     """Handler that runs tasks, not external HTTP requests."""
     IS_TASK = True
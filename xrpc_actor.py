@@ -8,6 +8,7 @@ import mf2util
 from oauth_dropins.webutil import util
 
 from app import xrpc_server
+from conversions import convert
 from models import User
 
 logger = logging.getLogger(__name__)
@@ -33,7 +34,7 @@ def getProfile(input, actor=None):
     logger.info(f'AS1 actor: {json.dumps(actor_as1, indent=2)}')
 
     profile = {
-        **bluesky.from_as1(actor_as1),
+        **convert(bluesky.from_as1, actor_as1),
         'myState': {
             # ?
             'follow': 'TODO',
@@ -9,6 +9,7 @@ from oauth_dropins.webutil import util
 
 from app import xrpc_server
 from common import PAGE_SIZE
+from conversions import convert
 from models import Object, User
 
 logger = logging.getLogger(__name__)
@@ -30,13 +31,13 @@ def getAuthorFeed(input, author=None, limit=None, before=None):
 
     # TODO: unify with pages.feed?
     limit = min(limit or PAGE_SIZE, PAGE_SIZE)
-    objects, _, _ = Object.query(Object.domains == author, Object.labels == 'user') \
+    objects, _, _ = Object.query_live(Object.domains == author, Object.labels == 'user') \
         .order(-Object.created) \
         .fetch_page(limit)
     activities = [obj.as1 for obj in objects if not obj.deleted]
     logger.info(f'AS1 activities: {json.dumps(activities, indent=2)}')
 
-    return {'feed': [bluesky.from_as1(a) for a in activities]}
+    return {'feed': [convert(bluesky.from_as1, a) for a in activities]}
 
 
 @xrpc_server.method('app.bsky.feed.getPostThread')
@@ -56,10 +57,10 @@ def getPostThread(input, uri=None, depth=None):
     return {
         'thread': {
             '$type': 'app.bsky.feed.getPostThread#threadViewPost',
-            'post': bluesky.from_as1(obj.as1)['post'],
+            'post': convert(bluesky.from_as1, obj.as1)['post'],
             'replies': [{
                 '$type': 'app.bsky.feed.getPostThread#threadViewPost',
-                'post': bluesky.from_as1(reply)['post'],
+                'post': convert(bluesky.from_as1, reply)['post'],
             } for reply in obj.as1.get('replies', {}).get('items', [])],
         },
     }
@@ -75,7 +76,7 @@ def getRepostedBy(input, uri=None, cid=None, limit=None, before=None):
         raise ValueError('Missing uri')
 
     limit = min(limit or PAGE_SIZE, PAGE_SIZE)
-    objects, _, _ = Object.query(Object.object_ids == uri) \
+    objects, _, _ = Object.query_live(Object.object_ids == uri) \
         .order(-Object.created) \
         .fetch_page(limit)
     activities = [obj.as1 for obj in objects if not obj.deleted]
@@ -101,11 +102,12 @@ def getTimeline(input, algorithm=None, limit=50, before=None):
 
     # TODO: de-dupe with pages.feed()
     logger.info(f'Fetching {limit} objects for {user}')
-    objects, _, _ = Object.query(Object.domains == user, Object.labels == 'feed') \
+    objects, _, _ = Object.query_live(Object.domains == user, Object.labels == 'feed') \
         .order(-Object.created) \
         .fetch_page(limit)
 
-    return {'feed': [bluesky.from_as1(obj.as1) for obj in objects if not obj.deleted]}
+    return {'feed': [convert(bluesky.from_as1, obj.as1)
+                     for obj in objects if not obj.deleted]}
 
 
 # TODO: use likes as votes?